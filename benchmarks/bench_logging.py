@@ -0,0 +1,121 @@
+"""
+Benchmark of how much logging stalls the event loop when stdout is slow.
+
+Simulated requests log handler records and timed stages while a probe task
+measures how late its 1 ms sleeps wake up. The same workload runs with the
+synchronous stdout handler the bot used before (logging.basicConfig) and with
+utils.log, whose handler only queues records for a writer thread. Every write
+to the stream takes --write-latency, like a pipe the container runtime is
+slow to drain.
+
+Usage:
+    python -m benchmarks.bench_logging [--requests 50] [--records 40] [--write-latency 0.2]
+"""
+import argparse
+import asyncio
+import io
+import logging
+import time
+from typing import Dict, List
+
+from config import LOG_LEVEL
+from utils import log
+from utils.metrics import timed
+
+PROBE_INTERVAL = 0.001  # seconds
+
+
+class SlowStream(io.TextIOBase):
+    """Text stream that blocks for a while on every write and throws the text away."""
+
+    def __init__(self, latency: float) -> None:
+        super().__init__()
+        self.latency = latency
+        self.lines = 0
+
+    def write(self, text: str) -> int:
+        time.sleep(self.latency)
+        self.lines += text.count("\n")
+        return len(text)
+
+
+def percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))] if ordered else 0.0
+
+
+async def workload(requests: int, records: int) -> Dict[str, float]:
+    """Run the simulated requests and return how late the probe woke up."""
+    logger = logging.getLogger("handlers.messages")
+    lateness: List[float] = []
+    done = asyncio.Event()
+
+    async def probe() -> None:
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(PROBE_INTERVAL)
+            lateness.append(max(0.0, time.perf_counter() - start - PROBE_INTERVAL))
+
+    async def request(number: int) -> None:
+        with log.request_context(1000 + number, number, 1000 + number):
+            for record in range(records):
+                with timed("bench"):
+                    logger.info("Prompt of message %s: %s tokens, %s context messages", number, record, 3)
+                await asyncio.sleep(0)
+
+    probe_task = asyncio.create_task(probe())
+    start = time.perf_counter()
+    await asyncio.gather(*(request(number) for number in range(requests)))
+    wall = time.perf_counter() - start
+    done.set()
+    await probe_task
+    return {
+        "wall": wall,
+        "stall": sum(lateness),
+        "p99": percentile(lateness, 0.99),
+        "max": max(lateness, default=0.0),
+    }
+
+
+def run(mode: str, args: argparse.Namespace) -> None:
+    stream = SlowStream(args.write_latency / 1000)
+    for key in log.stats:
+        log.stats[key] = 0
+    if mode == "sync":
+        logging.basicConfig(
+            level=getattr(logging, LOG_LEVEL),
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            stream=stream,
+            force=True,
+        )
+    else:
+        log.setup_logging(stream=stream)
+
+    result = asyncio.run(workload(args.requests, args.records))
+
+    start = time.perf_counter()
+    log.close_logging()
+    drain = time.perf_counter() - start
+    logging.getLogger().handlers.clear()
+
+    print(f"{mode:<6} {result['wall'] * 1000:9.1f} {result['stall'] * 1000:9.1f} {result['p99'] * 1000:8.2f} "
+          f"{result['max'] * 1000:8.2f} {drain * 1000:9.1f} {stream.lines:8d} "
+          f"{log.stats['sampled_out']:8d} {log.stats['dropped']:8d}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50, help="concurrent simulated requests")
+    parser.add_argument("--records", type=int, default=40, help="handler records per request, each in a timed stage")
+    parser.add_argument("--write-latency", type=float, default=0.2, help="milliseconds every write to stdout takes")
+    args = parser.parse_args()
+
+    print(f"{args.requests} requests x {args.records} records, {args.write_latency} ms per write")
+    print(f"{'mode':<6} {'wall ms':>9} {'stall ms':>9} {'p99 ms':>8} {'max ms':>8} {'drain ms':>9} "
+          f"{'written':>8} {'sampled':>8} {'dropped':>8}")
+    run("sync", args)
+    run("queue", args)
+
+
+if __name__ == "__main__":
+    main()
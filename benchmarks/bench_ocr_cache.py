@@ -0,0 +1,135 @@
+"""
+Benchmark of whether perceptual hashes tell copies of a photo from different formulas.
+
+Formulas from benchmarks/formulas.txt are rendered like photos, and each one is
+changed in one symbol at a time: a digit, a plus or minus sign, or a variable.
+The hashes of re-compressed and downscaled copies of each photo should be
+close to the original's, the hashes of the edited formulas should not. The
+photos in benchmarks/ocr_samples are copied the same way, and compared with
+each other as distinct photos.
+
+For each distance threshold the benchmark reports the share of copies the hash
+lookup would find and the pairs of distinct formulas it would wrongly match.
+OCR_CACHE_HASH_LOOKUP may only be turned on at a threshold without false positives.
+
+Usage:
+    python -m benchmarks.bench_ocr_cache [--edits 4]
+"""
+import argparse
+import glob
+import io
+import os
+import random
+import re
+from typing import Dict, List, Tuple
+
+from PIL import Image
+
+from config import MATPLOTLIB_CONFIG, RENDER_FONTSIZE, OCR_CACHE_MAX_DISTANCE
+from services import render_service
+from services.ocr_cache import image_hash
+
+FORMULAS = os.path.join(os.path.dirname(__file__), "formulas.txt")
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), "ocr_samples")
+# JPEG quality and scale of the copies, like a photo saved again or sent as a smaller size
+COPIES = ((85, 1.0), (75, 0.75), (60, 0.5))
+THRESHOLDS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def recompress(data: bytes, quality: int, scale: float) -> bytes:
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    if scale != 1.0:
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def edits(latex: str) -> List[str]:
+    """Versions of a formula that differ from it in one symbol."""
+    changed = []
+    for match in re.finditer(r"\d", latex):
+        changed.append(latex[:match.start()] + str((int(match.group()) + 1) % 10) + latex[match.end():])
+    for match in re.finditer(r"[+-]", latex):
+        changed.append(latex[:match.start()] + ("-" if match.group() == "+" else "+") + latex[match.end():])
+    for match in re.finditer(r"(?<![\\a-zA-Z])[a-z](?![a-zA-Z])", latex):
+        changed.append(latex[:match.start()] + ("y" if match.group() != "y" else "z") + latex[match.end():])
+    return changed
+
+
+def render(latex: str) -> bytes:
+    """Render a formula with mathtext and save it as a photo would be."""
+    png, usetex = render_service._render_png(latex, RENDER_FONTSIZE)
+    if usetex:
+        raise ValueError("needs LaTeX")
+    return recompress(png, 90, 1.0)
+
+
+def distance(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--edits", type=int, default=4, help="one-symbol edits per formula, 0 for all")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    render_service._init_worker(MATPLOTLIB_CONFIG)
+
+    with open(FORMULAS, encoding="utf-8") as f:
+        formulas = [line.strip() for line in f if line.strip()]
+
+    originals: Dict[str, str] = {}
+    copies: List[int] = []
+    distinct: List[Tuple[int, str, str]] = []
+    for latex in formulas:
+        try:
+            photo = render(latex)
+        except Exception:
+            continue
+        originals[latex] = phash = image_hash(photo)
+        copies.extend(distance(phash, image_hash(recompress(photo, *copy))) for copy in COPIES)
+
+        changed = edits(latex)
+        random.shuffle(changed)
+        for edited in changed[:args.edits or None]:
+            try:
+                edited_photo = render(edited)
+            except Exception:
+                continue
+            # The edited formula may arrive as a fresh photo or as a re-compressed one
+            for candidate in (edited_photo, recompress(edited_photo, *COPIES[-1])):
+                distinct.append((distance(phash, image_hash(candidate)), latex, edited))
+
+    for a, b in ((a, b) for i, a in enumerate(originals) for b in list(originals)[i + 1:]):
+        distinct.append((distance(originals[a], originals[b]), a, b))
+
+    samples = {os.path.basename(path): open(path, "rb").read()
+               for path in sorted(glob.glob(os.path.join(SAMPLES_DIR, "*.jpg")))}
+    sample_hashes = {name: image_hash(data) for name, data in samples.items()}
+    for name, data in samples.items():
+        copies.extend(distance(sample_hashes[name], image_hash(recompress(data, *copy))) for copy in COPIES)
+    names = list(sample_hashes)
+    for i, a in enumerate(names):
+        for b in names[i + 1:]:
+            distinct.append((distance(sample_hashes[a], sample_hashes[b]), a, b))
+
+    print(f"{len(originals)} formulas and {len(samples)} photos, {len(copies)} copies, "
+          f"{len(distinct)} pairs of distinct images")
+    print(f"{'threshold':>9} {'copies found':>13} {'false positives':>16}")
+    for threshold in THRESHOLDS:
+        found = sum(d <= threshold for d in copies)
+        wrong = sum(d <= threshold for d, _, _ in distinct)
+        mark = "  <- OCR_CACHE_MAX_DISTANCE" if threshold == OCR_CACHE_MAX_DISTANCE else ""
+        print(f"{threshold:>9} {found / len(copies):>12.0%} {wrong:>16}{mark}")
+
+    closest = sorted(distinct)[:5]
+    print("\nClosest distinct pairs:")
+    for d, a, b in closest:
+        print(f"{d:>5} bits  {a}  vs  {b}")
+    print(f"\nCopies differ by up to {max(copies)} bits, distinct images by as few as {closest[0][0]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Latency and agreement benchmark for the image preprocessing before LaTeX OCR.
+
+Runs pix2tex on every photo in benchmarks/ocr_samples twice: on the raw photo,
+as the bot did before preprocessing, and on the equations cut out of the photo
+by services.image_preprocessing. Reports the time of both paths, whether their
+outputs agree, and how close each output is to the LaTeX the sample was drawn
+from. Photos are first scaled down to OCR_MIN_PHOTO_SIDE, like the photo size
+the bot downloads now.
+
+Usage:
+    python -m benchmarks.bench_ocr_preprocessing [--repeats 3] [--no-ocr]
+"""
+import argparse
+import difflib
+import io
+import json
+import os
+import time
+from typing import List
+
+from PIL import Image
+
+from config import OCR_MIN_PHOTO_SIDE
+from services.image_preprocessing import preprocess_image
+
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), "ocr_samples")
+
+
+def normalize(latex: str) -> str:
+    return "".join(latex.split())
+
+
+def similarity(a: str, b: str) -> float:
+    return difflib.SequenceMatcher(None, normalize(a), normalize(b)).ratio()
+
+
+def downscale(data: bytes, side: int) -> bytes:
+    """Scale a photo like Telegram's smaller photo sizes."""
+    image = Image.open(io.BytesIO(data))
+    if max(image.size) <= side:
+        return data
+    image.thumbnail((side, side))
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=87)
+    return buffer.getvalue()
+
+
+def timed(function, repeats: int):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = function()
+    return result, (time.perf_counter() - start) / repeats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=3, help="runs per sample and path")
+    parser.add_argument("--no-ocr", action="store_true", help="only time the preprocessing")
+    args = parser.parse_args()
+
+    with open(os.path.join(SAMPLES_DIR, "expected.json"), encoding="utf-8") as f:
+        expected = json.load(f)
+
+    model = None
+    if not args.no_ocr:
+        from pix2tex.cli import LatexOCR
+        model = LatexOCR()
+
+    def recognize_regions(regions: List[bytes]) -> str:
+        return "\n".join(model(Image.open(io.BytesIO(region))) for region in regions)
+
+    print(f"{'sample':<22} {'raw KB':>7} {'used KB':>8} {'regions':>8} {'prep ms':>8}", end="")
+    print(f" {'raw ms':>8} {'new ms':>8} {'agree':>6} {'raw sim':>8} {'new sim':>8}" if model else "")
+    totals = {"raw": 0.0, "new": 0.0, "agree": 0, "raw_sim": 0.0, "new_sim": 0.0}
+
+    for name in sorted(expected):
+        with open(os.path.join(SAMPLES_DIR, name), "rb") as f:
+            raw = f.read()
+        used = downscale(raw, OCR_MIN_PHOTO_SIDE)
+        regions, prep = timed(lambda: preprocess_image(used), args.repeats)
+        line = (f"{name:<22} {len(raw) / 1024:>7.1f} {len(used) / 1024:>8.1f} "
+                f"{f'{len(regions)}/{len(expected[name])}':>8} {prep * 1000:>8.1f}")
+
+        if model:
+            raw_output, raw_time = timed(lambda: model(Image.open(io.BytesIO(raw))), args.repeats)
+            new_output, new_time = timed(lambda: recognize_regions(regions), args.repeats)
+            new_time += prep
+            truth = "\n".join(expected[name])
+            agree = normalize(raw_output) == normalize(new_output)
+            raw_sim, new_sim = similarity(raw_output, truth), similarity(new_output, truth)
+            totals["raw"] += raw_time
+            totals["new"] += new_time
+            totals["agree"] += agree
+            totals["raw_sim"] += raw_sim
+            totals["new_sim"] += new_sim
+            line += (f" {raw_time * 1000:>8.0f} {new_time * 1000:>8.0f} {'yes' if agree else 'no':>6}"
+                     f" {raw_sim:>8.2f} {new_sim:>8.2f}")
+        print(line)
+
+    if model:
+        count = len(expected)
+        print(f"\nTotal OCR time: raw {totals['raw']:.2f}s, preprocessed {totals['new']:.2f}s "
+              f"({totals['raw'] / totals['new']:.1f}x)")
+        print(f"Identical output on {totals['agree']}/{count} samples, mean similarity to the source LaTeX: "
+              f"raw {totals['raw_sim'] / count:.2f}, preprocessed {totals['new_sim'] / count:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark of the formula renderer on a corpus of formulas from real answers.
+
+Renders every formula of benchmarks/formulas.txt with the LaTeX-only renderer
+it replaced and with services.render_service, in this process, and reports
+time, PNG size and the tier each formula took. Without a LaTeX installation
+the legacy column and the usetex fallback are reported as failures.
+
+Usage:
+    python -m benchmarks.bench_render [--corpus benchmarks/formulas.txt] [--repeats 3]
+"""
+import argparse
+import io
+import os
+import time
+from typing import List, Optional, Tuple
+
+from config import MATPLOTLIB_CONFIG, RENDER_FONTSIZE
+from services import render_service
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), "formulas.txt")
+
+
+# Reference implementation, kept verbatim from before the mathtext tier
+
+def legacy_render_png(latex_expr: str, fontsize: int = 20, dpi: int = 300) -> bytes:
+    """Render a LaTeX expression on the worker's figure and return PNG bytes."""
+    figure = render_service._figure
+    figure.clear()
+    figure.text(0.5, 0.5, latex_expr, fontsize=fontsize, ha='center', va='center', usetex=True)
+
+    buffer = io.BytesIO()
+    try:
+        figure.savefig(buffer, format='png', dpi=dpi, bbox_inches='tight', pad_inches=0.05)
+    finally:
+        figure.clear()
+    return buffer.getvalue()
+
+
+def load_corpus(path: str) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def measure(render, formula: str, repeats: int) -> Tuple[Optional[float], Optional[bytes]]:
+    """Best time of a render in seconds and its output, or None for both if it fails."""
+    best = None
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        try:
+            result = render(formula)
+        except Exception:
+            return None, None
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark(corpus: List[str], repeats: int) -> None:
+    render_service._init_worker(MATPLOTLIB_CONFIG)
+    # Load fonts before timing anything
+    render_service._render_png(r"$x^2$", RENDER_FONTSIZE)
+
+    def fmt(seconds: Optional[float], data: Optional[bytes]) -> str:
+        return f"{seconds * 1000:>8.1f} {len(data) / 1024:>7.1f}" if seconds is not None else f"{'failed':>16}"
+
+    print(f"{'#':>3} {'legacy ms':>9} {'KiB':>6} {'new ms':>8} {'KiB':>7} {'tier':>8}  formula")
+    legacy_total = new_total = 0.0
+    legacy_bytes = new_bytes = 0
+    compared = mathtext = failed = 0
+    for number, formula in enumerate(corpus, 1):
+        legacy_time, legacy_png = measure(legacy_render_png, formula, repeats)
+        new_time, new_result = measure(lambda f: render_service._render_png(f, RENDER_FONTSIZE), formula, repeats)
+        new_png, usetex = new_result if new_result else (None, True)
+        if new_time is None:
+            tier = "failed"
+            failed += 1
+        else:
+            tier = "usetex" if usetex else "mathtext"
+            mathtext += not usetex
+        if legacy_time is not None and new_time is not None:
+            compared += 1
+            legacy_total += legacy_time
+            new_total += new_time
+            legacy_bytes += len(legacy_png)
+            new_bytes += len(new_png)
+        short = formula if len(formula) <= 50 else formula[:47] + "..."
+        print(f"{number:>3} {fmt(legacy_time, legacy_png)} {fmt(new_time, new_png)} {tier:>8}  {short}")
+
+    print()
+    print(f"{len(corpus)} formulas: {mathtext} with mathtext ({mathtext / len(corpus):.0%}), "
+          f"{len(corpus) - mathtext - failed} with LaTeX, {failed} failed")
+    if compared:
+        print(f"{compared} rendered by both: legacy {legacy_total * 1000:.0f} ms, {legacy_bytes / 1024:.0f} KiB; "
+              f"new {new_total * 1000:.0f} ms, {new_bytes / 1024:.0f} KiB "
+              f"({legacy_total / new_total:.1f}x faster, {legacy_bytes / new_bytes:.1f}x smaller)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="file with one formula per line")
+    parser.add_argument("--repeats", type=int, default=3, help="renders per formula, the best one counts")
+    args = parser.parse_args()
+
+    benchmark(load_corpus(args.corpus), args.repeats)
+
+
+if __name__ == "__main__":
+    main()
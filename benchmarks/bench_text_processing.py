@@ -0,0 +1,229 @@
+"""
+Equivalence check and micro-benchmark for the response tokenizer.
+
+Compares utils.text_processing.split_response with the pipeline it replaced
+(preprocess_response -> split_response -> clear_splitted_response), on random
+LaTeX-heavy inputs fed both at once and in random increments, then times both
+across answer sizes.
+
+Usage:
+    python -m benchmarks.bench_text_processing [--cases 2000] [--seed 0]
+"""
+import argparse
+import random
+import time
+from typing import List
+
+from utils.text_processing import ResponseSplitter, split_response
+
+# Pieces the random responses are built from, biased towards delimiters and their edge cases
+ALPHABET = [
+    "$", "$$", "\\(", "\\)", "\\[", "\\]", "```", "`", "\\", "(", ")", "[", "]",
+    " ", "  ", "\n", ".", ",", ":", "-", "!", "a", "x", "x^2", "\\frac{1}{2}", "\\int_0^1",
+    "Solve ", "the equation", "\t",
+]
+
+
+# Reference implementation, kept verbatim from before the tokenizer
+
+def legacy_preprocess_response(tex: str) -> str:
+    """Preprocess LaTeX in the response for proper rendering."""
+    text = list(tex)
+    i = 0
+    length = len(text)
+    while i < length:
+        if text[i:i + 2] in [['\\', '('], ['\\', '[']]:
+            if text[i + 5:i + 7] in [['\\', ')'], ['\\', ']']]:
+                text[i:i + 2] = ['', '*']
+                text[i + 5:i + 7] = ['', '*']
+            else:
+                text[i:i + 2] = ['$', '$']
+        elif text[i:i + 2] in [['\\', ')'], ['\\', ']']]:
+            text[i:i + 2] = ['$', '$']
+        elif text[i] == '$' and i + 2 < length and text[i + 2] == '$':
+            text[i] = '*'
+            text[i + 2] = '*'
+        i += 1
+    return "".join(text)
+
+
+def legacy_split_response(text: str, max_length: int = 4096) -> List[str]:
+    """
+    Split a response into chunks, preserving LaTeX expressions.
+
+    Args:
+        text: The text to split
+        max_length: Maximum length of each chunk
+
+    Returns:
+        List of text chunks
+    """
+    result = []
+    buffer = ""
+    inside_latex = False
+    delimiter = None
+    in_code_block = False
+    i = 0
+
+    while i < len(text):
+        if text[i:i + 3] == "```":
+            in_code_block = not in_code_block
+            buffer += text[i:i + 3]
+            i += 3
+            continue
+
+        if not in_code_block:
+            if text[i:i + 2] == "$$":
+                if inside_latex and delimiter == "$$":
+                    result.append("$$" + buffer + "$$")
+                    buffer = ""
+                    inside_latex = False
+                    delimiter = None
+                    i += 2
+                else:
+                    if buffer:
+                        result.extend(legacy_split_non_latex(buffer, max_length))
+                    buffer = ""
+                    inside_latex = True
+                    delimiter = "$$"
+                    i += 2
+            elif text[i] == "$":
+                if inside_latex and delimiter == "$":
+                    result.append("$" + buffer + "$")
+                    buffer = ""
+                    inside_latex = False
+                    delimiter = None
+                    i += 1
+                else:
+                    if buffer:
+                        result.extend(legacy_split_non_latex(buffer, max_length))
+                    buffer = ""
+                    inside_latex = True
+                    delimiter = "$"
+                    i += 1
+            else:
+                buffer += text[i]
+                i += 1
+        else:
+            buffer += text[i]
+            i += 1
+
+    # Add remaining buffer
+    if buffer:
+        result.extend(legacy_split_non_latex(buffer, max_length))
+
+    return result
+
+
+def legacy_split_non_latex(text: str, max_length: int) -> List[str]:
+    """
+    Split non-LaTeX text into chunks of a specified length.
+
+    Args:
+        text: The text to split
+        max_length: Maximum length of each chunk
+
+    Returns:
+        List of text chunks
+    """
+    return [text[i:i + max_length] for i in range(0, len(text), max_length)]
+
+
+def legacy_clear_splitted_response(text: str) -> str:
+    """
+    Clean up a split response by removing leading whitespace and punctuation.
+
+    Args:
+        text: The text to clean
+
+    Returns:
+        Cleaned text
+    """
+    to_remove = " !.,:-\n"
+    text = text.lstrip()
+    for ch in text:
+        if ch in to_remove:
+            text = text[1:]
+        else:
+            break
+    return text
+
+
+def legacy_chunks(text: str, max_length: int) -> List[str]:
+    chunks = legacy_split_response(legacy_preprocess_response(text), max_length)
+    return [cleared for cleared in map(legacy_clear_splitted_response, chunks) if cleared]
+
+
+def random_response(rng: random.Random, size: int) -> str:
+    return "".join(rng.choice(ALPHABET) for _ in range(size))
+
+
+def fed_in_pieces(text: str, rng: random.Random, max_length: int) -> List[str]:
+    splitter = ResponseSplitter(max_length)
+    chunks = []
+    i = 0
+    while i < len(text):
+        step = rng.randint(1, 12)
+        chunks.extend(splitter.feed(text[i:i + step]))
+        i += step
+    chunks.extend(splitter.close())
+    return [chunk.text for chunk in chunks]
+
+
+def check_equivalence(cases: int, seed: int) -> None:
+    rng = random.Random(seed)
+    for case in range(cases):
+        text = random_response(rng, rng.randint(0, 80))
+        max_length = rng.choice([3, 8, 32, 4096])
+        expected = legacy_chunks(text, max_length)
+        actual = [chunk.text for chunk in split_response(text, max_length)]
+        incremental = fed_in_pieces(text, rng, max_length)
+        if actual != expected or incremental != expected:
+            raise AssertionError(
+                f"Mismatch in case {case} (max_length={max_length}) for {text!r}:\n"
+                f"  legacy:      {expected!r}\n  tokenizer:   {actual!r}\n  incremental: {incremental!r}"
+            )
+    print(f"{cases} random responses: tokenizer output matches the legacy pipeline")
+
+
+def realistic_response(size: int) -> str:
+    paragraph = (
+        "To solve the equation we substitute $u = x^2$ and integrate:\n"
+        "$$\\int_0^1 \\frac{x}{1 + x^2} dx = \\frac{1}{2}\\ln 2$$\n"
+        "Then \\(a + b\\) gives the answer, see the code below.\n"
+        "```python\nprint(sum(range(10)))\n```\n"
+    )
+    return (paragraph * (size // len(paragraph) + 1))[:size]
+
+
+def benchmark() -> None:
+    print(f"{'size':>8} {'legacy ms':>10} {'tokenizer ms':>13} {'speedup':>8}")
+    for size in (1_000, 10_000, 100_000, 1_000_000):
+        text = realistic_response(size)
+        repeats = max(1, 200_000 // size)
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            legacy_chunks(text, 4096)
+        legacy = (time.perf_counter() - start) / repeats
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            split_response(text, 4096)
+        tokenizer = (time.perf_counter() - start) / repeats
+
+        print(f"{size:>8} {legacy * 1000:>10.2f} {tokenizer * 1000:>13.2f} {legacy / tokenizer:>7.1f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", type=int, default=2000, help="number of random responses to compare")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    check_equivalence(args.cases, args.seed)
+    benchmark()
+
+
+if __name__ == "__main__":
+    main()
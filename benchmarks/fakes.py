@@ -0,0 +1,250 @@
+"""
+Local stand-ins for the Telegram Bot API and the OpenAI API, used by the load test.
+
+FakeBotSession replaces the bot's HTTP session, so requests still pass through the
+session middlewares and responses through aiogram's deserialization. FakeOpenAI
+is an OpenAI-compatible chat completions server with configurable latency and
+streaming, run on its own thread so it doesn't compete with the bot's event loop.
+"""
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from typing import AsyncGenerator, Callable, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import (
+    EditMessageText,
+    GetFile,
+    SendMediaGroup,
+    SendMessage,
+    SendPhoto,
+    TelegramMethod,
+)
+from aiogram.methods.base import TelegramType
+
+# Methods that deliver a reply to the user
+REPLY_METHODS = (SendMessage, SendPhoto, SendMediaGroup)
+
+
+class FakeBotSession(BaseSession):
+    """
+    Bot API session answering every request locally after a simulated network delay.
+
+    Args:
+        latency: Mean delay of a request in seconds
+        jitter: Relative spread of the delay, 0.5 gives delays between 0.5x and 1.5x latency
+        seed: Seed of the delay generator
+        on_reply: Called with the chat id whenever a reply is sent to a chat
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.5,
+        seed: int = 0,
+        on_reply: Optional[Callable[[int], None]] = None,
+    ) -> None:
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.on_reply = on_reply
+        # Downloadable files by file id, which also serves as the file path
+        self.files: Dict[str, bytes] = {}
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.requests: Counter = Counter()
+
+    def _delay(self) -> float:
+        return self.latency * self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _message(self, chat_id: int, **fields) -> dict:
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **fields,
+        }
+
+    def _photo(self) -> List[dict]:
+        number = next(self.file_ids)
+        return [{"file_id": f"sent-{number}", "file_unique_id": f"sent-{number}", "width": 800, "height": 200}]
+
+    def _result(self, method: TelegramMethod) -> object:
+        chat_id = getattr(method, "chat_id", None)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return self._message(chat_id, text=method.text)
+        if isinstance(method, SendPhoto):
+            return self._message(chat_id, photo=self._photo())
+        if isinstance(method, SendMediaGroup):
+            return [self._message(chat_id, photo=self._photo()) for _ in method.media]
+        if isinstance(method, GetFile):
+            data = self.files.get(method.file_id, b"")
+            return {
+                "file_id": method.file_id,
+                "file_unique_id": method.file_id,
+                "file_size": len(data),
+                "file_path": method.file_id,
+            }
+        return True
+
+    async def make_request(
+        self,
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+        timeout: Optional[int] = None,
+    ) -> TelegramType:
+        await asyncio.sleep(self._delay())
+        self.requests[type(method).__name__] += 1
+        if self.on_reply and isinstance(method, REPLY_METHODS):
+            self.on_reply(method.chat_id)
+        content = json.dumps({"ok": True, "result": self._result(method)})
+        return self.check_response(bot=bot, method=method, status_code=200, content=content).result
+
+    async def stream_content(
+        self,
+        url: str,
+        headers: Optional[dict] = None,
+        timeout: int = 30,
+        chunk_size: int = 65536,
+        raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        await asyncio.sleep(self._delay())
+        data = self.files[url.rsplit("/", 1)[-1]]
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeOpenAI:
+    """
+    OpenAI-compatible chat completions server producing LaTeX-heavy answers.
+
+    Args:
+        first_token: Mean seconds until the first token of a response
+        token_interval: Seconds between streamed tokens
+        formulas: Display formulas per answer
+        jitter: Relative spread of the first token delay
+        seed: Seed of the response generator
+    """
+
+    def __init__(
+        self,
+        first_token: float = 0.5,
+        token_interval: float = 0.01,
+        formulas: int = 3,
+        jitter: float = 0.3,
+        seed: int = 0,
+    ) -> None:
+        self.first_token = first_token
+        self.token_interval = token_interval
+        self.formulas = formulas
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self.runner = None
+
+    def _answer(self, short: bool) -> str:
+        rng = self.rng
+        if short:
+            return "The user is working on equations; results so far: $x = 2$ and $y = -1$."
+        a, b, c = rng.randint(2, 9), rng.randint(2, 20), rng.randint(1, 9)
+        parts = [f"Let's solve it step by step. We start from $f(x) = {a}x^2 + {b}x + {c}$ "
+                 f"and look for its roots, using the discriminant $D = b^2 - 4ac$."]
+        formulas = [
+            f"$$D = {b}^2 - 4 \\cdot {a} \\cdot {c} = {b * b - 4 * a * c}$$",
+            f"$$x_{{1,2}} = \\frac{{-{b} \\pm \\sqrt{{{b * b - 4 * a * c}}}}}{{{2 * a}}}$$",
+            f"$$\\int_0^{{{c}}} {a}x^2 \\, dx = \\frac{{{a} \\cdot {c}^3}}{{3}}$$",
+            f"$$\\sum_{{k=1}}^{{{b}}} k = \\frac{{{b} \\cdot {b + 1}}}{{2}} = {b * (b + 1) // 2}$$",
+            f"$$\\lim_{{x \\to \\infty}} \\frac{{{a}x + {c}}}{{x}} = {a}$$",
+        ]
+        for i in range(self.formulas):
+            parts.append(formulas[i % len(formulas)])
+            parts.append(f"Here ${a}x$ grows slower than $x^2$, so the term with $x^{{{i + 2}}}$ dominates.")
+        parts.append("```python\nimport sympy as sp\nx = sp.symbols('x')\n"
+                     f"print(sp.solve({a}*x**2 + {b}*x + {c}, x))\n```")
+        parts.append("So the answer is the pair of roots above.")
+        return "\n\n".join(parts)
+
+    @staticmethod
+    def _tokens(text: str) -> List[str]:
+        # Roughly four characters per token
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    async def _completions(self, request):
+        from aiohttp import web
+
+        body = await request.json()
+        self.requests += 1
+        tokens = self._tokens(self._answer(short="max_tokens" in body))
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in body["messages"]) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens)}
+        base = {"id": f"chatcmpl-{self.requests}", "created": int(time.time()), "model": body["model"]}
+        await asyncio.sleep(self.first_token * self.rng.uniform(1 - self.jitter, 1 + self.jitter))
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_interval * len(tokens))
+            return web.json_response({
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(tokens)}}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def event(data: dict) -> None:
+            await response.write(f"data: {json.dumps(data)}\n\n".encode())
+
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(self.token_interval)
+            await event({**base, "object": "chat.completion.chunk",
+                         "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]})
+        await event({**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if body.get("stream_options", {}).get("include_usage"):
+            await event({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def _start(self) -> str:
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._completions)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        host, port = self.runner.addresses[0][:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> str:
+        """Start the server on a free port and return its base URL."""
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="fake-openai", daemon=True)
+        self.thread.start()
+        return asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    def stop(self) -> None:
+        """Stop the server and its thread."""
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
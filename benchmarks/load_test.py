@@ -0,0 +1,378 @@
+"""
+End-to-end load test of the bot against local Telegram and OpenAI stand-ins.
+
+Drives the real Dispatcher with the bot's handlers through benchmarks.fakes:
+a fake Bot API session and a fake OpenAI server with configurable latency and
+streaming. Simulated users send text, photo and document messages concurrently,
+each waiting for the answer to one message before sending the next, and the
+answers are LaTeX-heavy, so rendering and sending formulas is part of the load.
+
+Reports throughput, latency percentiles per stage as recorded by utils.metrics
+(plus e2e, the whole handling of an update, and first_reply, the time until the
+first reply is sent), errors and peak memory, and saves them as JSON so runs can
+be compared. Messages are processed in this process as with JOB_WORKERS = 0, on
+a fresh database and caches in a temporary directory. Photo messages need pix2tex,
+and formulas mathtext can't handle need LaTeX, like in the bot itself.
+
+Usage:
+    python -m benchmarks.load_test [--users 20] [--messages 5] [--mix text=6,photo=2,document=2]
+        [--gpt-first-token 0.5] [--gpt-token-interval 0.01] [--api-latency 0.05]
+        [--output results.json] [--compare earlier.json]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+from benchmarks.fakes import FakeBotSession, FakeOpenAI
+
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), "ocr_samples")
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+TOKEN = "123456:LOAD-TEST"
+FIRST_USER_ID = 100000
+# Stages shown first in the report, in processing order
+STAGE_ORDER = ["e2e", "first_reply", "update", "message", "download", "ocr_preprocess", "ocr", "gpt",
+               "gpt_first_token", "solve", "tokenize", "render", "send", "db_read", "db_enqueue", "db_write"]
+
+PROMPTS = [
+    "Solve the equation {a}x^2 - {b}x + {c} = 0",
+    "Find the derivative of x^{a} sin({b}x) and explain every step",
+    "Compute the integral of {a}x^2 + {b} from 0 to {c}",
+    "Prove that the sum of the first {b} odd numbers is a square",
+    "Find the limit of ({a}x + {c}) / x as x goes to infinity",
+    # Plain math, answered by the solver without GPT
+    "x^2 - {b}x - {c} = 0",
+    "\\int_0^{{{c}}} {a}x^2 \\, dx",
+]
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("text", "photo", "document"):
+            raise argparse.ArgumentTypeError(f"unknown message kind: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def summarize(values: List[float]) -> dict:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": values[-1],
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_mb() -> Dict[str, float]:
+    """Peak resident memory of this process and of its finished child processes."""
+    try:
+        import resource
+    except ImportError:
+        return {}
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "children_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+class Traffic:
+    """Builds the updates the simulated users send."""
+
+    def __init__(self, session: FakeBotSession, seed: int, large_documents: float) -> None:
+        self.session = session
+        self.rng = random.Random(seed)
+        self.large_documents = large_documents
+        self.update_ids = 0
+        self.photos = []
+        for name in sorted(os.listdir(SAMPLES_DIR)):
+            if name.endswith(".jpg"):
+                with open(os.path.join(SAMPLES_DIR, name), "rb") as f:
+                    self.photos.append(f.read())
+
+    def _prompt(self) -> str:
+        rng = self.rng
+        return rng.choice(PROMPTS).format(a=rng.randint(2, 9), b=rng.randint(2, 30), c=rng.randint(1, 9))
+
+    def _document(self, number: int) -> dict:
+        rng = self.rng
+        rows = 4000 if rng.random() < self.large_documents else 150
+        kind = rng.choice(["csv", "py", "txt"])
+        if kind == "csv":
+            lines = ["id,x,y,label"] + [f"{i},{rng.random():.4f},{rng.randint(0, 999)},class{i % 7}"
+                                        for i in range(rows)]
+        elif kind == "py":
+            lines = [f"def f{i}(x):\n    return x ** {i % 5} + {rng.randint(0, 99)}\n" for i in range(rows)]
+        else:
+            lines = [f"Line {i}: the value of x^{i % 9} at x = {rng.randint(0, 50)} is computed below."
+                     for i in range(rows)]
+        data = "\n".join(lines).encode()
+        file_id = f"document-{number}"
+        self.session.files[file_id] = data
+        return {"file_id": file_id, "file_unique_id": file_id, "file_name": f"data{number}.{kind}",
+                "file_size": len(data), "caption": "What does this file do? Explain the formulas."}
+
+    def _photo(self, number: int) -> dict:
+        data = self.rng.choice(self.photos)
+        file_id = f"photo-{number}"
+        self.session.files[file_id] = data
+        size = {"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 600, "file_size": len(data)}
+        return {"photo": [size], "caption": "Solve this"}
+
+    def update(self, user_id: int, message_id: int, kind: str) -> dict:
+        self.update_ids += 1
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"user{user_id}"},
+        }
+        if kind == "text":
+            message["text"] = self._prompt()
+        elif kind == "photo":
+            message.update(self._photo(self.update_ids))
+        else:
+            document = self._document(self.update_ids)
+            message["caption"] = document.pop("caption")
+            message["document"] = document
+        return {"update_id": self.update_ids, "message": message}
+
+
+async def run(args: argparse.Namespace, openai_url: str) -> dict:
+    os.environ["OPENAI_BASE_URL"] = openai_url
+    os.environ.setdefault("OPENAI_API_KEY", "load-test")
+    os.environ["JOB_WORKERS"] = "0"
+
+    from aiogram import Bot, Dispatcher
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.enums import ParseMode
+    from aiogram.types import Update
+
+    from database.db_manager import init_db, close_connection, get_db_stats
+    from handlers import register_all_handlers
+    from services import conversation
+    from services.formula_cache import init_formula_cache, get_cache_stats
+    from services.ocr_cache import get_ocr_cache_stats
+    from services.ocr_service import init_ocr_service, close_ocr_service, warm_up_ocr_service
+    from services.openai_service import get_gpt_stats
+    from services.render_service import init_renderer, close_renderer, warm_up_renderer, get_render_stats
+    from services.response_cache import init_response_cache, get_response_cache_stats
+    from services.solver_service import init_solver, close_solver, warm_up_solver, get_solver_stats
+    from services.admission import get_admission_stats
+    from services.send_scheduler import init_send_scheduler, close_send_scheduler, get_send_stats, \
+        SendSchedulerMiddleware
+    from utils import metrics
+
+    init_db()
+    init_response_cache()
+    init_renderer()
+    init_formula_cache()
+    init_ocr_service()
+    init_solver()
+    print("Warming up the renderer, the solver and OCR...")
+    try:
+        await warm_up_renderer()
+    except Exception as e:
+        print(f"Renderer warm-up failed, formulas will fail to render: {e}")
+    await warm_up_solver()
+    if args.mix.get("photo"):
+        await warm_up_ocr_service()
+
+    # The first reply to each user's pending message ends its first_reply measurement
+    pending: Dict[int, float] = {}
+
+    def on_reply(chat_id: int) -> None:
+        start = pending.pop(chat_id, None)
+        if start is not None:
+            metrics.observe("first_reply", time.perf_counter() - start)
+
+    session = FakeBotSession(latency=args.api_latency, seed=args.seed, on_reply=on_reply)
+    bot = Bot(token=TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot.session.middleware(metrics.MetricsRequestMiddleware())
+    bot.session.middleware(SendSchedulerMiddleware())
+    init_send_scheduler()
+
+    dp = Dispatcher()
+    dp.update.outer_middleware(metrics.MetricsMiddleware())
+    register_all_handlers(dp)
+
+    traffic = Traffic(session, args.seed, args.large_documents)
+    kinds, weights = zip(*args.mix.items())
+    sent: Dict[str, int] = {kind: 0 for kind in kinds}
+
+    async def user(user_id: int) -> None:
+        rng = random.Random(args.seed * 100003 + user_id)
+        # Spread the users' first messages over the ramp-up
+        await asyncio.sleep(rng.uniform(0, args.ramp_up))
+        for message_id in range(1, args.messages + 1):
+            kind = rng.choices(kinds, weights)[0]
+            sent[kind] += 1
+            update = Update.model_validate(traffic.update(user_id, message_id, kind), context={"bot": bot})
+            start = pending[user_id] = time.perf_counter()
+            await dp.feed_update(bot, update)
+            metrics.observe("e2e", time.perf_counter() - start)
+            pending.pop(user_id, None)
+            if args.think_time:
+                await asyncio.sleep(rng.expovariate(1 / args.think_time))
+
+    samples = metrics.keep_samples()
+    if args.tracemalloc:
+        tracemalloc.start()
+    print(f"Running {args.users} users x {args.messages} messages...")
+    start = time.perf_counter()
+    await asyncio.gather(*(user(FIRST_USER_ID + i) for i in range(args.users)))
+    wall_time = time.perf_counter() - start
+    await asyncio.gather(*conversation.summary_tasks, return_exceptions=True)
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    tracemalloc.stop()
+
+    close_send_scheduler()
+    close_renderer()
+    close_ocr_service()
+    close_solver()
+    await bot.session.close()
+    close_connection()
+
+    messages = sum(sent.values())
+    failed = sum(count for (stage, _), count in metrics.errors.items() if stage == "message")
+    order = {stage: i for i, stage in enumerate(STAGE_ORDER)}
+    memory = peak_rss_mb()
+    if traced_peak is not None:
+        memory["tracemalloc_peak_mb"] = traced_peak / 1024 / 1024
+    return {
+        "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "messages": {"sent": messages, "failed": failed, "by_kind": sent},
+        "wall_time": wall_time,
+        "throughput": messages / wall_time,
+        "stages": {stage: summarize(values)
+                   for stage, values in sorted(samples.items(), key=lambda item: (order.get(item[0], 99), item[0]))},
+        "errors": {f"{stage}/{kind}": count for (stage, kind), count in sorted(metrics.errors.items())},
+        "memory": memory,
+        "bot_api_requests": dict(session.requests),
+        "stats": {
+            "admission": get_admission_stats(),
+            "gpt": get_gpt_stats(),
+            "send_scheduler": get_send_stats(),
+            "response_cache": get_response_cache_stats(),
+            "formula_cache": get_cache_stats(),
+            "renderer": get_render_stats(),
+            "solver": get_solver_stats(),
+            "ocr_cache": get_ocr_cache_stats(),
+            "context": conversation.get_context_stats(),
+            "database": get_db_stats(),
+        },
+    }
+
+
+def print_report(result: dict) -> None:
+    messages = result["messages"]
+    print(f"\n{messages['sent']} messages ({', '.join(f'{n} {kind}' for kind, n in messages['by_kind'].items())}), "
+          f"{messages['failed']} failed, in {result['wall_time']:.1f}s: {result['throughput']:.2f} messages/s")
+    print(f"\n{'stage':<16} {'count':>7} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for stage, s in result["stages"].items():
+        print(f"{stage:<16} {s['count']:>7} {s['mean'] * 1000:>9.1f} {s['p50'] * 1000:>9.1f} "
+              f"{s['p95'] * 1000:>9.1f} {s['p99'] * 1000:>9.1f} {s['max'] * 1000:>9.1f}")
+    if result["errors"]:
+        print("\nErrors: " + ", ".join(f"{key} {count}" for key, count in result["errors"].items()))
+    print("Memory: " + ", ".join(f"{key} {value:.1f}" for key, value in result["memory"].items()))
+
+
+def print_comparison(result: dict, earlier: dict) -> None:
+    def change(new: float, old: float) -> str:
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    print(f"\nCompared to {earlier.get('commit')} ({earlier.get('started_at')}):")
+    print(f"throughput {earlier['throughput']:.2f} -> {result['throughput']:.2f} messages/s "
+          f"({change(result['throughput'], earlier['throughput'])})")
+    print(f"{'stage':<16} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for stage, s in result["stages"].items():
+        old = earlier["stages"].get(stage)
+        if old:
+            print(f"{stage:<16} " + " ".join(f"{change(s[q], old[q]):>9}" for q in ("p50", "p95", "p99")))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="concurrent users")
+    parser.add_argument("--messages", type=int, default=5, help="messages each user sends")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("text=6,photo=2,document=2"),
+                        help="relative shares of message kinds")
+    parser.add_argument("--large-documents", type=float, default=0.2,
+                        help="share of documents large enough to be condensed")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean seconds between a user's messages")
+    parser.add_argument("--ramp-up", type=float, default=1.0, help="seconds over which users start")
+    parser.add_argument("--gpt-first-token", type=float, default=0.5, help="seconds until the first token")
+    parser.add_argument("--gpt-token-interval", type=float, default=0.01, help="seconds between streamed tokens")
+    parser.add_argument("--gpt-formulas", type=int, default=3, help="display formulas per answer")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds per Bot API request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also trace Python allocations, slows the run down")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="JSON file for the results, by default in benchmarks/results")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()), stream=sys.stdout,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    output = os.path.abspath(args.output or os.path.join(
+        RESULTS_DIR, f"load_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"))
+    earlier = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            earlier = json.load(f)
+
+    server = FakeOpenAI(first_token=args.gpt_first_token, token_interval=args.gpt_token_interval,
+                        formulas=args.gpt_formulas, seed=args.seed)
+    openai_url = server.start()
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="load_test_") as tmp:
+        # Database, caches and archives are created relative to the working directory
+        os.chdir(tmp)
+        try:
+            result = asyncio.run(run(args, openai_url))
+        finally:
+            os.chdir(workdir)
+            server.stop()
+
+    print_report(result)
+    if earlier:
+        print_comparison(result, earlier)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, default=str)
+    print(f"\nResults saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,25 +8,161 @@ load_dotenv()
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# Update ingress: "polling" or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base URL, the webhook is not registered when empty
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "127.0.0.1")  # behind a local reverse proxy
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+
 # Database configuration
 DB_FILE = "database.db"
+DB_WRITE_QUEUE_SIZE = 10000  # pending writes before handlers have to wait
+DB_BATCH_SIZE = 200  # writes per transaction
+DB_BATCH_WAIT = 0.05  # seconds to wait for more writes before committing
+ARCHIVE_DIR = "archive"
+RETENTION_DAYS = 180  # messages older than this are moved to the archive
+RETENTION_INTERVAL = 24 * 60 * 60  # seconds between retention runs
+ARCHIVE_BATCH_SIZE = 2000  # messages moved to the archive per transaction
+ARCHIVE_BATCH_PAUSE = 0.05  # seconds between archive transactions, the bot's writes go in between
+EXPORT_FETCH_SIZE = 1000  # rows fetched per page when exporting
+
+# Job queue
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # worker processes, 0 processes messages in the bot process
+JOB_CONCURRENCY = 8  # jobs one worker processes at once
+JOB_VISIBILITY_TIMEOUT = 60  # seconds before a job of an unresponsive worker is handed out again
+JOB_POLL_INTERVAL = 0.2  # seconds between polls of an empty queue
+JOB_MAX_ATTEMPTS = 3  # deliveries before a job is dropped
 
 # File handling
 MAX_FILE_SIZE = 5  # MB
 ALLOWED_EXTENSIONS = ['cpp', 'py', 'txt', 'csv']
+DOC_MAX_TOKENS = 6000  # larger documents are condensed part by part before answering
+DOC_CHUNK_TOKENS = 3000  # tokens per part of a large document
+DOC_MAP_CONCURRENCY = 4  # parts of one document condensed at once
+DOC_CSV_SAMPLE_ROWS = 20  # rows of a CSV file shown to the model
+DOC_MAP_PROMPT = """You are given part {part} of {parts} of the file {file_name}.
+Extract everything in this part that is needed to answer the request below, keep code, numbers and formulas exact.
+Request: {request}"""
+
+# Admission control
+ADMISSION_LIMITS = {  # messages of each content type processed or waiting in the job queue at once
+    "text": 64,
+    "photo": 8,
+    "document": 8,
+}
+ADMISSION_PER_USER = 1  # messages of one user processed or waiting at once
+DRAIN_TIMEOUT = 30  # seconds to finish messages in progress on shutdown
+
+# Bot API flood limits
+SEND_GLOBAL_RATE = 30  # messages per second across all chats
+# Per-chat limits are kept by each process. A private chat is answered by one worker at a time,
+# since each user has one message in flight; sends of several workers to one group chat can exceed
+# them, and the RetryAfter the Bot API answers with then throttles that chat in the worker it hits.
+SEND_CHAT_RATE = 1  # messages per second in one chat
+SEND_CHAT_BURST = 3  # messages a chat may receive at once before being throttled
+SEND_BUCKET_SWEEP_INTERVAL = 60  # seconds between evictions of the buckets of idle chats
+SEND_MAX_RETRIES = 3  # retries after a RetryAfter error
 
 # Logging
 LOG_LEVEL = "INFO"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" records or "text" lines
+LOG_QUEUE_SIZE = 10000  # records waiting for the writer thread, more are dropped
+LOG_SAMPLE_RATES = {  # share of requests whose info records of these loggers are kept
+    "stages": 0.1,
+}
+
+# Metrics
+METRICS_ENABLED = True  # serve Prometheus metrics on /metrics
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9101  # port of the bot process, worker N listens on METRICS_PORT + N + 1
 
 # LaTeX rendering
 MATPLOTLIB_CONFIG = {
     'text.usetex': True,
     'font.family': 'serif',
-    'text.latex.preamble': r'\usepackage{amsmath}'
+    'text.latex.preamble': r'\usepackage{amsmath}',
+    'mathtext.fontset': 'cm',  # Computer Modern, like LaTeX
 }
+RENDER_FONTSIZE = 20  # pt
+RENDER_MAX_DPI = 200  # short formulas
+RENDER_MIN_DPI = 100  # long formulas are allowed to get wider than RENDER_MAX_WIDTH below this
+RENDER_MAX_WIDTH = 1280  # px, Telegram scales wider photos down
+RENDER_PADDING = 4  # pt of white space around a formula
+RENDER_POOL_SIZE = 2  # worker processes
+RENDER_QUEUE_SIZE = 32  # renders allowed to wait for a free worker
+RENDER_TIMEOUT = 10  # seconds
+FORMULA_CACHE_DIR = "formula_cache"
+FORMULA_CACHE_MEMORY_ITEMS = 256
+FORMULA_CACHE_DISK_SIZE = 100 * 1024 * 1024  # bytes
+
+# LaTeX OCR
+OCR_WORKERS = 1  # processes, each holding its own model
+OCR_MAX_BATCH_SIZE = 8
+OCR_MAX_BATCH_WAIT = 0.05  # seconds to wait for more images before running a batch
+OCR_TIMEOUT = 60  # seconds
+OCR_WARMUP_TIMEOUT = 300  # seconds a request may wait for the models to load
+OCR_MIN_PHOTO_SIDE = 800  # px, the smallest photo size at least this large is downloaded
+OCR_MAX_REGION_SIDE = 1024  # px, larger regions are scaled down
+OCR_MIN_REGION_HEIGHT = 32  # px, smaller regions are scaled up
+OCR_REGION_MARGIN = 8  # px of white border around a region
+OCR_SPLIT_MIN_GAP = 0.5  # blank rows separating two equations, relative to their line height
+OCR_MAX_REGIONS = 8  # photos with more regions are recognized whole
+OCR_CACHE_MAX_ROWS = 20000  # recognized photos kept in the database
+# Reusing the result of a similar-looking photo. Off: one-symbol edits of a formula hash as close
+# as re-compressed copies of one photo, see benchmarks/bench_ocr_cache.py. Only after the benchmark
+# shows no false positives on distinct formulas at OCR_CACHE_MAX_DISTANCE may it be turned on.
+OCR_CACHE_HASH_LOOKUP = False
+OCR_CACHE_MAX_DISTANCE = 4  # bits in which perceptual hashes of the same photo may differ, out of 2048
+
+# Local SymPy solver, answers plain math prompts without GPT
+SOLVER_ENABLED = True
+SOLVER_WORKERS = 1  # processes, prompts arriving while all are busy go to GPT
+SOLVER_TIMEOUT = 1.0  # seconds a prompt may spend in the solver before it goes to GPT
+SOLVER_MAX_PROMPT_LENGTH = 300  # characters, longer prompts go straight to GPT
+SOLVER_MEMORY_LIMIT = 1024  # MB of address space per worker process
 
 # OpenAI configuration
 OPENAI_MODEL = "gpt-4"
+OPENAI_MAX_CONCURRENCY = 16  # requests in flight across all users
+OPENAI_MAX_CONCURRENCY_PER_USER = 1  # requests in flight for one user
+OPENAI_DEADLINE = 120  # seconds for a request including retries and escalation to other tiers
+OPENAI_MAX_RETRIES = 4
+OPENAI_BACKOFF_BASE = 0.5  # seconds, doubled with every retry
+OPENAI_BACKOFF_MAX = 20  # seconds
+OPENAI_BREAKER_THRESHOLD = 5  # consecutive failures of a tier that open its circuit breaker
+OPENAI_BREAKER_COOLDOWN = 30  # seconds requests are rejected once the breaker is open
+# Models a prompt may be answered by, fastest first: (name, model, seconds for one attempt including retries).
+# A tier that fails, times out or has its breaker open passes the prompt on to the next one, within
+# what is left of OPENAI_DEADLINE.
+OPENAI_MODEL_TIERS = [
+    ("fast", "gpt-4o-mini", 30),
+    ("standard", "gpt-4o", 60),
+    ("strong", OPENAI_MODEL, OPENAI_DEADLINE),
+]
+ROUTING_ENABLED = True  # False starts every prompt at the last tier
+ROUTING_FAST_MAX_TOKENS = 150  # short text prompts without formulas or code blocks start at the first tier
+ROUTING_FAST_MAX_CONTEXT_TOKENS = 1000  # follow-ups with more context than this start at the second tier or later
+ROUTING_STRONG_MIN_TOKENS = 1500  # longer prompts start at the last tier, the context is not counted
+ROUTING_STRONG_MIN_MATH = 0.3  # share of the prompt in formulas from which it starts at the last tier
+STREAM_RESPONSES = True  # send the response while it is being generated
+STREAM_EDIT_INTERVAL = 1.0  # seconds between edits of the live preview message
+
+# Response cache
+RESPONSE_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+RESPONSE_CACHE_MAX_ROWS = 10000
+RESPONSE_CACHE_MEMORY_ITEMS = 512
+# Conversation context
+CONTEXT_ENABLED = True  # send earlier turns of the chat along with the prompt
+CONTEXT_TOKEN_BUDGET = 2000  # tokens of history sent with a prompt
+CONTEXT_MAX_TURNS = 20  # turns kept per chat
+CONTEXT_CACHE_CHATS = 1000  # chats whose history is kept in memory
+CONTEXT_SUMMARY_MAX_TOKENS = 300
+CONTEXT_SUMMARY_PROMPT = """Summarize the conversation between a user and an assistant below in a few sentences.
+Keep the problems the user is working on, definitions, notation and results that later questions may refer to.
+Start from the previous summary if there is one."""
+
 SYSTEM_PROMPT = """You are universal assistant with a focus in advanced math and programming. 
 When you're asked to solve some problems requiring LaTeX notation you must use $ and $$ delimiters for it.
 Don't ask about if user wants to do with your response (like extend, continue solving etc., 
@@ -1,67 +1,417 @@
+import asyncio
+import queue
 import sqlite3
 import logging
-from typing import Optional
-from config import DB_FILE
-from database.models import Message, Error, CREATE_MESSAGES_TABLE, CREATE_ERRORS_TABLE
+import threading
+import time
+from typing import List, Optional, Set, Tuple
+from config import DB_FILE, DB_WRITE_QUEUE_SIZE, DB_BATCH_SIZE, DB_BATCH_WAIT
+from database.models import Message, Error, MIGRATIONS
+from utils.metrics import observe, timed
 
-# Global connection and cursor
+# Global connection and cursor, used for reads on the event loop
 conn = None
 cursor = None
+# Connection for reads too slow for the event loop, run in worker threads one at a time
+thread_conn: Optional[sqlite3.Connection] = None
+thread_lock = threading.Lock()
 logger = logging.getLogger(__name__)
 
+# Pending writes as (sql, params), applied by the writer thread
+write_queue: "queue.Queue" = queue.Queue(maxsize=DB_WRITE_QUEUE_SIZE)
+writer_thread: Optional[threading.Thread] = None
+_STOP = object()
+# Marks a flush request in the write queue, its params are called once the writes before it are committed
+_FLUSH = object()
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA busy_timeout = 5000",
+)
+
+stats = {
+    "enqueued": 0,
+    "enqueue_time": 0.0,
+    "max_enqueue_time": 0.0,
+    "backpressure_waits": 0,
+    "batches": 0,
+    "written": 0,
+    "max_batch_size": 0,
+    "commit_time": 0.0,
+    "max_commit_time": 0.0,
+    "failed": 0,
+}
+
+
+def _connect() -> sqlite3.Connection:
+    """Open a connection with the tuned pragmas applied."""
+    connection = sqlite3.connect(DB_FILE, check_same_thread=False)
+    for pragma in PRAGMAS:
+        connection.execute(pragma)
+    return connection
+
+def apply_migrations(connection: sqlite3.Connection) -> None:
+    """Bring the schema up to date, applying each pending migration in its own transaction."""
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    for target, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        try:
+            connection.execute("BEGIN")
+            for statement in statements:
+                connection.execute(statement)
+            connection.execute(f"PRAGMA user_version = {target}")
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        logger.info(f"Database migrated to version {target}")
+
 def init_db() -> None:
-    """Initialize database connection and create tables if they don't exist."""
-    global conn, cursor
+    """Initialize database connection, migrate the schema and start the writer."""
+    global conn, cursor, thread_conn, writer_thread
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
-        cursor.execute(CREATE_MESSAGES_TABLE)
-        cursor.execute(CREATE_ERRORS_TABLE)
-        conn.commit()
+        apply_migrations(conn)
+        thread_conn = _connect()
+
+        writer_thread = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+        writer_thread.start()
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"Database initialization error: {e}")
         raise
 
 def close_connection() -> None:
-    """Close the database connection."""
+    """Flush pending writes and close the database connection."""
+    global writer_thread
+    if writer_thread:
+        if write_queue.qsize():
+            logger.info(f"Flushing {write_queue.qsize()} pending writes")
+        write_queue.put(_STOP)
+        writer_thread.join()
+        writer_thread = None
+    if thread_conn:
+        with thread_lock:
+            thread_conn.close()
     if conn:
         conn.commit()
         conn.close()
         logger.info("Database connection closed")
 
-def save_message(message: Message) -> None:
+def _writer_loop() -> None:
+    """Apply queued writes in transactions grouped by size or time."""
+    writer = _connect()
+    writer_cursor = writer.cursor()
+    stopping = False
+
+    while not stopping:
+        item = write_queue.get()
+        if item is _STOP:
+            break
+        batch = [item]
+        deadline = time.monotonic() + DB_BATCH_WAIT
+        # Someone waiting for a flush doesn't wait for more writes to arrive
+        while len(batch) < DB_BATCH_SIZE and batch[-1][0] is not _FLUSH:
+            remaining = deadline - time.monotonic()
+            try:
+                item = write_queue.get(timeout=remaining) if remaining > 0 else write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+
+        start = time.perf_counter()
+        flushes = [params for sql, params in batch if sql is _FLUSH]
+        batch = [(sql, params) for sql, params in batch if sql is not _FLUSH]
+        error = None
+        for sql, params in batch:
+            try:
+                writer_cursor.execute(sql, params)
+            except Exception as e:
+                stats["failed"] += 1
+                logger.error(f"Error applying database write: {e}")
+                error = error or e
+        try:
+            writer.commit()
+        except Exception as e:
+            stats["failed"] += len(batch)
+            logger.error(f"Error committing database writes: {e}")
+            writer.rollback()
+            error = e
+        for notify in flushes:
+            notify(error)
+        commit_time = time.perf_counter() - start
+        observe("db_write", commit_time)
+
+        stats["batches"] += 1
+        stats["written"] += len(batch)
+        stats["max_batch_size"] = max(stats["max_batch_size"], len(batch))
+        stats["commit_time"] += commit_time
+        stats["max_commit_time"] = max(stats["max_commit_time"], commit_time)
+
+    writer.close()
+    logger.info("Database writer stopped")
+
+async def _enqueue(sql: str, params: tuple) -> None:
+    """Queue a write for the writer thread, waiting while the queue is full."""
+    start = time.perf_counter()
+    try:
+        write_queue.put_nowait((sql, params))
+    except queue.Full:
+        stats["backpressure_waits"] += 1
+        await asyncio.to_thread(write_queue.put, (sql, params))
+    elapsed = time.perf_counter() - start
+    observe("db_enqueue", elapsed)
+    stats["enqueued"] += 1
+    stats["enqueue_time"] += elapsed
+    stats["max_enqueue_time"] = max(stats["max_enqueue_time"], elapsed)
+
+async def flush_writes() -> None:
+    """
+    Wait until the writes queued so far are committed.
+
+    Raises:
+        RuntimeError: If a write of the batches waited for failed
+    """
+    if writer_thread is None:
+        return
+    loop = asyncio.get_running_loop()
+    committed = loop.create_future()
+
+    def resolve(error: Optional[Exception]) -> None:
+        if committed.done():
+            return
+        if error is None:
+            committed.set_result(None)
+        else:
+            committed.set_exception(RuntimeError(f"Database writes were not committed: {error}"))
+
+    def notify(error: Optional[Exception]) -> None:
+        # Runs in the writer thread
+        try:
+            loop.call_soon_threadsafe(resolve, error)
+        except RuntimeError:
+            # The waiting loop is already closed
+            pass
+
+    item = (_FLUSH, notify)
+    try:
+        write_queue.put_nowait(item)
+    except queue.Full:
+        await asyncio.to_thread(write_queue.put, item)
+    await committed
+
+def _touch(sql: str, params: tuple) -> None:
+    """Queue a recency update, skipped rather than waited for when the queue is full."""
+    # Recency only drives eviction, losing an update is harmless
+    try:
+        write_queue.put_nowait((sql, params))
+    except queue.Full:
+        pass
+
+def get_db_stats() -> dict:
+    """Return enqueue latency, batch size and commit time statistics of the writer."""
+    batches = stats["batches"]
+    return {
+        **stats,
+        "queue_depth": write_queue.qsize(),
+        "avg_enqueue_time": stats["enqueue_time"] / stats["enqueued"] if stats["enqueued"] else 0.0,
+        "avg_batch_size": stats["written"] / batches if batches else 0.0,
+        "avg_commit_time": stats["commit_time"] / batches if batches else 0.0,
+    }
+
+async def save_message(message: Message) -> None:
     """Save a message to the database."""
+    await _enqueue(
+        "INSERT INTO messages (chat_id, msg_tg_id, username, user_id, date, prompt, response) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (message.chat_id, message.msg_tg_id, message.username, message.user_id, message.date,
+         message.prompt, message.response)
+    )
+
+async def update_message_response(chat_id: int, msg_tg_id: int, response: str) -> None:
+    """Update the response field for a message."""
+    await _enqueue(
+        "UPDATE messages SET response = ? WHERE chat_id = ? AND msg_tg_id = ?",
+        (response, chat_id, msg_tg_id)
+    )
+
+async def save_error(error: Error) -> None:
+    """Save an error to the database."""
+    await _enqueue(
+        "INSERT INTO errors (chat_id, msg_tg_id, error_text) VALUES (?, ?, ?)",
+        (error.chat_id, error.msg_tg_id, error.error_text)
+    )
+
+
+def get_cached_response(key: str, min_created_at: int) -> Optional[Tuple[str, int]]:
+    """Return a cached response newer than min_created_at with its creation time and mark it as recently used."""
     try:
-        cursor.execute(
-            "INSERT INTO messages (msg_tg_id, username, user_id, date, prompt, response) VALUES (?, ?, ?, ?, ?, ?)",
-            (message.msg_tg_id, message.username, message.user_id, message.date, message.prompt, message.response)
-        )
-        conn.commit()
+        with timed("db_read"):
+            row = cursor.execute(
+                "SELECT response, created_at FROM response_cache WHERE key = ? AND created_at >= ?",
+                (key, min_created_at)
+            ).fetchone()
     except Exception as e:
-        logger.error(f"Error saving message: {e}")
-        conn.rollback()
+        logger.error(f"Error reading cached response: {e}")
+        return None
+    if row is None:
+        return None
+    _touch("UPDATE response_cache SET last_used = ? WHERE key = ?", (int(time.time()), key))
+    return row[0], row[1]
 
-def update_message_response(msg_tg_id: int, response: str) -> None:
-    """Update the response field for a message."""
+
+async def save_cached_response(key: str, response: str, max_rows: int) -> None:
+    """Store a response in the cache, evicting least recently used rows above max_rows."""
+    now = int(time.time())
+    await _enqueue(
+        "INSERT OR REPLACE INTO response_cache (key, response, created_at, last_used) VALUES (?, ?, ?, ?)",
+        (key, response, now, now)
+    )
+    await _enqueue(
+        "DELETE FROM response_cache WHERE key IN "
+        "(SELECT key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+        (max_rows,)
+    )
+
+
+def get_cache_opt_outs() -> Set[int]:
+    """Return ids of users who disabled response caching."""
     try:
-        cursor.execute(
-            "UPDATE messages SET response = ? WHERE msg_tg_id = ?",
-            (response, msg_tg_id)
-        )
-        conn.commit()
+        return {row[0] for row in cursor.execute("SELECT user_id FROM cache_opt_out")}
     except Exception as e:
-        logger.error(f"Error updating message response: {e}")
-        conn.rollback()
+        logger.error(f"Error reading cache opt-outs: {e}")
+        return set()
 
-def save_error(error: Error) -> None:
-    """Save an error to the database."""
+
+async def set_cache_opt_out(user_id: int, opt_out: bool) -> None:
+    """Enable or disable response caching for a user."""
+    if opt_out:
+        await _enqueue("INSERT OR IGNORE INTO cache_opt_out (user_id) VALUES (?)", (user_id,))
+    else:
+        await _enqueue("DELETE FROM cache_opt_out WHERE user_id = ?", (user_id,))
+
+
+def get_chat_context(chat_id: int) -> Tuple[str, int, int]:
+    """Return the summary, the last summarized message id and the last answered message id of a chat."""
     try:
-        cursor.execute(
-            "INSERT INTO errors (msg_tg_id, error_text) VALUES (?, ?)",
-            (error.msg_tg_id, error.error_text)
-        )
-        conn.commit()
+        with timed("db_read"):
+            row = cursor.execute(
+                "SELECT summary, summarized_through, last_turn FROM chat_context WHERE chat_id = ?",
+                (chat_id,)
+            ).fetchone()
+    except Exception as e:
+        logger.error(f"Error reading chat context: {e}")
+        return "", 0, 0
+    return row if row is not None else ("", 0, 0)
+
+
+def get_recent_turns(chat_id: int, after: int, before: int, limit: int) -> List[Tuple[int, str, str]]:
+    """Return up to limit answered messages of a chat between two message ids, newest first."""
+    try:
+        with timed("db_read"):
+            return cursor.execute(
+                "SELECT msg_tg_id, prompt, response FROM messages "
+                "WHERE chat_id = ? AND msg_tg_id > ? AND msg_tg_id < ? AND response != '' "
+                "ORDER BY msg_tg_id DESC LIMIT ?",
+                (chat_id, after, before, limit)
+            ).fetchall()
     except Exception as e:
-        logger.error(f"Error saving error record: {e}")
-        conn.rollback()
\ No newline at end of file
+        logger.error(f"Error reading recent turns: {e}")
+        return []
+
+
+async def save_last_turn(chat_id: int, msg_tg_id: int) -> None:
+    """Record the latest answered message of a chat."""
+    await _enqueue(
+        "INSERT INTO chat_context (chat_id, last_turn) VALUES (?, ?) "
+        "ON CONFLICT (chat_id) DO UPDATE SET last_turn = MAX(last_turn, excluded.last_turn)",
+        (chat_id, msg_tg_id)
+    )
+
+
+async def save_chat_summary(chat_id: int, summary: str, summarized_through: int) -> None:
+    """Store the summary of a chat's messages up to summarized_through."""
+    await _enqueue(
+        "INSERT INTO chat_context (chat_id, summary, summarized_through) VALUES (?, ?, ?) "
+        "ON CONFLICT (chat_id) DO UPDATE SET summary = excluded.summary, "
+        "summarized_through = excluded.summarized_through "
+        "WHERE excluded.summarized_through > summarized_through",
+        (chat_id, summary, summarized_through)
+    )
+
+
+async def reset_chat_context(chat_id: int, msg_tg_id: int) -> None:
+    """Forget a chat's context before the given message."""
+    await _enqueue(
+        "INSERT INTO chat_context (chat_id, summary, summarized_through) VALUES (?, '', ?) "
+        "ON CONFLICT (chat_id) DO UPDATE SET summary = '', summarized_through = excluded.summarized_through",
+        (chat_id, msg_tg_id)
+    )
+
+
+def get_ocr_by_file(file_unique_id: str) -> Optional[str]:
+    """Return the OCR result of a Telegram file and mark it as recently used."""
+    try:
+        with timed("db_read"):
+            row = cursor.execute(
+                "SELECT result FROM ocr_cache WHERE file_unique_id = ?", (file_unique_id,)
+            ).fetchone()
+    except Exception as e:
+        logger.error(f"Error reading OCR cache: {e}")
+        return None
+    if row is None:
+        return None
+    _touch("UPDATE ocr_cache SET last_used = ? WHERE file_unique_id = ?", (int(time.time()), file_unique_id))
+    return row[0]
+
+
+def get_ocr_hashes(after_rowid: int, length: int) -> List[Tuple[int, str, str]]:
+    """
+    Return the rowid, file id and perceptual hash of OCR results stored after a rowid.
+
+    Only hashes of the given length are returned, rows stored without a hash or
+    with the hash of an older version are left out. Blocking, call it from a
+    worker thread.
+    """
+    with timed("db_read"), thread_lock:
+        return thread_conn.execute(
+            "SELECT rowid, file_unique_id, phash FROM ocr_cache WHERE rowid > ? AND length(phash) = ? ORDER BY rowid",
+            (after_rowid, length)
+        ).fetchall()
+
+
+def get_ocr_by_hash(file_unique_id: str, phash: str) -> Optional[str]:
+    """
+    Return the OCR result of a file if it is still stored with that hash, and mark it as recently used.
+
+    Blocking, call it from a worker thread.
+    """
+    with timed("db_read"), thread_lock:
+        row = thread_conn.execute(
+            "SELECT result FROM ocr_cache WHERE file_unique_id = ? AND phash = ?", (file_unique_id, phash)
+        ).fetchone()
+    if row is None:
+        return None
+    _touch("UPDATE ocr_cache SET last_used = ? WHERE file_unique_id = ?", (int(time.time()), file_unique_id))
+    return row[0]
+
+
+async def save_ocr_result(file_unique_id: str, phash: Optional[str], result: str, max_rows: int) -> None:
+    """Store an OCR result, evicting least recently used rows above max_rows."""
+    await _enqueue(
+        "INSERT OR REPLACE INTO ocr_cache (file_unique_id, phash, result, last_used) VALUES (?, ?, ?, ?)",
+        (file_unique_id, phash, result, int(time.time()))
+    )
+    await _enqueue(
+        "DELETE FROM ocr_cache WHERE file_unique_id IN "
+        "(SELECT file_unique_id FROM ocr_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+        (max_rows,)
+    )
@@ -0,0 +1,241 @@
+import asyncio
+import contextvars
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from config import DB_FILE, JOB_VISIBILITY_TIMEOUT
+from database.db_manager import PRAGMAS, flush_writes
+from database.models import Job
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Connection of this process, queue operations are written through right away
+# rather than batched, so a job survives a crash once enqueue_job returns
+conn: Optional[sqlite3.Connection] = None
+lock = threading.Lock()
+
+# Job processed by the current task, None when messages are handled in the bot process
+current_job: contextvars.ContextVar[Optional[Job]] = contextvars.ContextVar("current_job", default=None)
+
+stats = {
+    "enqueued": 0,
+    "duplicates": 0,
+    "claimed": 0,
+    "resumed": 0,
+    "acked": 0,
+    "released": 0,
+    "dropped": 0,
+    "checkpoints": 0,
+}
+
+
+def init_job_queue() -> None:
+    """Open the job queue connection, the schema must already be migrated by init_db."""
+    global conn
+    # Autocommit, transactions are started explicitly where several statements must be atomic
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    logger.info("Job queue initialized")
+
+
+def close_job_queue() -> None:
+    """Close the job queue connection."""
+    global conn
+    if conn:
+        conn.close()
+        conn = None
+        logger.info("Job queue closed")
+
+
+def _execute(sql: str, params: tuple) -> int:
+    with lock:
+        return conn.execute(sql, params).rowcount
+
+
+def _insert(chat_id: int, msg_tg_id: int, payload: str, kind: str, user_id: Optional[int]) -> bool:
+    now = time.time()
+    return _execute(
+        "INSERT OR IGNORE INTO jobs (chat_id, msg_tg_id, payload, kind, user_id, checkpoint, visible_at, created_at) "
+        "VALUES (?, ?, ?, ?, ?, '{}', ?, ?)",
+        (chat_id, msg_tg_id, payload, kind, user_id, now, int(now))
+    ) > 0
+
+
+def _claim() -> Optional[Job]:
+    now = time.time()
+    with lock:
+        # IMMEDIATE takes the write lock up front, so two workers can't claim the same job
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, chat_id, msg_tg_id, payload, stage, checkpoint, attempts FROM jobs "
+                "WHERE visible_at <= ? ORDER BY id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET visible_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    (now + JOB_VISIBILITY_TIMEOUT, row[0])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    if row is None:
+        return None
+    job_id, chat_id, msg_tg_id, payload, stage, checkpoint, attempts = row
+    return Job(
+        id=job_id,
+        chat_id=chat_id,
+        msg_tg_id=msg_tg_id,
+        payload=payload,
+        stage=stage,
+        checkpoint=json.loads(checkpoint or "{}"),
+        attempts=attempts + 1,
+    )
+
+
+async def enqueue_job(
+    chat_id: int,
+    msg_tg_id: int,
+    payload: str,
+    kind: str = "text",
+    user_id: Optional[int] = None,
+) -> bool:
+    """
+    Persist a job for the workers.
+
+    Args:
+        chat_id: Chat the message came from
+        msg_tg_id: Telegram id of the message
+        payload: The message serialized as JSON
+        kind: Content type of the message: "text", "photo" or "document"
+        user_id: Telegram id of the sender
+
+    Returns:
+        False if the message was already queued, e.g. after a redelivered update
+    """
+    inserted = await asyncio.to_thread(_insert, chat_id, msg_tg_id, payload, kind, user_id)
+    stats["enqueued" if inserted else "duplicates"] += 1
+    return inserted
+
+
+async def claim_job() -> Optional[Job]:
+    """
+    Take the oldest visible job and hide it from other workers for JOB_VISIBILITY_TIMEOUT.
+
+    Returns:
+        The job, or None when the queue is empty
+    """
+    job = await asyncio.to_thread(_claim)
+    if job is not None:
+        stats["claimed"] += 1
+        if job.stage is not None:
+            stats["resumed"] += 1
+    return job
+
+
+async def extend_job(job_id: int) -> None:
+    """Keep a job hidden from other workers while it is still being processed."""
+    await asyncio.to_thread(
+        _execute, "UPDATE jobs SET visible_at = ? WHERE id = ?", (time.time() + JOB_VISIBILITY_TIMEOUT, job_id)
+    )
+
+
+async def ack_job(job_id: int) -> None:
+    """Remove a finished job from the queue."""
+    await asyncio.to_thread(_execute, "DELETE FROM jobs WHERE id = ?", (job_id,))
+    stats["acked"] += 1
+
+
+async def drop_job(job_id: int) -> None:
+    """Remove a job that failed too many times."""
+    await asyncio.to_thread(_execute, "DELETE FROM jobs WHERE id = ?", (job_id,))
+    stats["dropped"] += 1
+
+
+async def release_job(job_id: int) -> None:
+    """Make an unfinished job visible again right away, e.g. when a worker shuts down."""
+    await asyncio.to_thread(
+        _execute, "UPDATE jobs SET visible_at = ?, attempts = attempts - 1 WHERE id = ?", (time.time(), job_id)
+    )
+    stats["released"] += 1
+
+
+async def run_stage(name: str, produce: Callable[[], Awaitable[T]]) -> T:
+    """
+    Run a processing stage once per job, checkpointing its result.
+
+    When the current job already completed the stage before a crash, the stored
+    result is returned instead of running it again. The checkpoint is only
+    written once the database writes the stage queued are committed, so a
+    skipped stage never leaves its writes lost. Outside of a job the stage
+    simply runs.
+
+    Args:
+        name: Stage name, unique within a job
+        produce: Coroutine factory running the stage, its result must be JSON serializable
+
+    Returns:
+        The stage's result
+    """
+    job = current_job.get()
+    if job is None:
+        return await produce()
+    if name in job.checkpoint:
+        return job.checkpoint[name]
+
+    result = await produce()
+    await flush_writes()
+    job.checkpoint[name] = result
+    job.stage = name
+    await asyncio.to_thread(
+        _execute,
+        "UPDATE jobs SET stage = ?, checkpoint = ? WHERE id = ?",
+        (name, json.dumps(job.checkpoint, ensure_ascii=False), job.id)
+    )
+    stats["checkpoints"] += 1
+    return result
+
+
+def count_jobs() -> int:
+    """Return the number of queued and running jobs."""
+    with lock:
+        return conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+
+def _count_unfinished(user_id: int) -> Tuple[Dict[str, int], int]:
+    with lock:
+        rows = conn.execute(
+            "SELECT kind, COUNT(*), SUM(user_id = ?) FROM jobs GROUP BY kind", (user_id,)
+        ).fetchall()
+    # Jobs queued before kinds were recorded count as text
+    kinds: Dict[str, int] = {}
+    for kind, count, _ in rows:
+        kinds[kind or "text"] = kinds.get(kind or "text", 0) + count
+    return kinds, sum(of_user or 0 for _, _, of_user in rows)
+
+
+async def count_unfinished_jobs(user_id: int) -> Tuple[Dict[str, int], int]:
+    """
+    Count queued and running jobs, for admission control.
+
+    Args:
+        user_id: User whose jobs are counted separately
+
+    Returns:
+        Jobs per kind and jobs of the user
+    """
+    return await asyncio.to_thread(_count_unfinished, user_id)
+
+
+def get_job_stats() -> dict:
+    """Return queue counters of this process."""
+    return dict(stats)
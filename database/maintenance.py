@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Optional, TextIO, Tuple
+
+from config import (
+    DB_FILE,
+    ARCHIVE_DIR,
+    ARCHIVE_BATCH_SIZE,
+    ARCHIVE_BATCH_PAUSE,
+    RETENTION_DAYS,
+    RETENTION_INTERVAL,
+    EXPORT_FETCH_SIZE,
+)
+from database.models import CREATE_MESSAGES_TABLE
+
+logger = logging.getLogger(__name__)
+
+EXPORT_COLUMNS = ("id", "chat_id", "msg_tg_id", "username", "user_id", "date", "prompt", "response")
+
+
+def _archive_path(month: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f"messages-{month}.db")
+
+
+def _month_bounds(timestamp: int) -> Tuple[str, int]:
+    """Return the UTC month a timestamp falls in and the timestamp the next month starts at."""
+    day = datetime.fromtimestamp(timestamp, timezone.utc)
+    next_month = datetime(day.year + day.month // 12, day.month % 12 + 1, 1, tzinfo=timezone.utc)
+    return day.strftime("%Y-%m"), int(next_month.timestamp())
+
+
+def _archive_range(connection: sqlite3.Connection, month: str, start: int, end: int) -> int:
+    """
+    Move the messages dated in [start, end) into the archive database of a month.
+
+    Messages are moved in batches of ARCHIVE_BATCH_SIZE, each in its own short
+    transaction, so the bot's writer never waits for the lock for long.
+
+    Returns:
+        Number of moved messages
+    """
+    connection.execute("ATTACH DATABASE ? AS archive", (_archive_path(month),))
+    moved = 0
+    try:
+        connection.execute(CREATE_MESSAGES_TABLE.replace("messages", "archive.messages", 1))
+        # Uses idx_messages_date, and picks the same rows for both statements of a batch
+        batch = "SELECT rowid FROM messages WHERE date >= ? AND date < ? ORDER BY date LIMIT ?"
+        params = (start, end, ARCHIVE_BATCH_SIZE)
+        while True:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    f"INSERT OR IGNORE INTO archive.messages SELECT * FROM messages WHERE rowid IN ({batch})",
+                    params
+                )
+                count = connection.execute(f"DELETE FROM messages WHERE rowid IN ({batch})", params).rowcount
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            moved += count
+            if count < ARCHIVE_BATCH_SIZE:
+                return moved
+            # Give the bot's writer a chance to take the lock between batches
+            time.sleep(ARCHIVE_BATCH_PAUSE)
+    finally:
+        connection.execute("DETACH DATABASE archive")
+
+
+def archive_old_messages(before: int) -> int:
+    """
+    Move messages older than a timestamp into monthly archive databases.
+
+    Each month goes to its own archive file, so old history stays queryable
+    without growing the live database.
+
+    Args:
+        before: Unix timestamp, messages dated earlier are archived
+
+    Returns:
+        Number of archived messages
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    connection = sqlite3.connect(DB_FILE)
+    connection.execute("PRAGMA busy_timeout = 5000")
+    archived = 0
+    try:
+        while True:
+            oldest = connection.execute("SELECT MIN(date) FROM messages WHERE date < ?", (before,)).fetchone()[0]
+            if oldest is None:
+                break
+            month, next_month = _month_bounds(oldest)
+            archived += _archive_range(connection, month, oldest, min(next_month, before))
+    finally:
+        connection.close()
+
+    if archived:
+        logger.info(f"Archived {archived} messages older than {datetime.fromtimestamp(before, timezone.utc)}")
+    return archived
+
+
+async def run_retention() -> None:
+    """Periodically archive messages older than RETENTION_DAYS."""
+    while True:
+        try:
+            before = int(time.time()) - RETENTION_DAYS * 24 * 60 * 60
+            await asyncio.to_thread(archive_old_messages, before)
+        except Exception as e:
+            logger.error(f"Error archiving old messages: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+
+def export_messages(out: TextIO, fmt: str = "jsonl", since: Optional[int] = None, db_file: str = DB_FILE) -> int:
+    """
+    Stream messages to a file as JSONL or CSV with bounded memory.
+
+    The database is opened read-only and rows are fetched in pages, so the export
+    neither loads the whole table nor blocks the bot's writes.
+
+    Args:
+        out: Text stream to write to
+        fmt: Either "jsonl" or "csv"
+        since: Only export messages dated at or after this Unix timestamp
+        db_file: Database to export from, e.g. an archive database
+
+    Returns:
+        Number of exported messages
+    """
+    if fmt not in ("jsonl", "csv"):
+        raise ValueError(f"Unsupported export format: {fmt}")
+
+    connection = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    exported = 0
+    try:
+        export_cursor = connection.execute(
+            f"SELECT {', '.join(EXPORT_COLUMNS)} FROM messages WHERE date >= ? ORDER BY id",
+            (since or 0,)
+        )
+        writer = csv.writer(out) if fmt == "csv" else None
+        if writer:
+            writer.writerow(EXPORT_COLUMNS)
+
+        while True:
+            rows = export_cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                record = dict(zip(EXPORT_COLUMNS, row))
+                if record["date"] is not None:
+                    record["date"] = datetime.fromtimestamp(record["date"], timezone.utc).isoformat()
+                if writer:
+                    writer.writerow(record.values())
+                else:
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            exported += len(rows)
+    finally:
+        connection.close()
+    return exported
+
+
+def main() -> None:
+    """Command line entry point for archiving and exporting messages."""
+    parser = argparse.ArgumentParser(description="Message history maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    archive_parser = subparsers.add_parser("archive", help="move old messages into archive databases")
+    archive_parser.add_argument("--days", type=int, default=RETENTION_DAYS, help="keep messages newer than this")
+
+    export_parser = subparsers.add_parser("export", help="export messages as JSONL or CSV")
+    export_parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    export_parser.add_argument("--since", type=int, help="Unix timestamp of the oldest message to export")
+    export_parser.add_argument("--db", default=DB_FILE, help="database file, e.g. an archive")
+    export_parser.add_argument("--output", help="output file, stdout by default")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    if args.command == "archive":
+        archive_old_messages(int(time.time()) - args.days * 24 * 60 * 60)
+    else:
+        if args.output:
+            with open(args.output, "w", encoding="utf-8", newline="") as f:
+                count = export_messages(f, args.format, args.since, args.db)
+        else:
+            count = export_messages(sys.stdout, args.format, args.since, args.db)
+        logger.info(f"Exported {count} messages")
+
+
+if __name__ == "__main__":
+    main()
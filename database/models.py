@@ -1,15 +1,16 @@
 import sqlite3
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 @dataclass
 class Message:
     id: Optional[int] = None
+    chat_id: int = 0
     msg_tg_id: int = 0
     username: str = ""
     user_id: int = 0
-    date: str = ""
+    date: int = 0  # Unix timestamp
     prompt: str = ""
     response: str = ""
 
@@ -17,18 +18,31 @@ class Message:
 @dataclass
 class Error:
     id: Optional[int] = None
+    chat_id: int = 0
     msg_tg_id: int = 0
     error_text: str = ""
 
 
-# SQL creation statements
+@dataclass
+class Job:
+    id: Optional[int] = None
+    chat_id: int = 0
+    msg_tg_id: int = 0
+    payload: str = ""  # Telegram message as JSON
+    stage: Optional[str] = None  # last completed stage
+    checkpoint: Dict[str, Any] = field(default_factory=dict)  # stage name -> result
+    attempts: int = 0
+
+
+# SQL creation statements for the current schema
 CREATE_MESSAGES_TABLE = '''
 CREATE TABLE IF NOT EXISTS messages (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER,
     msg_tg_id INTEGER,
     username TEXT,
     user_id INTEGER,
-    date TEXT,
+    date INTEGER,
     prompt TEXT,
     response TEXT
 )
@@ -38,6 +52,150 @@ CREATE_ERRORS_TABLE = '''
 CREATE TABLE IF NOT EXISTS errors (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     msg_tg_id INTEGER,
-    error_text TEXT
+    error_text TEXT,
+    chat_id INTEGER
+)
+'''
+
+CREATE_RESPONSE_CACHE_TABLE = '''
+CREATE TABLE IF NOT EXISTS response_cache (
+    key TEXT PRIMARY KEY,
+    response TEXT,
+    created_at INTEGER,
+    last_used INTEGER
+)
+'''
+
+CREATE_RESPONSE_CACHE_INDEX = '''
+CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used)
+'''
+
+CREATE_CACHE_OPT_OUT_TABLE = '''
+CREATE TABLE IF NOT EXISTS cache_opt_out (
+    user_id INTEGER PRIMARY KEY
+)
+'''
+
+CREATE_JOBS_TABLE = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER,
+    msg_tg_id INTEGER,
+    payload TEXT,
+    stage TEXT,
+    checkpoint TEXT,
+    attempts INTEGER DEFAULT 0,
+    visible_at REAL,
+    created_at INTEGER,
+    UNIQUE (chat_id, msg_tg_id)
+)
+'''
+
+CREATE_JOBS_INDEX = '''
+CREATE INDEX IF NOT EXISTS idx_jobs_visible_at ON jobs (visible_at)
+'''
+
+CREATE_CHAT_CONTEXT_TABLE = '''
+CREATE TABLE IF NOT EXISTS chat_context (
+    chat_id INTEGER PRIMARY KEY,
+    summary TEXT DEFAULT '',
+    summarized_through INTEGER DEFAULT 0,
+    last_turn INTEGER DEFAULT 0
+)
+'''
+
+CREATE_OCR_CACHE_TABLE = '''
+CREATE TABLE IF NOT EXISTS ocr_cache (
+    file_unique_id TEXT PRIMARY KEY,
+    phash TEXT,
+    result TEXT,
+    last_used INTEGER
 )
-'''
\ No newline at end of file
+'''
+
+CREATE_OCR_CACHE_INDEX = '''
+CREATE INDEX IF NOT EXISTS idx_ocr_cache_last_used ON ocr_cache (last_used)
+'''
+
+
+# Schema migrations as (version, statements), applied in order and tracked with PRAGMA user_version.
+# Never edit a released migration, add a new one instead.
+MIGRATIONS: List[Tuple[int, List[str]]] = [
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            msg_tg_id INTEGER,
+            username TEXT,
+            user_id INTEGER,
+            date TEXT,
+            prompt TEXT,
+            response TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS errors (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            msg_tg_id INTEGER,
+            error_text TEXT
+        )
+        ''',
+        CREATE_RESPONSE_CACHE_TABLE,
+        CREATE_RESPONSE_CACHE_INDEX,
+        CREATE_CACHE_OPT_OUT_TABLE,
+    ]),
+    (2, [
+        # Rebuild messages with a chat id and integer dates. Rows written before this
+        # migration only came from private chats, where the chat id equals the user id.
+        '''
+        CREATE TABLE messages_v2 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            msg_tg_id INTEGER,
+            username TEXT,
+            user_id INTEGER,
+            date INTEGER,
+            prompt TEXT,
+            response TEXT
+        )
+        ''',
+        '''
+        INSERT INTO messages_v2 (id, chat_id, msg_tg_id, username, user_id, date, prompt, response)
+        SELECT id, user_id, msg_tg_id, username, user_id,
+               CAST(strftime('%s', substr(date, 1, 19)) AS INTEGER), prompt, response
+        FROM messages
+        ''',
+        'DROP TABLE messages',
+        'ALTER TABLE messages_v2 RENAME TO messages',
+        'CREATE INDEX idx_messages_chat_msg ON messages (chat_id, msg_tg_id)',
+        'CREATE INDEX idx_messages_user_id ON messages (user_id)',
+        'CREATE INDEX idx_messages_date ON messages (date)',
+        'ALTER TABLE errors ADD COLUMN chat_id INTEGER',
+        '''
+        UPDATE errors SET chat_id = (
+            SELECT chat_id FROM messages WHERE messages.msg_tg_id = errors.msg_tg_id ORDER BY id DESC LIMIT 1
+        )
+        ''',
+    ]),
+    (3, [
+        CREATE_JOBS_TABLE,
+        CREATE_JOBS_INDEX,
+    ]),
+    (4, [
+        CREATE_CHAT_CONTEXT_TABLE,
+    ]),
+    (5, [
+        CREATE_OCR_CACHE_TABLE,
+        CREATE_OCR_CACHE_INDEX,
+    ]),
+    (6, [
+        # Content type of the queued message, for admission limits per type
+        'ALTER TABLE jobs ADD COLUMN kind TEXT',
+    ]),
+    (7, [
+        # Sender of the queued message, for the admission limit per user
+        'ALTER TABLE jobs ADD COLUMN user_id INTEGER',
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
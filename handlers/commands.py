@@ -1,8 +1,11 @@
 import logging
 from aiogram import Dispatcher, html
-from aiogram.filters import CommandStart
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.types import Message
 
+from services.response_cache import set_cache_enabled, is_cache_enabled
+from services.conversation import reset_context
+
 logger = logging.getLogger(__name__)
 
 async def command_start_handler(message: Message) -> None:
@@ -13,6 +16,32 @@ async def command_start_handler(message: Message) -> None:
     except Exception as e:
         logger.error(f"Error in start command handler: {e}")
 
+async def command_cache_handler(message: Message, command: CommandObject) -> None:
+    """Handle the /cache command that turns response caching on or off."""
+    try:
+        argument = (command.args or "").strip().lower()
+        if argument in ("on", "off"):
+            await set_cache_enabled(message.from_user.id, argument == "on")
+
+        if is_cache_enabled(message.from_user.id):
+            await message.answer("Кешування відповідей увімкнено. Щоб вимкнути, надішліть /cache off")
+        else:
+            await message.answer("Кешування відповідей вимкнено. Щоб увімкнути, надішліть /cache on")
+        logger.info(f"User {message.from_user.id} set response cache: {argument or 'status'}")
+    except Exception as e:
+        logger.error(f"Error in cache command handler: {e}")
+
+async def command_new_handler(message: Message) -> None:
+    """Handle the /new command that starts a new conversation."""
+    try:
+        await reset_context(message.chat.id, message.message_id)
+        await message.answer("Починаємо нову розмову. Попередні повідомлення більше не враховуються.")
+        logger.info(f"Chat {message.chat.id} started a new conversation")
+    except Exception as e:
+        logger.error(f"Error in new command handler: {e}")
+
 def register_command_handlers(dp: Dispatcher) -> None:
     """Register command handlers with the dispatcher."""
-    dp.message.register(command_start_handler, CommandStart())
\ No newline at end of file
+    dp.message.register(command_start_handler, CommandStart())
+    dp.message.register(command_cache_handler, Command("cache"))
+    dp.message.register(command_new_handler, Command("new"))
\ No newline at end of file
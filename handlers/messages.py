@@ -1,19 +1,85 @@
+import asyncio
 import logging
-import os
+import time
+from typing import List
 from aiogram import Dispatcher
 from aiogram.enums import ParseMode, ContentType
-from aiogram.types import Message
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, InputMediaPhoto
 
-from config import MAX_FILE_SIZE, ALLOWED_EXTENSIONS
+from config import (
+    MAX_FILE_SIZE, ALLOWED_EXTENSIONS, STREAM_RESPONSES, STREAM_EDIT_INTERVAL, JOB_WORKERS, OPENAI_MODEL_TIERS,
+)
 from database.db_manager import save_message, update_message_response, save_error
+from database.job_queue import enqueue_job, run_stage
 from database.models import Message as DbMessage, Error as DbError
-from services.openai_service import get_gpt_response
-from services.latex_service import preprocess_response, render_latex_to_image, process_image_with_latex_ocr
-from utils.text_processing import split_response, clear_splitted_response
+from services.openai_service import get_gpt_response, stream_gpt_response, route_prompt, GptBusyError
+from services.latex_service import render_latex_to_image, recognize_photo
+from services.image_preprocessing import pick_photo_size
+from services.formula_cache import formula_key, get_file_id, set_file_id
+from services.response_cache import get_or_create_response
+from services.conversation import build_context, count_tokens, remember_turn
+from services.document_service import download_document, compact_csv, condense_document
+from services.solver_service import solve
+from services.admission import admit, release, message_kind, USER_BUSY
+from services.send_scheduler import priority, BULK
+from utils.text_processing import ResponseSplitter, Segment, MATH_KINDS, split_response, compose_messages
+from utils.metrics import timed, observe, count_error, track_message
+from utils.log import request_context
 
 logger = logging.getLogger(__name__)
 
 
+async def send_formulas(message: Message, chunks: List[Segment], img_index: int) -> int:
+    """
+    Send rendered formulas, grouped into one media group when there are several.
+
+    Args:
+        message: The message to reply to
+        chunks: Up to 10 formula chunks
+        img_index: Index of the next formula image
+
+    Returns:
+        Index of the next formula image
+    """
+    keys = [formula_key(chunk.text.replace("\n", "")) for chunk in chunks]
+    file_ids = [get_file_id(key) for key in keys]
+
+    async def photo(i: int):
+        if file_ids[i]:
+            return file_ids[i]
+        return await render_latex_to_image(chunks[i].text, message.message_id, img_index + i)
+
+    photos = await asyncio.gather(*(photo(i) for i in range(len(chunks))))
+    if len(photos) == 1:
+        sent = [await message.answer_photo(photo=photos[0])]
+    else:
+        sent = await message.answer_media_group(media=[InputMediaPhoto(media=p) for p in photos])
+
+    for key, file_id, sent_message in zip(keys, file_ids, sent):
+        if not file_id:
+            await set_file_id(key, sent_message.photo[-1].file_id)
+    return img_index + len(chunks)
+
+
+async def send_response_group(message: Message, group: List[Segment], img_index: int) -> int:
+    """
+    Send one outbound message of a response: a text chunk or a group of formulas.
+
+    Args:
+        message: The message to reply to
+        group: A message produced by compose_messages
+        img_index: Index of the next formula image
+
+    Returns:
+        Index of the next formula image
+    """
+    if group[0].kind not in MATH_KINDS:
+        await message.answer(group[0].text, parse_mode=ParseMode.MARKDOWN)
+        return img_index
+    return await send_formulas(message, group, img_index)
+
+
 async def process_text_response(message: Message, gpt_response: str) -> None:
     """
     Process and send a GPT response with potential LaTeX content.
@@ -22,18 +88,132 @@ async def process_text_response(message: Message, gpt_response: str) -> None:
         message: The message to reply to
         gpt_response: The GPT-generated response
     """
-    chunks = split_response(preprocess_response(gpt_response))
     img_index = 0
+    with timed("tokenize"):
+        groups = compose_messages(split_response(gpt_response))
+    if groups:
+        img_index = await send_response_group(message, groups[0], img_index)
+    # The rest of a long answer must not hold up first replies in other chats
+    with priority(BULK):
+        for group in groups[1:]:
+            img_index = await send_response_group(message, group, img_index)
+
 
-    for chunk in chunks:
-        cleared_chunk = clear_splitted_response(str(chunk))
-        if cleared_chunk != "" and cleared_chunk and len(cleared_chunk) != 0:
-            if cleared_chunk[0] != "$":
-                await message.answer(cleared_chunk, parse_mode=ParseMode.MARKDOWN)
+async def process_streaming_response(message: Message, prompt: str, context: List[dict], tier: int) -> str:
+    """
+    Stream a GPT response to the chat while it is being generated.
+
+    The text that is still being generated is shown in a placeholder message which is
+    edited at most once per STREAM_EDIT_INTERVAL. Text is finalized as soon as a
+    formula starts or the message limit is reached, formulas as soon as they close.
+
+    Args:
+        message: The message to reply to
+        prompt: The user prompt to send to the model
+        context: Earlier messages of the conversation
+        tier: Model tier to start at
+
+    Returns:
+        The full GPT-generated response
+    """
+    splitter = ResponseSplitter()
+    parts = []
+    img_index = 0
+    placeholder = None
+    shown = ""
+    last_edit = 0.0
+    # Time spent splitting the response, recorded once the stream is done
+    tokenize_time = 0.0
+
+    async def send(chunks: List[Segment]) -> None:
+        nonlocal img_index, placeholder, shown
+        for group in compose_messages(chunks):
+            if placeholder:
+                if group[0].kind not in MATH_KINDS:
+                    # The finished text replaces the live preview, unless it already shows it
+                    if group[0].text.strip() != shown:
+                        try:
+                            await placeholder.edit_text(group[0].text, parse_mode=ParseMode.MARKDOWN)
+                        except TelegramBadRequest as e:
+                            # Markdown that renders as the preview already does
+                            if "message is not modified" not in e.message:
+                                raise
+                    placeholder, shown = None, ""
+                    continue
+                await placeholder.delete()
+                placeholder, shown = None, ""
+            img_index = await send_response_group(message, group, img_index)
+
+    async for delta in stream_gpt_response(prompt, message.from_user.id, context, tier):
+        parts.append(delta)
+        start = time.perf_counter()
+        chunks = splitter.feed(delta)
+        tokenize_time += time.perf_counter() - start
+        await send(chunks)
+
+        preview = splitter.pending.strip()[:4096]
+        now = time.monotonic()
+        if preview and preview != shown and now - last_edit >= STREAM_EDIT_INTERVAL:
+            if placeholder:
+                await placeholder.edit_text(preview, parse_mode=None)
             else:
-                photo = await render_latex_to_image(cleared_chunk, message.message_id, img_index)
-                await message.answer_photo(photo=photo)
-                img_index += 1
+                placeholder = await message.answer(preview, parse_mode=None)
+            shown, last_edit = preview, now
+
+    start = time.perf_counter()
+    chunks = splitter.close()
+    observe("tokenize", tokenize_time + time.perf_counter() - start)
+    await send(chunks)
+    if placeholder:
+        await placeholder.delete()
+    return "".join(parts)
+
+
+async def answer_prompt(message: Message, prompt: str, source: str = "text") -> str:
+    """
+    Get a GPT response for a prompt and send it to the chat.
+
+    Plain math is answered by the local solver when it can, without GPT. Other
+    prompts are sent along with the chat's earlier turns to the model tier
+    picked by route_prompt. Responses to prompts without context may be served
+    from the response cache.
+
+    Args:
+        message: The message to reply to
+        prompt: The user prompt to send to the model
+        source: Where the prompt came from: "text", "photo" or "document"
+
+    Returns:
+        The full GPT-generated response
+    """
+    answer = await solve(prompt)
+    if answer is not None:
+        logger.info("Message %s answered by the solver", message.message_id)
+        await process_text_response(message, answer)
+        return answer
+
+    context, request_tokens = await build_context(message.chat.id, message.message_id, prompt)
+    logger.info("Prompt of message %s: %s tokens, %s context messages",
+                message.message_id, request_tokens, len(context))
+    prompt_tokens = count_tokens(prompt)
+    tier = route_prompt(prompt, prompt_tokens, request_tokens - prompt_tokens, source)
+
+    async def create_response() -> str:
+        if STREAM_RESPONSES:
+            return await process_streaming_response(message, prompt, context, tier)
+
+        gpt_response = await get_gpt_response(prompt, message.from_user.id, context, tier)
+        await process_text_response(message, gpt_response)
+        return gpt_response
+
+    if context:
+        # A follow-up's answer depends on the conversation, so it can't be shared
+        return await create_response()
+    response, sent = await get_or_create_response(prompt, message.from_user.id, create_response,
+                                                  OPENAI_MODEL_TIERS[tier][1])
+    if not sent:
+        await process_text_response(message, response)
+    return response
 
 
 async def handle_text_message(message: Message) -> None:
@@ -41,22 +221,23 @@ async def handle_text_message(message: Message) -> None:
     try:
         # Save message to database
         db_message = DbMessage(
+            chat_id=message.chat.id,
             msg_tg_id=message.message_id,
             username=message.from_user.username,
             user_id=message.from_user.id,
-            date=str(message.date),
+            date=int(message.date.timestamp()),
             prompt=message.text,
         )
-        save_message(db_message)
+        await run_stage("saved", lambda: save_message(db_message))
 
         # Get and process response
-        gpt_response = await get_gpt_response(message.text)
-        await process_text_response(message, gpt_response)
+        gpt_response = await run_stage("answer", lambda: answer_prompt(message, message.text))
 
         # Update database with response
-        update_message_response(message.message_id, gpt_response)
+        await update_message_response(message.chat.id, message.message_id, gpt_response)
+        await remember_turn(message.chat.id, message.message_id, db_message.prompt, gpt_response)
 
-        logger.info(f"Processed text message from user {message.from_user.id}")
+        logger.info("Processed text message")
     except Exception as e:
         logger.error(f"Error processing text message: {e}")
         await handle_error(message, e)
@@ -77,38 +258,54 @@ async def handle_document_message(message: Message) -> None:
         if extension not in ALLOWED_EXTENSIONS:
             raise TypeError(f"Unsupported file extension: {extension}")
 
-        file_path = (await message.bot.get_file(document.file_id)).file_path
-        file_name = f"{message.message_id}.{extension}"
-        await message.bot.download_file(file_path, file_name)
+        timings = {}
+
+        async def download() -> str:
+            start = time.perf_counter()
+            with timed("download"):
+                data = await download_document(message.bot, document)
+            timings["download"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            text = data.decode("utf-8")
+            if extension == "csv":
+                text = await asyncio.to_thread(compact_csv, text)
+            timings["prepare"] = time.perf_counter() - start
+            return text
 
-        with open(file_name, "r", encoding="utf-8") as f:
-            file_content = f.read()
+        file_content = await run_stage("download", download)
 
         # Save message to database
         db_message = DbMessage(
+            chat_id=message.chat.id,
             msg_tg_id=message.message_id,
             username=message.from_user.username,
             user_id=message.from_user.id,
-            date=str(message.date),
+            date=int(message.date.timestamp()),
             prompt=f"{message.text or ''}\n[FILE: {document.file_name}]",
         )
-        save_message(db_message)
+        await run_stage("saved", lambda: save_message(db_message))
 
         # Get and process response
-        if message.text:
-            gpt_response = await get_gpt_response(message.text + "\n\n" + file_content)
-        else:
-            gpt_response = await get_gpt_response(file_content)
+        start = time.perf_counter()
+        file_content = await run_stage(
+            "condense", lambda: condense_document(message.text or "", document.file_name, file_content))
+        timings["condense"] = time.perf_counter() - start
 
-        await process_text_response(message, gpt_response)
+        start = time.perf_counter()
+        prompt = message.text + "\n\n" + file_content if message.text else file_content
+        gpt_response = await run_stage("answer", lambda: answer_prompt(message, prompt, "document"))
+        timings["answer"] = time.perf_counter() - start
 
         # Update database with response
-        update_message_response(message.message_id, gpt_response)
+        await update_message_response(message.chat.id, message.message_id, gpt_response)
+        await remember_turn(message.chat.id, message.message_id, db_message.prompt, gpt_response)
 
-        # Clean up
-        os.remove(file_name)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Document %s (%s bytes): %s", document.file_name, document.file_size,
+                        ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items()))
 
-        logger.info(f"Processed document message from user {message.from_user.id}")
+        logger.info("Processed document message")
     except Exception as e:
         logger.error(f"Error processing document message: {e}")
         await handle_error(message, e)
@@ -117,7 +314,7 @@ async def handle_document_message(message: Message) -> None:
 async def handle_photo_message(message: Message) -> None:
     """Handle photo messages."""
     try:
-        photo = message.photo[-1]
+        photo = pick_photo_size(message.photo)
         file_size = photo.file_size / (1024 * 1024)
 
         if file_size > MAX_FILE_SIZE:
@@ -125,39 +322,29 @@ async def handle_photo_message(message: Message) -> None:
                 f"Розмір вашого фото занадто великий. Максимальний дозволений розмір - {MAX_FILE_SIZE} MB.")
             return
 
-        file_path = (await message.bot.get_file(photo.file_id)).file_path
-        file_name = f"in{message.message_id}.png"
-        await message.bot.download_file(file_path, file_name)
-
         # Process image with LaTeX OCR
-        photo_content = await process_image_with_latex_ocr(file_name)
+        photo_content = await run_stage("ocr", lambda: recognize_photo(message.bot, photo))
 
         # Save message to database
         db_message = DbMessage(
+            chat_id=message.chat.id,
             msg_tg_id=message.message_id,
             username=message.from_user.username,
             user_id=message.from_user.id,
-            date=str(message.date),
+            date=int(message.date.timestamp()),
             prompt=f"{message.caption or ''}\n[IMAGE: LaTeX content detected: {photo_content}]",
         )
-        save_message(db_message)
+        await run_stage("saved", lambda: save_message(db_message))
 
         # Get and process response
-        if message.caption:
-            prompt = photo_content + ' ' + message.caption
-            gpt_response = await get_gpt_response(prompt)
-        else:
-            gpt_response = await get_gpt_response(photo_content)
-
-        await process_text_response(message, gpt_response)
+        prompt = photo_content + ' ' + message.caption if message.caption else photo_content
+        gpt_response = await run_stage("answer", lambda: answer_prompt(message, prompt, "photo"))
 
         # Update database with response
-        update_message_response(message.message_id, gpt_response)
+        await update_message_response(message.chat.id, message.message_id, gpt_response)
+        await remember_turn(message.chat.id, message.message_id, db_message.prompt, gpt_response)
 
-        # Clean up
-        os.remove(file_name)
-
-        logger.info(f"Processed photo message from user {message.from_user.id}")
+        logger.info("Processed photo message")
     except Exception as e:
         logger.error(f"Error processing photo message: {e}")
         await handle_error(message, e)
@@ -165,39 +352,77 @@ async def handle_photo_message(message: Message) -> None:
 
 async def handle_error(message: Message, exception: Exception) -> None:
     """Handle and log errors."""
+    count_error("message", exception)
     try:
         if isinstance(exception, TypeError):
             await message.answer(
                 "Формат вашого повідомлення не підтримується. На даний момент, енциклопедія приймає лише текстові запити.")
+        elif isinstance(exception, GptBusyError):
+            await message.answer("Сервіс зараз перевантажений. Будь ласка, спробуйте пізніше.")
         else:
             await message.answer("Дуже прикро, але під час опрацювання вашого запиту сталася помилка.")
 
         # Save error to database
         error = DbError(
+            chat_id=message.chat.id,
             msg_tg_id=message.message_id,
             error_text=str(exception)
         )
-        save_error(error)
+        await save_error(error)
     except Exception as e:
         logger.error(f"Error in error handler: {e}")
 
 
-async def echo_handler(message: Message) -> None:
-    """Main message handler that routes to specific handlers based on content type."""
+async def process_message(message: Message) -> None:
+    """Route a message to the handler of its content type."""
     try:
-        if message.content_type == ContentType.TEXT:
-            await handle_text_message(message)
-        elif message.content_type == ContentType.DOCUMENT:
-            await handle_document_message(message)
-        elif message.content_type == ContentType.PHOTO:
-            await handle_photo_message(message)
-        else:
-            raise TypeError(f"Unsupported content type: {message.content_type}")
+        with track_message():
+            if message.content_type == ContentType.TEXT:
+                await handle_text_message(message)
+            elif message.content_type == ContentType.DOCUMENT:
+                await handle_document_message(message)
+            elif message.content_type == ContentType.PHOTO:
+                await handle_photo_message(message)
+            else:
+                raise TypeError(f"Unsupported content type: {message.content_type}")
     except Exception as e:
-        logger.error(f"Error in echo handler: {e}")
+        logger.error(f"Error processing message: {e}")
         await handle_error(message, e)
 
 
+async def reply_busy(message: Message, reason: str) -> None:
+    """Tell the user a message was turned away by admission control."""
+    try:
+        if reason == USER_BUSY:
+            await message.answer("Ваш попередній запит ще опрацьовується. Будь ласка, дочекайтеся відповіді.")
+        else:
+            await message.answer("Сервіс зараз перевантажений. Будь ласка, спробуйте пізніше.")
+    except Exception as e:
+        logger.error(f"Error replying to a shed message: {e}")
+
+
+async def echo_handler(message: Message) -> None:
+    """Main message handler, queues the message for the workers or processes it right away."""
+    with request_context(message.chat.id, message.message_id, message.from_user.id):
+        # Shed load right away instead of letting it pile up
+        reason = await admit(message)
+        if reason is not None:
+            await reply_busy(message, reason)
+            return
+        try:
+            if not JOB_WORKERS:
+                await process_message(message)
+                return
+            try:
+                await enqueue_job(message.chat.id, message.message_id, message.model_dump_json(exclude_none=True),
+                                  message_kind(message), message.from_user.id)
+            except Exception as e:
+                logger.error(f"Error queueing message: {e}")
+                await handle_error(message, e)
+        finally:
+            release(message)
+
+
 def register_message_handlers(dp: Dispatcher) -> None:
     """Register message handlers with the dispatcher."""
     dp.message.register(echo_handler)
\ No newline at end of file
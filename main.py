@@ -1,54 +1,251 @@
 #!/usr/bin/env python3
 import asyncio
 import logging
-import sys
+import multiprocessing
+import signal
 
-from aiogram import Bot, Dispatcher
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
+from utils.startup import startup_phase, log_startup_report
 
-from config import TOKEN, LOG_LEVEL
-from database.db_manager import init_db, close_connection
-from handlers import register_all_handlers
+with startup_phase("import aiogram"):
+    from aiogram import Bot, Dispatcher
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.enums import ParseMode
+
+with startup_phase("import config"):
+    from config import (
+        TOKEN, BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT,
+        JOB_WORKERS, METRICS_PORT, DRAIN_TIMEOUT, SEND_GLOBAL_RATE,
+    )
+
+with startup_phase("import database"):
+    from database.db_manager import init_db, close_connection, get_db_stats
+    from database.maintenance import run_retention
+    from database.job_queue import init_job_queue, close_job_queue, count_jobs, get_job_stats
+
+with startup_phase("import handlers"):
+    from handlers import register_all_handlers
+
+with startup_phase("import services"):
+    from services.render_service import init_renderer, close_renderer, warm_up_renderer, get_render_stats
+    from services.formula_cache import init_formula_cache, get_cache_stats
+    from services.ocr_service import init_ocr_service, close_ocr_service, get_ocr_stats, warm_up_ocr_service
+    from services.response_cache import init_response_cache, get_response_cache_stats
+    from services.ocr_cache import get_ocr_cache_stats
+    from services.openai_service import get_gpt_stats
+    from services.conversation import get_context_stats
+    from services.solver_service import init_solver, close_solver, warm_up_solver, get_solver_stats
+    from services.admission import drain, get_admission_stats
+    from services.send_scheduler import init_send_scheduler, close_send_scheduler, get_send_stats, \
+        SendSchedulerMiddleware
+    from worker import worker_main
+
+with startup_phase("import utils"):
+    from utils.metrics import start_metrics_server, stop_metrics_server, MetricsMiddleware, \
+        MetricsRequestMiddleware
+    from utils.log import setup_logging, close_logging, get_log_stats
+
+# Background tasks, kept referenced so they aren't garbage collected
+warmup_task = None
+retention_task = None
+# Job queue worker processes
+workers = []
+
+
+def start_workers() -> None:
+    """Start the worker processes consuming the job queue."""
+    context = multiprocessing.get_context("spawn")
+    for worker_id in range(JOB_WORKERS):
+        process = context.Process(target=worker_main, args=(worker_id,), name=f"worker-{worker_id}")
+        process.start()
+        workers.append(process)
+
+
+def stop_workers(timeout: float = DRAIN_TIMEOUT + 10) -> None:
+    """Ask the workers to hand back unfinished jobs and wait for them to exit."""
+    for process in workers:
+        if process.is_alive():
+            process.terminate()
+    for process in workers:
+        process.join(timeout)
+        if process.is_alive():
+            process.kill()
+    workers.clear()
+
+
+async def _warm_up_phase(name: str, warm_up_service) -> None:
+    """Run one warm-up as a startup phase, logging its failure instead of raising."""
+    try:
+        with startup_phase(name):
+            await warm_up_service()
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Error during {name}: {e}")
+
+
+async def warm_up() -> None:
+    """Load the OCR models, the LaTeX toolchain and SymPy in the background once polling has started."""
+    try:
+        # Side by side, so a failing or slow warm-up doesn't hold back the others
+        await asyncio.gather(
+            _warm_up_phase("warm up renderer", warm_up_renderer),
+            _warm_up_phase("warm up solver", warm_up_solver),
+            _warm_up_phase("warm up OCR", warm_up_ocr_service),
+        )
+    finally:
+        log_startup_report()
+
+
+async def on_startup() -> None:
+    """Schedule warm-up and retention without delaying the start of update processing."""
+    global warmup_task, retention_task
+    if JOB_WORKERS:
+        log_startup_report()
+    else:
+        warmup_task = asyncio.create_task(warm_up())
+    retention_task = asyncio.create_task(run_retention())
+
+
+async def on_shutdown() -> None:
+    """Finish the messages in progress while the bot session is still open."""
+    # Runs once polling has stopped fetching updates, or the webhook has stopped accepting them
+    await drain(DRAIN_TIMEOUT)
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    """Serve Telegram updates from an aiohttp webhook endpoint until SIGTERM or SIGINT."""
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    logger = logging.getLogger(__name__)
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET is not set, webhook requests are not verified")
+
+    app = web.Application()
+    # Answer 200 right away and process the update in a background task
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=True,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+        logger.info(f"Webhook listening on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+        await stopping.wait()
+        logger.info("Stopping webhook")
+    finally:
+        # Closes the listening socket first, then runs the shutdown handlers
+        await runner.cleanup()
 
 
 async def main() -> None:
     """Initialize and start the bot."""
-    # Configure logging
-    logging.basicConfig(
-        level=getattr(logging, LOG_LEVEL),
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        stream=sys.stdout
-    )
+    # Configure logging, records are formatted and written by a background thread
+    setup_logging()
     logger = logging.getLogger(__name__)
     logger.info("Starting bot")
 
     # Initialize database
-    init_db()
+    with startup_phase("init database"):
+        init_db()
+        init_response_cache()
+
+    if JOB_WORKERS:
+        # Messages are processed by the workers, this process only queues them
+        with startup_phase("start workers"):
+            init_job_queue()
+            start_workers()
+        logger.info(f"Started {JOB_WORKERS} workers, {count_jobs()} jobs waiting in the queue")
+    else:
+        # Start LaTeX renderer workers and load rendered formula cache
+        with startup_phase("init renderer"):
+            init_renderer()
+            init_formula_cache()
+
+        # Start OCR workers, models are loaded by the warm-up
+        with startup_phase("init OCR"):
+            init_ocr_service()
+
+        # Start the SymPy solver workers, prompts go to GPT until the warm-up has imported SymPy
+        with startup_phase("init solver"):
+            init_solver()
 
     # Initialize Bot with default properties
     bot = Bot(
         token=TOKEN,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
+    # Measure Bot API requests including the wait for a send slot
+    bot.session.middleware(MetricsRequestMiddleware())
+    # Route every send through the flood-limit aware scheduler
+    bot.session.middleware(SendSchedulerMiddleware())
+    # The bot process and each worker send at an equal share of the global flood limit
+    init_send_scheduler(SEND_GLOBAL_RATE / (JOB_WORKERS + 1))
 
     # Initialize dispatcher
     dp = Dispatcher()
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    dp.update.outer_middleware(MetricsMiddleware())
 
     # Register all handlers
     register_all_handlers(dp)
 
+    await start_metrics_server(METRICS_PORT)
+
     try:
-        # Start polling
-        logger.info("Bot started")
-        await dp.start_polling(bot)
+        logger.info(f"Bot started in {BOT_MODE} mode")
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            await dp.start_polling(bot)
     except Exception as e:
         logger.error(f"Critical error: {e}")
     finally:
-        # Close database connection
+        # Stop background work, worker pools and close database connection
+        if retention_task:
+            retention_task.cancel()
+        await stop_metrics_server()
+        close_send_scheduler()
+        if JOB_WORKERS:
+            stop_workers()
+            logger.info(f"Job queue stats: {get_job_stats()}")
+            close_job_queue()
+        else:
+            close_renderer()
+            close_ocr_service()
+            close_solver()
+        logger.info(f"Formula cache stats: {get_cache_stats()}")
+        logger.info(f"Renderer stats: {get_render_stats()}")
+        logger.info(f"OCR stats: {get_ocr_stats()}")
+        logger.info(f"Solver stats: {get_solver_stats()}")
+        logger.info(f"OCR cache stats: {get_ocr_cache_stats()}")
+        logger.info(f"Response cache stats: {get_response_cache_stats()}")
+        logger.info(f"Admission stats: {get_admission_stats()}")
+        logger.info(f"Send scheduler stats: {get_send_stats()}")
+        logger.info(f"OpenAI gateway stats: {get_gpt_stats()}")
+        logger.info(f"Conversation context stats: {get_context_stats()}")
         close_connection()
+        logger.info(f"Database writer stats: {get_db_stats()}")
+        logger.info(f"Logging stats: {get_log_stats()}")
         logger.info("Bot stopped")
+        # Write out the queued log records last
+        close_logging()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,69 @@
+"""
+Post recorded Telegram updates to a locally running webhook server.
+
+Updates are read from JSON files holding either one Update object, a list of
+them, or one Update per line (JSONL). Useful for testing webhook mode offline:
+
+    BOT_MODE=webhook python main.py
+    python -m scripts.replay_updates updates.jsonl --concurrency 10
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import List
+
+from aiohttp import ClientSession
+
+from config import WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+
+
+def load_updates(path: str) -> List[dict]:
+    """Load updates from a JSON or JSONL file."""
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read().strip()
+    if not content:
+        return []
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+    return data if isinstance(data, list) else [data]
+
+
+async def replay(updates: List[dict], url: str, secret: str, concurrency: int) -> None:
+    slots = asyncio.Semaphore(concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    latencies = []
+
+    async with ClientSession() as session:
+        async def post(update: dict) -> None:
+            async with slots:
+                start = time.perf_counter()
+                async with session.post(url, json=update, headers=headers) as response:
+                    latencies.append(time.perf_counter() - start)
+                    if response.status != 200:
+                        print(f"Update {update.get('update_id')}: HTTP {response.status}")
+
+        await asyncio.gather(*(post(update) for update in updates))
+
+    if latencies:
+        latencies.sort()
+        print(f"Posted {len(latencies)} updates, "
+              f"median {latencies[len(latencies) // 2] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+", help="JSON or JSONL files with recorded updates")
+    parser.add_argument("--url", default=f"http://{WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET or "", help="secret token header to send")
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args()
+
+    updates = [update for path in args.files for update in load_updates(path)]
+    asyncio.run(replay(updates, args.url, args.secret, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from typing import Dict, Optional, Set
+
+from aiogram.enums import ContentType
+from aiogram.types import Message
+
+from config import ADMISSION_LIMITS, ADMISSION_PER_USER, JOB_WORKERS
+from database.job_queue import count_unfinished_jobs
+
+logger = logging.getLogger(__name__)
+
+# Reasons a message is turned away
+USER_BUSY = "user_busy"
+OVERLOADED = "overloaded"
+
+# Admitted messages of this process per content type and per user
+active: Dict[str, int] = {kind: 0 for kind in ADMISSION_LIMITS}
+active_users: Dict[int, int] = {}
+# Tasks handling the admitted messages, waited for when draining
+tasks: Set[asyncio.Task] = set()
+# Set on shutdown, no more messages are admitted
+draining = False
+
+stats = {
+    "admitted": 0,
+    "shed_user_busy": 0,
+    "shed_overloaded": 0,
+    "max_in_flight": 0,
+    "drained": 0,
+    "abandoned": 0,
+}
+
+
+def message_kind(message: Message) -> str:
+    """Content type a message counts against: "photo", "document" or "text"."""
+    if message.content_type == ContentType.PHOTO:
+        return "photo"
+    if message.content_type == ContentType.DOCUMENT:
+        return "document"
+    # Unsupported content fails fast, it costs no more than text
+    return "text"
+
+
+def _reject(reason: str) -> str:
+    stats[f"shed_{reason}"] += 1
+    return reason
+
+
+async def admit(message: Message) -> Optional[str]:
+    """
+    Decide whether a message may be processed now.
+
+    Each user may have ADMISSION_PER_USER messages and each content type
+    ADMISSION_LIMITS messages in flight. With job workers, messages waiting in
+    the queue or being processed by a worker count as in flight too. An
+    admitted message must be released with release() once it is handled.
+
+    Args:
+        message: The incoming message
+
+    Returns:
+        None if the message is admitted, else USER_BUSY or OVERLOADED
+    """
+    kind = message_kind(message)
+    user_id = message.from_user.id
+    if draining:
+        return _reject(OVERLOADED)
+    if active_users.get(user_id, 0) >= ADMISSION_PER_USER:
+        return _reject(USER_BUSY)
+    if active[kind] >= ADMISSION_LIMITS[kind]:
+        return _reject(OVERLOADED)
+
+    # Reserve the slots before waiting for the queue, so concurrent messages see them
+    active[kind] += 1
+    active_users[user_id] = active_users.get(user_id, 0) + 1
+    task = asyncio.current_task()
+    tasks.add(task)
+
+    if JOB_WORKERS:
+        try:
+            queued, queued_for_user = await count_unfinished_jobs(user_id)
+        except Exception as e:
+            # The limits are a safeguard, not worth failing the message for
+            logger.error(f"Error counting queued jobs: {e}")
+            queued, queued_for_user = {}, 0
+        reason = None
+        if queued_for_user >= ADMISSION_PER_USER:
+            reason = USER_BUSY
+        elif queued.get(kind, 0) >= ADMISSION_LIMITS[kind]:
+            reason = OVERLOADED
+        if reason is not None:
+            release(message)
+            return _reject(reason)
+
+    stats["admitted"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], sum(active.values()))
+    return None
+
+
+def release(message: Message) -> None:
+    """Free the slots of an admitted message."""
+    kind = message_kind(message)
+    user_id = message.from_user.id
+    active[kind] -= 1
+    active_users[user_id] -= 1
+    if not active_users[user_id]:
+        del active_users[user_id]
+    tasks.discard(asyncio.current_task())
+
+
+async def drain(timeout: float) -> None:
+    """
+    Stop admitting messages and wait for the admitted ones to finish.
+
+    Args:
+        timeout: Seconds to wait, messages still in progress after that are cancelled
+    """
+    global draining
+    draining = True
+    pending = {task for task in tasks if not task.done()}
+    if not pending:
+        return
+    logger.info(f"Draining {len(pending)} messages in progress")
+    done, pending = await asyncio.wait(pending, timeout=timeout)
+    stats["drained"] += len(done)
+    stats["abandoned"] += len(pending)
+    if pending:
+        logger.warning(f"{len(pending)} messages did not finish within {timeout}s, cancelling them")
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def get_admission_stats() -> dict:
+    """Return admitted and shed message counts and the messages in flight."""
+    return {
+        **stats,
+        "in_flight": dict(active),
+    }
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, NamedTuple, Set, Tuple
+
+from config import (
+    OPENAI_MODEL,
+    SYSTEM_PROMPT,
+    CONTEXT_ENABLED,
+    CONTEXT_TOKEN_BUDGET,
+    CONTEXT_MAX_TURNS,
+    CONTEXT_CACHE_CHATS,
+)
+from database.db_manager import (
+    get_chat_context,
+    get_recent_turns,
+    save_last_turn,
+    save_chat_summary,
+    reset_chat_context,
+)
+from services.openai_service import summarize_conversation
+
+logger = logging.getLogger(__name__)
+
+# Tokens the chat format adds to every message, and to prime the reply
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+# Characters of a turn passed on to the summary
+SUMMARY_TURN_CHARS = 2000
+
+# Tokenizer of the model, loaded on first use
+encoding = None
+
+
+class Turn(NamedTuple):
+    """A prompt and its response."""
+    msg_tg_id: int
+    prompt: str
+    response: str
+    tokens: int
+
+
+class ChatHistory:
+    """Recent turns of a chat together with the summary of the older ones."""
+
+    def __init__(self, summary: str, summarized_through: int, last_turn: int, turns: Deque[Turn]) -> None:
+        self.summary = summary
+        # Messages up to this id are covered by the summary or were reset
+        self.summarized_through = summarized_through
+        self.last_turn = last_turn
+        self.turns = turns
+
+
+# Hot tier: chat id -> history, most recently used last
+chats: "OrderedDict[int, ChatHistory]" = OrderedDict()
+# Chats whose older turns are being summarized, and the summary tasks
+summarizing: Set[int] = set()
+summary_tasks: Set[asyncio.Task] = set()
+
+stats = {
+    "requests": 0,
+    "cache_hits": 0,
+    "cache_misses": 0,
+    "context_tokens": 0,
+    "prompt_tokens": 0,
+    "summaries": 0,
+}
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a text with the model's tokenizer."""
+    global encoding
+    if encoding is None:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _turn(msg_tg_id: int, prompt: str, response: str) -> Turn:
+    tokens = count_tokens(prompt) + count_tokens(response) + 2 * MESSAGE_OVERHEAD
+    return Turn(msg_tg_id, prompt, response, tokens)
+
+
+def _turn_messages(turn: Turn) -> List[Dict[str, str]]:
+    return [
+        {"role": "user", "content": turn.prompt},
+        {"role": "assistant", "content": turn.response},
+    ]
+
+
+def _load(chat_id: int, msg_tg_id: int) -> ChatHistory:
+    """Return the history of a chat, reloading it if another process changed it."""
+    summary, summarized_through, last_turn = get_chat_context(chat_id)
+    history = chats.get(chat_id)
+    if history is not None and history.summarized_through >= summarized_through \
+            and history.last_turn >= last_turn:
+        chats.move_to_end(chat_id)
+        stats["cache_hits"] += 1
+        return history
+
+    stats["cache_misses"] += 1
+    rows = get_recent_turns(chat_id, summarized_through, msg_tg_id, CONTEXT_MAX_TURNS)
+    turns = deque((_turn(*row) for row in reversed(rows)), maxlen=CONTEXT_MAX_TURNS)
+    if turns:
+        last_turn = max(last_turn, turns[-1].msg_tg_id)
+    history = ChatHistory(summary, summarized_through, last_turn, turns)
+    chats[chat_id] = history
+    while len(chats) > CONTEXT_CACHE_CHATS:
+        chats.popitem(last=False)
+    return history
+
+
+async def _summarize(chat_id: int, history: ChatHistory, turns: List[Turn]) -> None:
+    """Fold turns that no longer fit the budget into the chat's summary."""
+    through = history.summarized_through
+    messages = []
+    for turn in turns:
+        for message in _turn_messages(turn):
+            messages.append({**message, "content": message["content"][:SUMMARY_TURN_CHARS]})
+    try:
+        summary = await summarize_conversation(history.summary, messages)
+    except Exception as e:
+        logger.error(f"Error summarizing conversation of chat {chat_id}: {e}")
+        return
+    finally:
+        summarizing.discard(chat_id)
+
+    if history.summarized_through != through:
+        # The context was reset meanwhile
+        return
+    history.summary = summary
+    history.summarized_through = turns[-1].msg_tg_id
+    while history.turns and history.turns[0].msg_tg_id <= history.summarized_through:
+        history.turns.popleft()
+    stats["summaries"] += 1
+    await save_chat_summary(chat_id, summary, history.summarized_through)
+
+
+async def build_context(chat_id: int, msg_tg_id: int, prompt: str) -> Tuple[List[Dict[str, str]], int]:
+    """
+    Build the conversation context sent along with a prompt.
+
+    The most recent turns are included while they fit into CONTEXT_TOKEN_BUDGET
+    together with the summary. Older turns are summarized in the background, so
+    the summary covers them from the next request on.
+
+    Args:
+        chat_id: Chat the prompt came from
+        msg_tg_id: Telegram id of the prompt's message, later turns are ignored
+        prompt: The user prompt
+
+    Returns:
+        The context messages and the token count of the whole request
+    """
+    stats["requests"] += 1
+    prompt_tokens = count_tokens(SYSTEM_PROMPT) + count_tokens(prompt) + 2 * MESSAGE_OVERHEAD + REPLY_OVERHEAD
+    if not CONTEXT_ENABLED:
+        stats["prompt_tokens"] += prompt_tokens
+        return [], prompt_tokens
+
+    history = _load(chat_id, msg_tg_id)
+    summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {history.summary}"}
+    used = count_tokens(summary_message["content"]) + MESSAGE_OVERHEAD if history.summary else 0
+
+    turns = [turn for turn in history.turns if turn.msg_tg_id < msg_tg_id]
+    start = len(turns)
+    while start > 0 and used + turns[start - 1].tokens <= CONTEXT_TOKEN_BUDGET:
+        start -= 1
+        used += turns[start].tokens
+
+    if start > 0 and chat_id not in summarizing:
+        summarizing.add(chat_id)
+        task = asyncio.create_task(_summarize(chat_id, history, turns[:start]))
+        summary_tasks.add(task)
+        task.add_done_callback(summary_tasks.discard)
+
+    messages = [summary_message] if history.summary else []
+    for turn in turns[start:]:
+        messages.extend(_turn_messages(turn))
+
+    stats["context_tokens"] += used
+    stats["prompt_tokens"] += prompt_tokens + used
+    return messages, prompt_tokens + used
+
+
+async def remember_turn(chat_id: int, msg_tg_id: int, prompt: str, response: str) -> None:
+    """
+    Add an answered prompt to the chat's history.
+
+    Args:
+        chat_id: Chat the prompt came from
+        msg_tg_id: Telegram id of the prompt's message
+        prompt: The prompt as stored in the messages table
+        response: The response sent to the chat
+    """
+    if not CONTEXT_ENABLED:
+        return
+    history = chats.get(chat_id)
+    if history is not None and msg_tg_id > max(history.summarized_through, history.last_turn):
+        history.turns.append(_turn(msg_tg_id, prompt, response))
+        history.last_turn = msg_tg_id
+    await save_last_turn(chat_id, msg_tg_id)
+
+
+async def reset_context(chat_id: int, msg_tg_id: int) -> None:
+    """Start a new conversation in a chat, earlier messages are no longer sent as context."""
+    chats.pop(chat_id, None)
+    await reset_chat_context(chat_id, msg_tg_id)
+
+
+def get_context_stats() -> dict:
+    """Return history cache hits and the average prompt size in tokens."""
+    lookups = stats["cache_hits"] + stats["cache_misses"]
+    return {
+        **stats,
+        "cache_hit_rate": stats["cache_hits"] / lookups if lookups else 0.0,
+        "avg_prompt_tokens": stats["prompt_tokens"] / stats["requests"] if stats["requests"] else 0.0,
+        "cached_chats": len(chats),
+    }
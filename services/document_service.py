@@ -0,0 +1,186 @@
+import asyncio
+import csv
+import io
+import logging
+import random
+import time
+from typing import List, Optional
+
+from aiogram import Bot
+from aiogram.types import Document
+
+from config import DOC_MAX_TOKENS, DOC_CHUNK_TOKENS, DOC_MAP_CONCURRENCY, DOC_CSV_SAMPLE_ROWS, DOC_MAP_PROMPT
+from services.conversation import count_tokens
+from services.openai_service import get_gpt_response
+
+logger = logging.getLogger(__name__)
+
+# Bytes inspected to detect the CSV dialect
+CSV_SNIFF_SIZE = 64 * 1024
+
+
+async def download_document(bot: Bot, document: Document) -> bytes:
+    """Download a document into memory."""
+    buffer = await bot.download(document, destination=io.BytesIO())
+    return buffer.getvalue()
+
+
+def _column_type(values: List[str]) -> str:
+    kind = "int"
+    for value in values:
+        if not value:
+            continue
+        try:
+            int(value)
+            continue
+        except ValueError:
+            pass
+        try:
+            float(value)
+            kind = "float"
+        except ValueError:
+            return "text"
+    return kind
+
+
+def compact_csv(text: str, sample_rows: int = DOC_CSV_SAMPLE_ROWS) -> str:
+    """
+    Describe a CSV file by its schema, size and a sample of rows instead of sending it whole.
+
+    Rows are sampled uniformly in a single pass, so the whole file is never held
+    as parsed rows.
+
+    Args:
+        text: Content of the CSV file
+        sample_rows: Number of rows to include
+
+    Returns:
+        The compact description, or the text itself if it can't be parsed as CSV
+    """
+    try:
+        dialect = csv.Sniffer().sniff(text[:CSV_SNIFF_SIZE])
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(io.StringIO(text), dialect)
+    header = next(reader, None)
+    if not header:
+        return text
+
+    rng = random.Random(0)
+    sample: List[List[str]] = []
+    empty = [0] * len(header)
+    minimum: List[Optional[float]] = [None] * len(header)
+    maximum: List[Optional[float]] = [None] * len(header)
+    rows = 0
+    for row in reader:
+        rows += 1
+        # Reservoir sampling keeps every row equally likely to be shown
+        if len(sample) < sample_rows:
+            sample.append(row)
+        else:
+            j = rng.randrange(rows)
+            if j < sample_rows:
+                sample[j] = row
+        for i, value in enumerate(row[:len(header)]):
+            if not value:
+                empty[i] += 1
+                continue
+            try:
+                number = float(value)
+            except ValueError:
+                continue
+            if minimum[i] is None or number < minimum[i]:
+                minimum[i] = number
+            if maximum[i] is None or number > maximum[i]:
+                maximum[i] = number
+
+    columns = []
+    for i, name in enumerate(header):
+        kind = _column_type([row[i] for row in sample if i < len(row)])
+        details = f"{name} ({kind}, {empty[i]} empty"
+        if kind != "text" and minimum[i] is not None:
+            details += f", min {minimum[i]:g}, max {maximum[i]:g}"
+        columns.append(details + ")")
+
+    out = io.StringIO()
+    writer = csv.writer(out, dialect)
+    writer.writerow(header)
+    writer.writerows(sample)
+    return (
+        f"CSV file with {rows} rows and {len(header)} columns.\n"
+        f"Columns: {'; '.join(columns)}\n"
+        f"{'Sample of ' + str(len(sample)) + ' rows' if len(sample) < rows else 'All rows'}:\n"
+        f"{out.getvalue()}"
+    )
+
+
+def split_by_tokens(text: str, max_tokens: int = DOC_CHUNK_TOKENS) -> List[str]:
+    """
+    Split a text into parts of at most max_tokens tokens, at line boundaries where possible.
+
+    Args:
+        text: The text to split
+        max_tokens: Token limit of a part
+
+    Returns:
+        The parts in order
+    """
+    parts = []
+    lines: List[str] = []
+    tokens = 0
+    for line in text.splitlines(keepends=True):
+        line_tokens = count_tokens(line)
+        if line_tokens > max_tokens:
+            # A single huge line is cut by characters, roughly four per token
+            step = max_tokens * 4
+            pieces = [line[i:i + step] for i in range(0, len(line), step)]
+        else:
+            pieces = [line]
+        for piece in pieces:
+            piece_tokens = line_tokens if len(pieces) == 1 else count_tokens(piece)
+            if lines and tokens + piece_tokens > max_tokens:
+                parts.append("".join(lines))
+                lines, tokens = [], 0
+            lines.append(piece)
+            tokens += piece_tokens
+    if lines:
+        parts.append("".join(lines))
+    return parts
+
+
+async def condense_document(request: str, file_name: str, content: str) -> str:
+    """
+    Condense a document that doesn't fit the model's context, part by part.
+
+    Every part is sent to GPT on its own with the user's request, up to
+    DOC_MAP_CONCURRENCY at once, and the extracts are joined in order. This
+    repeats until the result fits DOC_MAX_TOKENS.
+
+    Args:
+        request: What the user asked about the document
+        file_name: Name of the document
+        content: The document's text
+
+    Returns:
+        Extracts relevant to the request, or the content itself if it fits
+    """
+    slots = asyncio.Semaphore(DOC_MAP_CONCURRENCY)
+
+    async def condense(part: str, index: int, total: int) -> str:
+        instruction = DOC_MAP_PROMPT.format(part=index + 1, parts=total, file_name=file_name, request=request)
+        async with slots:
+            return await get_gpt_response(f"{instruction}\n\n{part}")
+
+    if len(content) <= DOC_MAX_TOKENS:
+        # A token spans at least one character
+        return content
+    # Tokenizing megabytes of text takes a while, keep it off the event loop
+    while await asyncio.to_thread(count_tokens, content) > DOC_MAX_TOKENS:
+        start = time.perf_counter()
+        parts = await asyncio.to_thread(split_by_tokens, content)
+        extracts = await asyncio.gather(*(condense(part, i, len(parts)) for i, part in enumerate(parts)))
+        content = "\n\n".join(f"[Part {i + 1}/{len(parts)}]\n{extract}" for i, extract in enumerate(extracts))
+        logger.info("Condensed %s from %s parts in %.2fs", file_name, len(parts), time.perf_counter() - start)
+        if len(parts) == 1:
+            break
+    return content
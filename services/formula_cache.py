@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from config import (
+    MATPLOTLIB_CONFIG,
+    RENDER_FONTSIZE,
+    RENDER_MIN_DPI,
+    RENDER_MAX_DPI,
+    RENDER_MAX_WIDTH,
+    RENDER_PADDING,
+    FORMULA_CACHE_DIR,
+    FORMULA_CACHE_MEMORY_ITEMS,
+    FORMULA_CACHE_DISK_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+# In-memory tier: key -> PNG bytes, most recently used last
+memory_cache: "OrderedDict[str, bytes]" = OrderedDict()
+# Telegram file_id of an already uploaded image: key -> file_id
+file_ids: Dict[str, str] = {}
+# Disk tier bookkeeping: key -> size in bytes, most recently used last
+disk_index: "OrderedDict[str, int]" = OrderedDict()
+disk_size = 0
+
+stats = {
+    "memory_hits": 0,
+    "disk_hits": 0,
+    "file_id_hits": 0,
+    "misses": 0,
+    "memory_evictions": 0,
+    "disk_evictions": 0,
+}
+
+
+def normalize_expression(latex_expr: str) -> str:
+    """Normalize a LaTeX expression so equivalent spellings share a cache entry."""
+    return re.sub(r"\s+", " ", latex_expr).strip()
+
+
+def formula_key(latex_expr: str, fontsize: int = RENDER_FONTSIZE) -> str:
+    """
+    Build the cache key of a formula.
+
+    Args:
+        latex_expr: LaTeX expression to render
+        fontsize: Font size used for rendering
+
+    Returns:
+        Hex digest identifying the rendered image
+    """
+    settings = repr((sorted(MATPLOTLIB_CONFIG.items()), RENDER_MIN_DPI, RENDER_MAX_DPI, RENDER_MAX_WIDTH,
+                     RENDER_PADDING))
+    payload = f"{normalize_expression(latex_expr)}\0{fontsize}\0{settings}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _image_path(key: str) -> str:
+    return os.path.join(FORMULA_CACHE_DIR, f"{key}.png")
+
+
+def _file_id_path(key: str) -> str:
+    return os.path.join(FORMULA_CACHE_DIR, f"{key}.id")
+
+
+def init_formula_cache() -> None:
+    """Create the cache directory and index the images already stored on disk."""
+    global disk_size
+    os.makedirs(FORMULA_CACHE_DIR, exist_ok=True)
+    disk_index.clear()
+    file_ids.clear()
+    images = []
+    for entry in os.scandir(FORMULA_CACHE_DIR):
+        key, extension = os.path.splitext(entry.name)
+        if extension == ".png":
+            stat = entry.stat()
+            images.append((stat.st_mtime, key, stat.st_size))
+        elif extension == ".id":
+            with open(entry.path, "r", encoding="utf-8") as f:
+                file_ids[key] = f.read().strip()
+    # Reads touch the files, so their modification times give the order of last use
+    for _, key, size in sorted(images):
+        disk_index[key] = size
+    disk_size = sum(disk_index.values())
+    logger.info(f"Formula cache loaded: {len(disk_index)} images, {disk_size} bytes")
+
+
+def _remember_in_memory(key: str, png: bytes) -> None:
+    memory_cache[key] = png
+    memory_cache.move_to_end(key)
+    while len(memory_cache) > FORMULA_CACHE_MEMORY_ITEMS:
+        memory_cache.popitem(last=False)
+        stats["memory_evictions"] += 1
+
+
+def _evict_disk() -> List[str]:
+    """
+    Drop least recently used images from the index until the disk tier fits its size limit.
+
+    Returns:
+        Keys of the evicted images, whose files are still to be removed
+    """
+    global disk_size
+    evicted = []
+    while disk_size > FORMULA_CACHE_DISK_SIZE and disk_index:
+        key, size = disk_index.popitem(last=False)
+        disk_size -= size
+        file_ids.pop(key, None)
+        evicted.append(key)
+        stats["disk_evictions"] += 1
+    return evicted
+
+
+def _read_image(path: str) -> bytes:
+    """Read a cached image and mark it used. Blocking, runs in a thread."""
+    with open(path, "rb") as f:
+        png = f.read()
+    os.utime(path)
+    return png
+
+
+def _write_file(path: str, data: bytes) -> None:
+    """Write a cache file so readers never see it half written. Blocking, runs in a thread."""
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+def _store_image(key: str, png: bytes, evicted: List[str]) -> None:
+    """Write an image and remove the files of evicted ones. Blocking, runs in a thread."""
+    _write_file(_image_path(key), png)
+    for old_key in evicted:
+        for path in (_image_path(old_key), _file_id_path(old_key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def get_file_id(key: str) -> Optional[str]:
+    """Return the Telegram file_id of an uploaded formula image, if known."""
+    file_id = file_ids.get(key)
+    if file_id:
+        stats["file_id_hits"] += 1
+    return file_id
+
+
+async def set_file_id(key: str, file_id: str) -> None:
+    """Remember the Telegram file_id returned after uploading a formula image."""
+    file_ids[key] = file_id
+    if key in disk_index:
+        try:
+            await asyncio.to_thread(_write_file, _file_id_path(key), file_id.encode("utf-8"))
+        except OSError as e:
+            logger.error(f"Error writing cached file_id: {e}")
+
+
+def _forget_on_disk(key: str) -> None:
+    """Drop an image whose file can't be used from the disk tier."""
+    global disk_size
+    size = disk_index.pop(key, None)
+    if size is not None:
+        disk_size -= size
+
+
+async def get_image(key: str) -> Optional[bytes]:
+    """
+    Look up a rendered formula in the memory tier, then on disk.
+
+    Args:
+        key: Cache key from formula_key
+
+    Returns:
+        PNG bytes, or None on a miss
+    """
+    png = memory_cache.get(key)
+    if png is not None:
+        memory_cache.move_to_end(key)
+        if key in disk_index:
+            disk_index.move_to_end(key)
+        stats["memory_hits"] += 1
+        return png
+
+    if key in disk_index:
+        try:
+            png = await asyncio.to_thread(_read_image, _image_path(key))
+        except OSError as e:
+            logger.error(f"Error reading cached formula: {e}")
+            _forget_on_disk(key)
+        else:
+            # The image may have been evicted while it was read
+            if key in disk_index:
+                disk_index.move_to_end(key)
+            _remember_in_memory(key, png)
+            stats["disk_hits"] += 1
+            return png
+
+    stats["misses"] += 1
+    return None
+
+
+async def put_image(key: str, png: bytes) -> None:
+    """
+    Store a rendered formula in both cache tiers.
+
+    The index is updated right away, writing the file and removing the files
+    of evicted images happen in a thread.
+    """
+    global disk_size
+    _remember_in_memory(key, png)
+    if key in disk_index:
+        return
+    disk_index[key] = len(png)
+    disk_size += len(png)
+    evicted = _evict_disk()
+    try:
+        await asyncio.to_thread(_store_image, key, png, evicted)
+    except OSError as e:
+        logger.error(f"Error writing cached formula: {e}")
+        _forget_on_disk(key)
+
+
+def get_cache_stats() -> dict:
+    """Return hit, miss and eviction counters along with current tier sizes."""
+    return {
+        **stats,
+        "memory_items": len(memory_cache),
+        "disk_items": len(disk_index),
+        "disk_bytes": disk_size,
+        "file_ids": len(file_ids),
+    }
@@ -0,0 +1,195 @@
+import io
+import logging
+from typing import List, Optional, Sequence, Tuple
+
+from aiogram.types import PhotoSize
+
+from config import (
+    OCR_MIN_PHOTO_SIDE,
+    OCR_MAX_REGION_SIDE,
+    OCR_MIN_REGION_HEIGHT,
+    OCR_REGION_MARGIN,
+    OCR_SPLIT_MIN_GAP,
+    OCR_MAX_REGIONS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Side of the thumbnail used to estimate uneven lighting
+BACKGROUND_SIZE = 32
+# Rows or columns with less ink than this share of their length count as blank
+NOISE_RATIO = 0.002
+# Regions with less than this share of the ink are specks, not equations
+MIN_REGION_INK = 0.01
+# Bands lower than this share of the tallest one are parts of a neighbouring line
+THIN_BAND = 0.3
+
+
+def pick_photo_size(sizes: Sequence[PhotoSize], min_side: int = OCR_MIN_PHOTO_SIDE) -> PhotoSize:
+    """
+    Pick the smallest size of a photo that is still large enough for recognition.
+
+    Args:
+        sizes: Available sizes of the photo, as in Message.photo
+        min_side: Required length of the longer side in pixels
+
+    Returns:
+        The smallest sufficient size, or the largest one if none is large enough
+    """
+    ordered = sorted(sizes, key=lambda size: size.width * size.height)
+    for size in ordered:
+        if max(size.width, size.height) >= min_side:
+            return size
+    return ordered[-1]
+
+
+def _otsu_threshold(pixels) -> int:
+    """Grey level that best separates ink from background."""
+    import numpy as np
+
+    histogram = np.bincount(pixels.ravel(), minlength=256).astype(np.float64)
+    probability = histogram / histogram.sum()
+    weight = np.cumsum(probability)
+    mean = np.cumsum(probability * np.arange(256))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = (mean[-1] * weight - mean) ** 2 / (weight * (1 - weight))
+    return int(np.nanargmax(variance))
+
+
+def ink_mask(image):
+    """
+    Separate writing from paper.
+
+    The image is converted to grayscale, inverted if it shows light writing on a
+    dark background, evened out against shadows and binarized.
+
+    Args:
+        image: PIL image
+
+    Returns:
+        Boolean numpy array, True where there is writing
+    """
+    import numpy as np
+    from PIL import Image, ImageFilter, ImageOps
+
+    image = ImageOps.exif_transpose(image).convert("L")
+    if np.asarray(image).mean() < 128:
+        # Light writing on a dark background, e.g. a blackboard
+        image = ImageOps.invert(image)
+
+    # Dividing by a blurred thumbnail removes shadows and gradients
+    background = image.resize((BACKGROUND_SIZE, BACKGROUND_SIZE), Image.BILINEAR) \
+        .filter(ImageFilter.GaussianBlur(2)).resize(image.size, Image.BILINEAR)
+    pixels = np.asarray(image, dtype=np.float32) / np.maximum(np.asarray(background, dtype=np.float32), 1)
+    pixels = np.clip(pixels * 255, 0, 255).astype(np.uint8)
+    return pixels < _otsu_threshold(pixels)
+
+
+def content_box(ink) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Bounding box of the writing, ignoring specks of noise.
+
+    Args:
+        ink: Mask returned by ink_mask
+
+    Returns:
+        (top, bottom, left, right) with exclusive ends, or None for a blank image
+    """
+    height, width = ink.shape
+    rows = _runs(ink.sum(axis=1) > max(1, width * NOISE_RATIO))
+    columns = _runs(ink.sum(axis=0) > max(1, height * NOISE_RATIO))
+    if not rows or not columns:
+        return None
+    return rows[0][0], rows[-1][1], columns[0][0], columns[-1][1]
+
+
+def _runs(mask) -> List[Tuple[int, int]]:
+    """Start and end (exclusive) of every run of True values."""
+    import numpy as np
+
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(edges[::2], edges[1::2]))
+
+
+def _bands(ink) -> List[Tuple[int, int]]:
+    """Horizontal bands of the image holding separate lines of content."""
+    height, width = ink.shape
+    bands = [list(run) for run in _runs(ink.sum(axis=1) > max(1, width * NOISE_RATIO))]
+
+    def gap(i: int) -> float:
+        """Blank rows between bands i and i + 1, relative to the taller one."""
+        taller = max(bands[i][1] - bands[i][0], bands[i + 1][1] - bands[i + 1][0])
+        return (bands[i + 1][0] - bands[i][1]) / taller
+
+    # Fraction bars, limits and exponents leave small gaps inside one equation, so
+    # bands are merged until every remaining gap is wide compared to the lines
+    while len(bands) > 1:
+        tallest = max(end - start for start, end in bands)
+        thin = [i for i, (start, end) in enumerate(bands) if end - start < tallest * THIN_BAND]
+        if thin:
+            i = thin[0]
+            # A thin band belongs to its closer neighbour
+            if i == len(bands) - 1 or (i > 0 and bands[i][0] - bands[i - 1][1] <= bands[i + 1][0] - bands[i][1]):
+                i -= 1
+        else:
+            i = min(range(len(bands) - 1), key=gap)
+            if gap(i) >= OCR_SPLIT_MIN_GAP:
+                break
+        bands[i][1] = bands.pop(i + 1)[1]
+    return [(start, end) for start, end in bands]
+
+
+def _encode_region(ink) -> bytes:
+    """Render an ink mask as black on white, padded and scaled for the model."""
+    import numpy as np
+    from PIL import Image
+
+    pixels = np.where(ink, 0, 255).astype(np.uint8)
+    pixels = np.pad(pixels, OCR_REGION_MARGIN, constant_values=255)
+    image = Image.fromarray(pixels)
+
+    width, height = image.size
+    scale = min(1.0, OCR_MAX_REGION_SIDE / max(width, height))
+    if height * scale < OCR_MIN_REGION_HEIGHT:
+        scale = OCR_MIN_REGION_HEIGHT / height
+    if scale != 1.0:
+        image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def preprocess_image(data: bytes) -> List[bytes]:
+    """
+    Prepare a photo for LaTeX OCR.
+
+    The photo is binarized with ink_mask. Each equation, found as a band of ink
+    separated from the others by blank rows, is cropped to its bounding box and
+    scaled to a size the model handles well.
+
+    Args:
+        data: Encoded image
+
+    Returns:
+        One encoded image per equation, or the original image if no content was found
+    """
+    from PIL import Image
+
+    ink = ink_mask(Image.open(io.BytesIO(data)))
+    bands = _bands(ink)
+    if not bands:
+        return [data]
+    if len(bands) > OCR_MAX_REGIONS:
+        bands = [(bands[0][0], bands[-1][1])]
+
+    total_ink = ink.sum()
+    regions = []
+    for start, end in bands:
+        band = ink[start:end]
+        if band.sum() < total_ink * MIN_REGION_INK:
+            continue
+        columns = _runs(band.sum(axis=0) > 0)
+        regions.append(_encode_region(band[:, columns[0][0]:columns[-1][1]]))
+    return regions or [data]
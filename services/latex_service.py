@@ -1,51 +1,20 @@
+import asyncio
+import io
 import logging
-import matplotlib.pyplot as plt
-from sympy.parsing.latex import parse_latex
-from pix2tex.cli import LatexOCR
-from aiogram.types import FSInputFile
-from PIL import Image
-from config import MATPLOTLIB_CONFIG
+import time
+from aiogram import Bot
+from aiogram.types import BufferedInputFile, PhotoSize
+from services.render_service import render_latex
+from services.formula_cache import formula_key, get_image, put_image
+from services.ocr_service import recognize
+from services.image_preprocessing import preprocess_image
+from services import ocr_cache
+from utils.metrics import timed
 
 logger = logging.getLogger(__name__)
 
-# Configure matplotlib for LaTeX rendering
-plt.rcParams.update(MATPLOTLIB_CONFIG)
 
-# Initialize LaTeX OCR model
-model = LatexOCR()
-
-
-def latex_to_math(expr: str) -> str:
-    """Convert LaTeX expression to mathematical notation."""
-    try:
-        return str(parse_latex(expr))
-    except Exception as e:
-        logger.error(f"Error parsing LaTeX: {e}")
-        return expr
-
-
-def preprocess_response(tex: str) -> str:
-    """Preprocess LaTeX in the response for proper rendering."""
-    text = list(tex)
-    i = 0
-    length = len(text)
-    while i < length:
-        if text[i:i + 2] in [['\\', '('], ['\\', '[']]:
-            if text[i + 5:i + 7] in [['\\', ')'], ['\\', ']']]:
-                text[i:i + 2] = ['', '*']
-                text[i + 5:i + 7] = ['', '*']
-            else:
-                text[i:i + 2] = ['$', '$']
-        elif text[i:i + 2] in [['\\', ')'], ['\\', ']']]:
-            text[i:i + 2] = ['$', '$']
-        elif text[i] == '$' and i + 2 < length and text[i + 2] == '$':
-            text[i] = '*'
-            text[i + 2] = '*'
-        i += 1
-    return "".join(text)
-
-
-async def render_latex_to_image(latex_expr: str, message_id: int, img_index: int) -> FSInputFile:
+async def render_latex_to_image(latex_expr: str, message_id: int, img_index: int) -> BufferedInputFile:
     """
     Render LaTeX expression to an image.
 
@@ -55,37 +24,74 @@ async def render_latex_to_image(latex_expr: str, message_id: int, img_index: int
         img_index: Index for file naming when multiple images
 
     Returns:
-        FSInputFile object for the image
+        BufferedInputFile object with the PNG image
     """
     try:
-        fig, ax = plt.subplots()
-        ax.axis('off')
-        latex_expr = ''.join([char for char in latex_expr if char not in ["\n"]])
-        ax.text(0.5, 0.5, latex_expr, fontsize=20, ha='center', va='center', transform=ax.transAxes)
-
-        img_name = f'out{message_id}_{img_index}.jpg'
-        plt.savefig(img_name, dpi=300, bbox_inches='tight', pad_inches=0)
-        plt.close('all')
-
-        return FSInputFile(img_name)
+        latex_expr = latex_expr.replace("\n", "")
+        key = formula_key(latex_expr)
+        png = await get_image(key)
+        if png is None:
+            with timed("render"):
+                png = await render_latex(latex_expr)
+            await put_image(key, png)
+        return BufferedInputFile(png, filename=f'out{message_id}_{img_index}.png')
     except Exception as e:
         logger.error(f"Error rendering LaTeX to image: {e}")
         raise
 
 
-async def process_image_with_latex_ocr(image_path: str) -> str:
+async def process_image_with_latex_ocr(image: bytes) -> str:
     """
     Process image with LaTeX OCR.
 
+    The image is cleaned up and split into equations first, and the equations
+    are recognized in parallel.
+
     Args:
-        image_path: Path to the image
+        image: Encoded image
 
     Returns:
-        LaTeX representation of the content
+        LaTeX representation of the content, one line per equation
     """
     try:
-        img = Image.open(image_path)
-        return model(img)
+        start = time.perf_counter()
+        with timed("ocr_preprocess"):
+            regions = await asyncio.to_thread(preprocess_image, image)
+        preprocessed = time.perf_counter()
+        with timed("ocr"):
+            results = await asyncio.gather(*(recognize(region) for region in regions))
+        logger.info("OCR of %s regions: preprocessing %.3fs, recognition %.3fs",
+                    len(regions), preprocessed - start, time.perf_counter() - preprocessed)
+        return "\n".join(results)
     except Exception as e:
         logger.error(f"Error processing image with LaTeX OCR: {e}")
-        raise
\ No newline at end of file
+        raise
+
+
+async def recognize_photo(bot: Bot, photo: PhotoSize) -> str:
+    """
+    Recognize LaTeX in a Telegram photo, reusing results of photos seen before.
+
+    A photo forwarded again is found by its file id without downloading it. With
+    OCR_CACHE_HASH_LOOKUP on, a re-uploaded or re-compressed copy is found by its
+    perceptual hash after the download.
+
+    Args:
+        bot: Bot to download the photo with
+        photo: Size of the photo to recognize
+
+    Returns:
+        LaTeX representation of the content
+    """
+    result = ocr_cache.get_by_file(photo.file_unique_id)
+    if result is not None:
+        return result
+
+    with timed("download"):
+        buffer = await bot.download(photo, destination=io.BytesIO())
+    image = buffer.getvalue()
+    result, phash = await ocr_cache.get_by_image(image)
+    if result is None:
+        result = await process_image_with_latex_ocr(image)
+    await ocr_cache.put(photo.file_unique_id, phash, result)
+    return result
@@ -0,0 +1,176 @@
+import asyncio
+import io
+import logging
+import threading
+from typing import List, Optional, Tuple
+
+from config import OCR_CACHE_MAX_ROWS, OCR_CACHE_HASH_LOOKUP, OCR_CACHE_MAX_DISTANCE
+from database.db_manager import get_ocr_by_file, get_ocr_by_hash, get_ocr_hashes, save_ocr_result
+from services.image_preprocessing import ink_mask, content_box
+
+logger = logging.getLogger(__name__)
+
+# The hash has a bit for each cell of a HASH_ROWS x HASH_COLS grid
+HASH_ROWS = 16
+HASH_COLS = 128
+# Length of a hash as a hex string
+HASH_LENGTH = HASH_ROWS * HASH_COLS // 4
+# Photos are decoded at about this size for hashing
+HASH_DECODE_SIZE = 512
+
+# In-memory copy of the stored hashes, so lookups don't scan the table.
+# Rows other processes add are picked up by rowid; evicted rows stay until the
+# next rebuild and are skipped when their result is read.
+index_lock = threading.Lock()
+index_ids: List[str] = []
+index_hashes = None  # numpy uint8 array, one row of hash bytes per entry of index_ids
+index_rowid = 0
+# Set bits of every byte value
+POPCOUNT = None
+# Candidates whose results are compared before a hash hit is accepted
+MAX_CANDIDATES = 8
+
+stats = {
+    "file_hits": 0,
+    "hash_hits": 0,
+    "ambiguous": 0,
+    "misses": 0,
+    "index_rebuilds": 0,
+}
+
+
+def image_hash(data: bytes) -> str:
+    """
+    Compute a perceptual hash that survives re-compression and resizing of a photo.
+
+    The photo is binarized and cropped to its writing, so the hash describes the
+    formulas rather than the paper and lighting around them. The writing is scaled
+    to HASH_ROWS rows keeping its aspect ratio, so formulas of different lengths
+    aren't stretched onto each other. Each bit tells whether a cell of the grid
+    holds less writing than the cell to its right, following the strokes of the
+    symbols rather than the average density.
+
+    Args:
+        data: Encoded image
+
+    Returns:
+        Hash of HASH_ROWS * HASH_COLS bits as a hex string
+    """
+    import numpy as np
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    # JPEG photos can be decoded at a fraction of their size
+    image.draft("RGB", (HASH_DECODE_SIZE, HASH_DECODE_SIZE))
+    ink = ink_mask(image)
+    box = content_box(ink)
+    if box:
+        top, bottom, left, right = box
+        ink = ink[top:bottom, left:right]
+
+    # One column more than the hash, each bit compares a cell with its right neighbour
+    height, width = ink.shape
+    scale = min(HASH_ROWS / height, (HASH_COLS + 1) / width)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    scaled = Image.fromarray((ink * 255).astype(np.uint8)).resize(size, Image.BOX)
+    grid = np.zeros((HASH_ROWS, HASH_COLS + 1), dtype=np.uint8)
+    grid[:size[1], :size[0]] = np.asarray(scaled)
+    return np.packbits(grid[:, :-1] < grid[:, 1:]).tobytes().hex()
+
+
+def get_by_file(file_unique_id: str) -> Optional[str]:
+    """Return the cached OCR result of a Telegram file, before it is downloaded."""
+    result = get_ocr_by_file(file_unique_id)
+    if result is not None:
+        stats["file_hits"] += 1
+    return result
+
+
+def _refresh_index() -> None:
+    """Add the hashes stored since the last refresh, rebuilding the index once it holds too many evicted rows."""
+    global index_hashes, index_rowid, POPCOUNT
+    import numpy as np
+
+    if POPCOUNT is None:
+        POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+    if len(index_ids) > 2 * OCR_CACHE_MAX_ROWS:
+        index_ids.clear()
+        index_hashes, index_rowid = None, 0
+        stats["index_rebuilds"] += 1
+
+    rows = get_ocr_hashes(index_rowid, HASH_LENGTH)
+    if not rows:
+        return
+    hashes = np.frombuffer(b"".join(bytes.fromhex(phash) for _, _, phash in rows), dtype=np.uint8)
+    hashes = hashes.reshape(len(rows), -1)
+    index_hashes = hashes if index_hashes is None else np.concatenate([index_hashes, hashes])
+    index_ids.extend(file_unique_id for _, file_unique_id, _ in rows)
+    index_rowid = rows[-1][0]
+
+
+def _find_similar(phash: str) -> Optional[str]:
+    import numpy as np
+
+    with index_lock:
+        _refresh_index()
+        if index_hashes is None:
+            return None
+        query = np.frombuffer(bytes.fromhex(phash), dtype=np.uint8)
+        distances = POPCOUNT[index_hashes ^ query].sum(axis=1)
+        close = np.flatnonzero(distances <= OCR_CACHE_MAX_DISTANCE)
+        close = close[np.argsort(distances[close], kind="stable")][:MAX_CANDIDATES]
+        candidates = [(index_ids[i], index_hashes[i].tobytes().hex()) for i in close]
+
+    # Skip rows that were evicted or replaced since they were indexed. Close
+    # photos with different results mean the hash can't tell them apart.
+    results = [get_ocr_by_hash(file_unique_id, stored) for file_unique_id, stored in candidates]
+    results = [result for result in results if result is not None]
+    if len(set(results)) > 1:
+        stats["ambiguous"] += 1
+        return None
+    return results[0] if results else None
+
+
+async def get_by_image(image: bytes) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Return the cached OCR result of a visually identical photo.
+
+    Only used when OCR_CACHE_HASH_LOOKUP is on, otherwise the photo isn't hashed.
+
+    Args:
+        image: The downloaded photo
+
+    Returns:
+        The result or None, and the photo's perceptual hash to store with its result
+    """
+    if not OCR_CACHE_HASH_LOOKUP:
+        stats["misses"] += 1
+        return None, None
+    result = None
+    try:
+        phash = await asyncio.to_thread(image_hash, image)
+        result = await asyncio.to_thread(_find_similar, phash)
+    except Exception as e:
+        logger.error(f"Error reading OCR cache: {e}")
+        phash = None
+    if result is not None:
+        stats["hash_hits"] += 1
+    else:
+        stats["misses"] += 1
+    return result, phash
+
+
+async def put(file_unique_id: str, phash: Optional[str], result: str) -> None:
+    """Remember the OCR result of a photo under its file id and perceptual hash."""
+    await save_ocr_result(file_unique_id, phash, result, OCR_CACHE_MAX_ROWS)
+
+
+def get_ocr_cache_stats() -> dict:
+    """Return hit counters and the hit rate of the OCR cache."""
+    hits = stats["file_hits"] + stats["hash_hits"]
+    lookups = hits + stats["misses"]
+    return {
+        **stats,
+        "hit_rate": hits / lookups if lookups else 0.0,
+        "indexed": len(index_ids),
+    }
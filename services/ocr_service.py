@@ -0,0 +1,242 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Set, Tuple
+
+from config import OCR_WORKERS, OCR_MAX_BATCH_SIZE, OCR_MAX_BATCH_WAIT, OCR_TIMEOUT, OCR_WARMUP_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Global service state
+executor: Optional[ProcessPoolExecutor] = None
+queue: Optional["asyncio.Queue[Tuple[bytes, asyncio.Future]]"] = None
+batcher_task: Optional[asyncio.Task] = None
+# Batches being recognized by the workers
+batch_tasks: Set[asyncio.Task] = set()
+# Set once the workers have loaded their models
+ready: Optional[asyncio.Event] = None
+warmup_task: Optional[asyncio.Task] = None
+
+stats = {
+    "requests": 0,
+    "batches": 0,
+    "timeouts": 0,
+    "restarts": 0,
+    "batch_sizes": Counter(),
+}
+
+# Per-worker OCR model, loaded once by the pool initializer
+_model = None
+
+
+def _init_worker() -> None:
+    """Load the pix2tex model inside a worker process."""
+    global _model
+    from pix2tex.cli import LatexOCR
+    _model = LatexOCR()
+
+
+def _warm_up_worker() -> bool:
+    """No-op task whose completion means the worker has loaded its model."""
+    return _model is not None
+
+
+def _recognize_batch(images: List[bytes]) -> List[str]:
+    """Run OCR over a batch of encoded images, returning one result or error per image."""
+    from PIL import Image
+
+    results = []
+    for data in images:
+        try:
+            results.append(_model(Image.open(io.BytesIO(data))))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _create_executor() -> ProcessPoolExecutor:
+    """Create a fresh pool of OCR processes."""
+    return ProcessPoolExecutor(
+        max_workers=OCR_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+    )
+
+
+def _kill_executor(pool: ProcessPoolExecutor) -> None:
+    """Terminate every worker of a pool, including ones stuck in inference."""
+    for process in list((pool._processes or {}).values()):
+        if process.is_alive():
+            process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def init_ocr_service() -> None:
+    """Start the OCR worker processes and the batching loop."""
+    global executor, queue, batcher_task, ready
+    executor = _create_executor()
+    queue = asyncio.Queue()
+    ready = asyncio.Event()
+    batcher_task = asyncio.create_task(_batch_loop())
+    logger.info(f"OCR service started with {OCR_WORKERS} workers")
+
+
+async def warm_up_ocr_service() -> None:
+    """Start the OCR workers so their models are loaded before the first photo arrives."""
+    if executor is None:
+        init_ocr_service()
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(*(loop.run_in_executor(executor, _warm_up_worker) for _ in range(OCR_WORKERS)))
+        logger.info("OCR service warmed up")
+    except Exception as e:
+        logger.error(f"Error warming up OCR service: {e}")
+    finally:
+        # Let waiting requests proceed even if warm-up failed, they will report their own errors
+        ready.set()
+
+
+def close_ocr_service() -> None:
+    """Stop the batching loop and the OCR worker processes."""
+    global executor, batcher_task, warmup_task
+    if batcher_task:
+        batcher_task.cancel()
+        batcher_task = None
+    if warmup_task:
+        warmup_task.cancel()
+        warmup_task = None
+    for task in batch_tasks:
+        task.cancel()
+    if executor:
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = None
+        logger.info("OCR service stopped")
+
+
+def _restart_ocr_service(pool: ProcessPoolExecutor) -> None:
+    """Replace a stuck or broken pool with a fresh one, warmed up in the background."""
+    global executor, warmup_task
+    if executor is not pool:
+        # Another batch already restarted it
+        return
+    # New batches wait until the fresh workers have loaded their models
+    ready.clear()
+    _kill_executor(pool)
+    executor = _create_executor()
+    warmup_task = asyncio.create_task(warm_up_ocr_service())
+    stats["restarts"] += 1
+    logger.warning("OCR pool restarted")
+
+
+async def _collect_batch() -> List[Tuple[bytes, asyncio.Future]]:
+    """Wait for one request, then gather more until the batch is full or the window closes."""
+    batch = [await queue.get()]
+    deadline = asyncio.get_running_loop().time() + OCR_MAX_BATCH_WAIT
+    while len(batch) < OCR_MAX_BATCH_SIZE:
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+        except asyncio.TimeoutError:
+            break
+    # Callers that already timed out don't need inference
+    return [(data, future) for data, future in batch if not future.done()]
+
+
+async def _run_batch(batch: List[Tuple[bytes, asyncio.Future]], slots: asyncio.Semaphore) -> None:
+    """Send a batch to a worker and resolve every caller's future."""
+    pool = executor
+    try:
+        # A worker is free for the batch, so the timeout only counts inference
+        results = await asyncio.wait_for(
+            asyncio.get_running_loop().run_in_executor(pool, _recognize_batch, [data for data, _ in batch]),
+            timeout=OCR_TIMEOUT,
+        )
+    except asyncio.TimeoutError as e:
+        logger.error(f"OCR batch timed out after {OCR_TIMEOUT}s, restarting OCR workers")
+        _restart_ocr_service(pool)
+        results = [e] * len(batch)
+    except BrokenProcessPool as e:
+        logger.error("OCR worker died, restarting OCR workers")
+        _restart_ocr_service(pool)
+        results = [e] * len(batch)
+    except Exception as e:
+        logger.error(f"OCR batch failed: {e}")
+        results = [e] * len(batch)
+    finally:
+        slots.release()
+
+    for (_, future), result in zip(batch, results):
+        if future.done():
+            continue
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+async def _batch_loop() -> None:
+    """Group queued images into micro-batches, keeping every worker busy."""
+    slots = asyncio.Semaphore(OCR_WORKERS)
+    while True:
+        await slots.acquire()
+        # After a restart, batches wait for the new workers' models
+        await ready.wait()
+        batch = await _collect_batch()
+        if not batch:
+            slots.release()
+            continue
+        stats["batches"] += 1
+        stats["batch_sizes"][len(batch)] += 1
+        task = asyncio.create_task(_run_batch(batch, slots))
+        batch_tasks.add(task)
+        task.add_done_callback(batch_tasks.discard)
+
+
+async def recognize(image: bytes) -> str:
+    """
+    Recognize LaTeX in an image using the OCR workers.
+
+    Args:
+        image: Encoded image bytes
+
+    Returns:
+        LaTeX representation of the content
+    """
+    global warmup_task
+    if executor is None:
+        init_ocr_service()
+        warmup_task = asyncio.create_task(warm_up_ocr_service())
+
+    # Requests arriving during warm-up wait for the models instead of failing
+    await asyncio.wait_for(ready.wait(), timeout=OCR_WARMUP_TIMEOUT)
+
+    future = asyncio.get_running_loop().create_future()
+    stats["requests"] += 1
+    await queue.put((image, future))
+    try:
+        return await asyncio.wait_for(future, timeout=OCR_TIMEOUT)
+    except asyncio.TimeoutError:
+        stats["timeouts"] += 1
+        logger.error(f"OCR request timed out after {OCR_TIMEOUT}s")
+        raise
+
+
+def get_ocr_stats() -> dict:
+    """Return queue depth and batch-size statistics."""
+    batches = stats["batches"]
+    batched = sum(size * count for size, count in stats["batch_sizes"].items())
+    return {
+        "queue_depth": queue.qsize() if queue else 0,
+        "requests": stats["requests"],
+        "timeouts": stats["timeouts"],
+        "restarts": stats["restarts"],
+        "batches": batches,
+        "avg_batch_size": batched / batches if batches else 0.0,
+        "batch_sizes": dict(stats["batch_sizes"]),
+    }
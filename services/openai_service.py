@@ -1,32 +1,521 @@
+import asyncio
 import logging
-from openai import AsyncOpenAI
-from config import OPENAI_API_KEY, OPENAI_MODEL, SYSTEM_PROMPT
+import random
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_MODEL_TIERS,
+    SYSTEM_PROMPT,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_MAX_CONCURRENCY_PER_USER,
+    OPENAI_DEADLINE,
+    OPENAI_MAX_RETRIES,
+    OPENAI_BACKOFF_BASE,
+    OPENAI_BACKOFF_MAX,
+    OPENAI_BREAKER_THRESHOLD,
+    OPENAI_BREAKER_COOLDOWN,
+    CONTEXT_SUMMARY_MAX_TOKENS,
+    CONTEXT_SUMMARY_PROMPT,
+    ROUTING_ENABLED,
+    ROUTING_FAST_MAX_TOKENS,
+    ROUTING_FAST_MAX_CONTEXT_TOKENS,
+    ROUTING_STRONG_MIN_TOKENS,
+    ROUTING_STRONG_MIN_MATH,
+)
+from utils.metrics import observe, count_error, timed
+from utils.text_processing import CODE, MATH_KINDS, ResponseTokenizer
 
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Initialize OpenAI client, retries and timeouts are handled by the gateway below
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
+T = TypeVar("T")
 
-async def get_gpt_response(prompt: str) -> str:
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError, APITimeoutError)
+
+
+class GptBusyError(Exception):
+    """Raised when GPT requests are rejected quickly because the API is failing."""
+
+
+class CircuitBreaker:
+    """Consecutive failure counter of one model tier that rejects requests for a while once it trips."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.failures = 0
+        self.open_until = 0.0
+        self.probe = False
+
+    def is_open(self) -> bool:
+        return self.failures >= OPENAI_BREAKER_THRESHOLD and time.monotonic() < self.open_until
+
+    def check(self) -> bool:
+        """
+        Reject the request right away while the breaker is open.
+
+        Returns:
+            Whether the request is the one probing whether the tier recovered
+        """
+        if self.failures < OPENAI_BREAKER_THRESHOLD:
+            return False
+        if time.monotonic() < self.open_until or self.probe:
+            stats["rejected"] += 1
+            raise GptBusyError(f"OpenAI tier {self.name} is unavailable, try again later")
+        # Cooldown is over, let one request probe whether the tier recovered
+        self.probe = True
+        return True
+
+    def record(self, success: bool) -> None:
+        self.probe = False
+        if success:
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.failures >= OPENAI_BREAKER_THRESHOLD:
+            self.open_until = time.monotonic() + OPENAI_BREAKER_COOLDOWN
+            logger.error(f"OpenAI circuit breaker of tier {self.name} open for {OPENAI_BREAKER_COOLDOWN}s")
+
+
+# Gateway state
+global_slots = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+user_slots: Dict[int, asyncio.Semaphore] = {}
+user_waiters: Dict[int, int] = {}
+# One breaker per tier, so a failing fast model doesn't shut out the others
+breakers = [CircuitBreaker(name) for name, _, _ in OPENAI_MODEL_TIERS]
+
+stats = {
+    "requests": 0,
+    "in_flight": 0,
+    "queue_wait": 0.0,
+    "max_queue_wait": 0.0,
+    "retries": 0,
+    "rate_limited": 0,
+    "timeouts": 0,
+    "rejected": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+    "escalations": 0,
+    # Tier name -> prompts routed to it first, attempts, failures, seconds spent and tokens used
+    "tiers": {name: {"routed": 0, "attempts": 0, "failures": 0, "latency": 0.0,
+                     "prompt_tokens": 0, "completion_tokens": 0} for name, _, _ in OPENAI_MODEL_TIERS},
+}
+
+LAST_TIER = len(OPENAI_MODEL_TIERS) - 1
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """Parse durations such as "20ms", "1.5s" or "6m0s" from rate-limit headers."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def _backoff_delay(error: Exception, attempt: int) -> float:
+    """Delay before the next attempt, from response headers when present, else exponential with jitter."""
+    if isinstance(error, APIStatusError):
+        headers = error.response.headers
+        for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+            if header in headers:
+                delay = _parse_duration(headers[header])
+                if delay is not None:
+                    return delay * scale
+        if isinstance(error, RateLimitError):
+            reset = headers.get("x-ratelimit-reset-requests") or headers.get("x-ratelimit-reset-tokens")
+            delay = _parse_duration(reset) if reset else None
+            if delay is not None:
+                return delay + random.uniform(0, OPENAI_BACKOFF_BASE)
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+
+
+@asynccontextmanager
+async def _request_slot(user_id: Optional[int]) -> AsyncIterator[None]:
+    """Wait for a free global and per-user slot."""
+    if all(breaker.is_open() for breaker in breakers):
+        # Don't queue behind other requests just to be rejected
+        stats["rejected"] += 1
+        raise GptBusyError("OpenAI API is unavailable, try again later")
+    start = time.perf_counter()
+    user_slot = None
+    if user_id is not None:
+        user_slot = user_slots.get(user_id)
+        if user_slot is None:
+            user_slot = user_slots[user_id] = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY_PER_USER)
+        user_waiters[user_id] = user_waiters.get(user_id, 0) + 1
+    try:
+        if user_slot:
+            await user_slot.acquire()
+        try:
+            async with global_slots:
+                wait = time.perf_counter() - start
+                stats["queue_wait"] += wait
+                stats["max_queue_wait"] = max(stats["max_queue_wait"], wait)
+                stats["in_flight"] += 1
+                try:
+                    yield
+                finally:
+                    stats["in_flight"] -= 1
+        finally:
+            if user_slot:
+                user_slot.release()
+    finally:
+        if user_id is not None:
+            user_waiters[user_id] -= 1
+            if not user_waiters[user_id]:
+                del user_waiters[user_id]
+                del user_slots[user_id]
+
+
+async def _call_with_retries(call: Callable[[float], Awaitable[T]], tier: int, timeout: float) -> T:
+    """
+    Run an OpenAI call on a tier within a deadline, retrying rate-limit and server errors.
+
+    Args:
+        call: Coroutine factory receiving the time left before the deadline
+        tier: Index of the tier whose circuit breaker accounts the call
+        timeout: Seconds for the call including retries
+
+    Returns:
+        The call's result
+    """
+    breaker = breakers[tier]
+    probing = breaker.check()
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                result = await asyncio.wait_for(call(remaining), timeout=remaining)
+                breaker.record(True)
+                return result
+            except asyncio.TimeoutError:
+                stats["timeouts"] += 1
+                breaker.record(False)
+                raise
+            except RETRYABLE_ERRORS as e:
+                if isinstance(e, RateLimitError):
+                    stats["rate_limited"] += 1
+                delay = _backoff_delay(e, attempt)
+                if attempt >= OPENAI_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                    breaker.record(False)
+                    raise
+                logger.warning(f"OpenAI request failed ({e.__class__.__name__}), retrying in {delay:.2f}s")
+                stats["retries"] += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+            except Exception:
+                # Client errors say nothing about the API's health
+                breaker.record(True)
+                raise
+    except asyncio.CancelledError:
+        # A cancelled probe says nothing about the API, let the next request probe
+        if probing:
+            breaker.probe = False
+        raise
+
+
+def _build_messages(prompt: str, context: Optional[List[dict]]) -> List[dict]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        *(context or []),
+        {"role": "user", "content": prompt}
+    ]
+
+
+def _record_usage(usage, tier: int) -> None:
+    """Account the tokens reported for a request answered by a tier."""
+    if usage is None:
+        return
+    name, model, _ = OPENAI_MODEL_TIERS[tier]
+    tier_stats = stats["tiers"][name]
+    for counter in (stats, tier_stats):
+        counter["prompt_tokens"] += usage.prompt_tokens
+        counter["completion_tokens"] += usage.completion_tokens
+    logger.info("GPT usage of %s: %s prompt tokens, %s completion tokens",
+                model, usage.prompt_tokens, usage.completion_tokens)
+
+
+def route_prompt(prompt: str, prompt_tokens: int, context_tokens: int = 0, source: str = "text") -> int:
+    """
+    Pick the model tier a prompt starts at from cheap local features.
+
+    Long prompts and prompts that are mostly formulas start at the last tier.
+    Photos, documents, prompts with formulas or code blocks and follow-ups with
+    a long context start at the second. Other short prompts, including one-line
+    code questions, start at the first. The context only decides between the
+    first two tiers, a long conversation alone doesn't call for the strongest
+    model.
+
+    Args:
+        prompt: The user prompt
+        prompt_tokens: Tokens of the prompt alone
+        context_tokens: Tokens the rest of the request adds, the system prompt
+            and the conversation context
+        source: Where the prompt came from: "text", "photo" (OCR) or "document"
+
+    Returns:
+        Index of the tier in OPENAI_MODEL_TIERS
+    """
+    if not ROUTING_ENABLED:
+        tier = LAST_TIER
+    else:
+        # Unpacked segments, the chunks of split_response mix code blocks into the text around them
+        tokenizer = ResponseTokenizer()
+        segments = tokenizer.feed(prompt) + tokenizer.close()
+        math = sum(len(segment.text) for segment in segments if segment.kind in MATH_KINDS)
+        math_share = math / len(prompt) if prompt else 0.0
+        code = any(segment.kind == CODE for segment in segments)
+        if prompt_tokens >= ROUTING_STRONG_MIN_TOKENS or math_share >= ROUTING_STRONG_MIN_MATH:
+            tier = LAST_TIER
+        elif (source != "text" or math or code or prompt_tokens > ROUTING_FAST_MAX_TOKENS
+              or context_tokens > ROUTING_FAST_MAX_CONTEXT_TOKENS):
+            tier = min(1, LAST_TIER)
+        else:
+            tier = 0
+        logger.info("Routed %s prompt to %s: %s tokens, %s context tokens, %.0f%% formulas, code %s",
+                    source, OPENAI_MODEL_TIERS[tier][0], prompt_tokens, context_tokens, math_share * 100, code)
+    stats["tiers"][OPENAI_MODEL_TIERS[tier][0]]["routed"] += 1
+    return tier
+
+
+async def _escalate(tier: int, attempt: Callable[[int, float], Awaitable[T]]) -> T:
+    """
+    Run a request on a tier and pass it on to the next tiers while it fails.
+
+    All tiers share one OPENAI_DEADLINE; each gets its own timeout or what is left
+    of the deadline, whichever is shorter. Tiers whose circuit breaker is open are
+    skipped.
+
+    Args:
+        tier: Index of the first tier to try
+        attempt: Coroutine factory running the request on the tier with the given
+            index within the given number of seconds
+
+    Returns:
+        The result of the first tier that succeeded
+    """
+    deadline = time.monotonic() + OPENAI_DEADLINE
+    while True:
+        name, model, tier_timeout = OPENAI_MODEL_TIERS[tier]
+        tier_stats = stats["tiers"][name]
+        tier_stats["attempts"] += 1
+        start = time.perf_counter()
+        try:
+            with timed(f"gpt_{name}"):
+                return await attempt(tier, min(tier_timeout, deadline - time.monotonic()))
+        except Exception as e:
+            if not isinstance(e, GptBusyError):
+                tier_stats["failures"] += 1
+            if tier >= LAST_TIER or deadline - time.monotonic() <= 0:
+                raise
+            tier += 1
+            stats["escalations"] += 1
+            logger.warning(f"{model} failed ({e.__class__.__name__}), escalating to {OPENAI_MODEL_TIERS[tier][1]}")
+        finally:
+            tier_stats["latency"] += time.perf_counter() - start
+
+
+async def get_gpt_response(
+    prompt: str,
+    user_id: Optional[int] = None,
+    context: Optional[List[dict]] = None,
+    tier: int = LAST_TIER,
+) -> str:
     """
     Get a response from the OpenAI GPT model.
 
     Args:
         prompt: The user prompt to send to the model
+        user_id: Telegram id of the user, for the per-user request limit
+        context: Earlier messages of the conversation, sent before the prompt
+        tier: Model tier to start at, see route_prompt
 
     Returns:
         The model's response text
     """
-    try:
-        response = await client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ],
-            model=OPENAI_MODEL,
-        )
+    messages = _build_messages(prompt, context)
+
+    async def attempt(tier: int, timeout: float) -> str:
+        model = OPENAI_MODEL_TIERS[tier][1]
+        response = await _call_with_retries(lambda remaining: client.chat.completions.create(
+            messages=messages,
+            model=model,
+            timeout=remaining,
+        ), tier, timeout)
+        _record_usage(response.usage, tier)
         return response.choices[0].message.content
+
+    stats["requests"] += 1
+    try:
+        with timed("gpt"):
+            async with _request_slot(user_id):
+                return await _escalate(tier, attempt)
     except Exception as e:
         logger.error(f"Error getting GPT response: {e}")
-        raise
\ No newline at end of file
+        raise
+
+
+async def _open_stream(messages: List[dict], tier: int, timeout: float) -> Tuple[AsyncIterator, str]:
+    """
+    Open a streamed response on a tier and wait for its first text within a timeout.
+
+    Returns:
+        The remaining chunks of the stream and the first piece of text
+    """
+    model = OPENAI_MODEL_TIERS[tier][1]
+    deadline = time.monotonic() + timeout
+    stream = await _call_with_retries(lambda remaining: client.chat.completions.create(
+        messages=messages,
+        model=model,
+        stream=True,
+        stream_options={"include_usage": True},
+        timeout=remaining,
+    ), tier, timeout)
+    chunks = stream.__aiter__()
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), timeout=deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                stats["timeouts"] += 1
+                raise
+            except StopAsyncIteration:
+                return chunks, ""
+            _record_usage(chunk.usage, tier)
+            if chunk.choices and chunk.choices[0].delta.content:
+                return chunks, chunk.choices[0].delta.content
+    except BaseException:
+        await stream.close()
+        raise
+
+
+async def stream_gpt_response(
+    prompt: str,
+    user_id: Optional[int] = None,
+    context: Optional[List[dict]] = None,
+    tier: int = LAST_TIER,
+) -> AsyncIterator[str]:
+    """
+    Stream a response from the OpenAI GPT model.
+
+    A tier can only be escalated from until its first text arrives, after that
+    the response is streamed to the end. The tier latencies of streams are
+    therefore their times to first text.
+
+    Args:
+        prompt: The user prompt to send to the model
+        user_id: Telegram id of the user, for the per-user request limit
+        context: Earlier messages of the conversation, sent before the prompt
+        tier: Model tier to start at, see route_prompt
+
+    Yields:
+        Pieces of the response text as they arrive
+    """
+    messages = _build_messages(prompt, context)
+    answered_by = tier
+
+    async def attempt(tier: int, timeout: float) -> Tuple[AsyncIterator, str]:
+        nonlocal answered_by
+        answered_by = tier
+        return await _open_stream(messages, tier, timeout)
+
+    stats["requests"] += 1
+    start = time.perf_counter()
+    first_token = None
+    try:
+        async with _request_slot(user_id):
+            chunks, delta = await _escalate(tier, attempt)
+            first_token = time.perf_counter() - start
+            if delta:
+                yield delta
+            async for chunk in chunks:
+                # Usage arrives in a final chunk without choices
+                _record_usage(chunk.usage, answered_by)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+    except Exception as e:
+        count_error("gpt", e)
+        logger.error(f"Error streaming GPT response: {e}")
+        raise
+    finally:
+        complete = time.perf_counter() - start
+        observe("gpt", complete)
+        if first_token is not None:
+            observe("gpt_first_token", first_token)
+            logger.info("GPT stream: time to first token %.2fs, time to complete %.2fs", first_token, complete)
+
+
+async def summarize_conversation(summary: str, turns: List[Dict[str, str]]) -> str:
+    """
+    Condense earlier turns of a conversation into a short summary.
+
+    Args:
+        summary: Summary of the turns before these, may be empty
+        turns: Messages of the turns to add to the summary, oldest first
+
+    Returns:
+        The new summary
+    """
+    transcript = "\n\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    if summary:
+        transcript = f"Previous summary: {summary}\n\n{transcript}"
+    messages = [
+        {"role": "system", "content": CONTEXT_SUMMARY_PROMPT},
+        {"role": "user", "content": transcript}
+    ]
+
+    async def attempt(tier: int, timeout: float) -> str:
+        model = OPENAI_MODEL_TIERS[tier][1]
+        response = await _call_with_retries(lambda remaining: client.chat.completions.create(
+            messages=messages,
+            model=model,
+            max_tokens=CONTEXT_SUMMARY_MAX_TOKENS,
+            timeout=remaining,
+        ), tier, timeout)
+        _record_usage(response.usage, tier)
+        return response.choices[0].message.content
+
+    stats["requests"] += 1
+    # Summaries are simple, the fastest tier is enough
+    with timed("gpt_summary"):
+        async with _request_slot(None):
+            return await _escalate(0, attempt)
+
+
+def get_gpt_stats() -> dict:
+    """Return in-flight count, queue wait, retry counters and per-tier latency and usage of the OpenAI gateway."""
+    return {
+        **stats,
+        "tiers": {
+            name: {
+                **tier_stats,
+                "avg_latency": tier_stats["latency"] / tier_stats["attempts"] if tier_stats["attempts"] else 0.0,
+                "failure_rate": tier_stats["failures"] / tier_stats["attempts"] if tier_stats["attempts"] else 0.0,
+            }
+            for name, tier_stats in stats["tiers"].items()
+        },
+        "avg_queue_wait": stats["queue_wait"] / stats["requests"] if stats["requests"] else 0.0,
+        "breaker_open": [breaker.name for breaker in breakers if breaker.is_open()],
+    }
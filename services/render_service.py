@@ -0,0 +1,298 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple
+
+from config import (
+    MATPLOTLIB_CONFIG,
+    RENDER_POOL_SIZE,
+    RENDER_QUEUE_SIZE,
+    RENDER_TIMEOUT,
+    RENDER_FONTSIZE,
+    RENDER_MIN_DPI,
+    RENDER_MAX_DPI,
+    RENDER_MAX_WIDTH,
+    RENDER_PADDING,
+)
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects photos more than this many times wider than high
+MAX_ASPECT_RATIO = 20
+# Average width of a rendered character relative to the font size, to size usetex renders
+CHAR_WIDTH = 0.6
+
+# Common LaTeX spellings mathtext doesn't know, with equivalents it does
+MATHTEXT_REWRITES = [(re.compile(pattern + r"(?![a-zA-Z])"), replacement) for pattern, replacement in (
+    (r"\\(?:displaystyle|textstyle|limits)", ""),
+    (r"\\tfrac", r"\\frac"),
+    (r"\\[lr]vert", "|"),
+    (r"\\[lr]Vert", r"\\Vert"),
+    (r"\\implies", r"\\Longrightarrow"),
+    (r"\\impliedby", r"\\Longleftarrow"),
+    (r"\\iff", r"\\Longleftrightarrow"),
+    (r"\\le", r"\\leq"),
+    (r"\\ge", r"\\geq"),
+    (r"\\bmod", r"\\,\\mathrm{mod}\\,"),
+    (r"\\pmod\{([^{}]*)\}", r"\\;(\\mathrm{mod}\\ \1)"),
+)]
+
+# Global pool state
+executor: Optional[ProcessPoolExecutor] = None
+slots: Optional[asyncio.Semaphore] = None
+# One permit per worker process, held while a render runs in it
+workers: Optional[asyncio.Semaphore] = None
+
+stats = {
+    "mathtext": 0,
+    "usetex": 0,
+}
+
+# Per-worker figure and mathtext parser, created once by the pool initializer and reused for every render
+_figure = None
+_parser = None
+
+
+def _init_worker(rc_params: dict) -> None:
+    """Configure matplotlib and create the reusable figure inside a worker process."""
+    global _figure, _parser
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.mathtext import MathTextParser
+
+    plt.rcParams.update(rc_params)
+    _figure = plt.figure()
+    _parser = MathTextParser("path")
+
+
+def to_mathtext(latex_expr: str) -> str:
+    """Rewrite a $...$ or $$...$$ formula into the form mathtext parses."""
+    body = latex_expr.strip().strip("$")
+    for pattern, replacement in MATHTEXT_REWRITES:
+        body = pattern.sub(replacement, body)
+    return f"${body}$"
+
+
+def _pick_dpi(width: float) -> float:
+    """Resolution at which a formula width points wide fits RENDER_MAX_WIDTH pixels."""
+    return max(RENDER_MIN_DPI, min(RENDER_MAX_DPI, RENDER_MAX_WIDTH * 72 / max(width, 1)))
+
+
+def _mathtext_size(expr: str, fontsize: int) -> Optional[Tuple[float, float, float]]:
+    """
+    Lay out a formula with mathtext without drawing it.
+
+    Returns:
+        Width, height and depth in points, or None if mathtext can't handle the formula
+    """
+    from matplotlib.font_manager import FontProperties
+
+    try:
+        width, height, depth, _, _ = _parser.parse(expr, dpi=72, prop=FontProperties(size=fontsize))
+    except ValueError:
+        return None
+    return width, height, depth
+
+
+def _render_mathtext(expr: str, fontsize: int, size: Tuple[float, float, float]) -> bytes:
+    """Draw a formula with mathtext on a figure of exactly its size, without a layout pass."""
+    import numpy as np
+    from PIL import Image
+    from matplotlib.font_manager import FontProperties
+
+    width, height, depth = size
+    fig_width = width + 2 * RENDER_PADDING
+    fig_height = max(height + 2 * RENDER_PADDING, fig_width / MAX_ASPECT_RATIO)
+    bottom = (fig_height - height) / 2
+
+    _figure.clear()
+    _figure.set_size_inches(fig_width / 72, fig_height / 72)
+    _figure.set_dpi(_pick_dpi(fig_width))
+    _figure.text(RENDER_PADDING / fig_width, (bottom + depth) / fig_height, expr,
+                 fontproperties=FontProperties(size=fontsize), usetex=False)
+    try:
+        _figure.canvas.draw()
+        pixels = np.asarray(_figure.canvas.buffer_rgba())
+    finally:
+        _figure.clear()
+
+    # Formulas are black on white, a grayscale PNG is a fraction of the size
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).convert("L").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _render_usetex(latex_expr: str, fontsize: int) -> bytes:
+    """Render a formula with LaTeX, sized by an estimate of its width."""
+    visible = re.sub(r"\\[a-zA-Z]+|[{}^_$\s]", lambda m: "x" if len(m.group()) > 1 else "", latex_expr)
+    dpi = _pick_dpi(len(visible) * fontsize * CHAR_WIDTH)
+
+    _figure.clear()
+    _figure.text(0.5, 0.5, latex_expr, fontsize=fontsize, ha='center', va='center', usetex=True)
+    buffer = io.BytesIO()
+    try:
+        _figure.savefig(buffer, format='png', dpi=dpi, bbox_inches='tight', pad_inches=RENDER_PADDING / 72)
+    finally:
+        _figure.clear()
+    return buffer.getvalue()
+
+
+def _render_png(latex_expr: str, fontsize: int) -> Tuple[bytes, bool]:
+    """
+    Render a LaTeX expression on the worker's figure.
+
+    mathtext is tried first, in-process. Formulas its parser rejects are rendered
+    with LaTeX, so the decision costs a parse, never a second render.
+
+    Returns:
+        PNG bytes and whether LaTeX was used
+    """
+    expr = to_mathtext(latex_expr)
+    size = _mathtext_size(expr, fontsize)
+    if size is not None:
+        try:
+            return _render_mathtext(expr, fontsize, size), False
+        except Exception:
+            # A parsed formula may still fail to draw, e.g. for a missing glyph
+            pass
+    return _render_usetex(latex_expr, fontsize), True
+
+
+def _warm_up_worker() -> bool:
+    """Load mathtext fonts and the LaTeX toolchain, returning whether LaTeX works."""
+    _render_png(r"$x^2$", RENDER_FONTSIZE)
+    try:
+        _render_usetex(r"$x^2$", RENDER_FONTSIZE)
+        return True
+    except Exception:
+        return False
+
+
+def _create_executor() -> ProcessPoolExecutor:
+    """Create a fresh pool of renderer processes."""
+    return ProcessPoolExecutor(
+        max_workers=RENDER_POOL_SIZE,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(MATPLOTLIB_CONFIG,),
+    )
+
+
+def _kill_executor(pool: ProcessPoolExecutor) -> None:
+    """Terminate every worker of a pool, including ones stuck in a render."""
+    for process in list((pool._processes or {}).values()):
+        if process.is_alive():
+            process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def init_renderer() -> None:
+    """Start the renderer process pool."""
+    global executor, slots, workers
+    executor = _create_executor()
+    slots = asyncio.Semaphore(RENDER_POOL_SIZE + RENDER_QUEUE_SIZE)
+    workers = asyncio.Semaphore(RENDER_POOL_SIZE)
+    logger.info(f"Renderer started with {RENDER_POOL_SIZE} workers")
+
+
+async def warm_up_renderer() -> None:
+    """Start every renderer process and render a sample formula to warm the LaTeX toolchain."""
+    if executor is None:
+        init_renderer()
+    loop = asyncio.get_running_loop()
+    usetex = await asyncio.gather(*(
+        loop.run_in_executor(executor, _warm_up_worker)
+        for _ in range(RENDER_POOL_SIZE)
+    ))
+    if not all(usetex):
+        logger.warning("LaTeX is not available, formulas mathtext can't handle will fail to render")
+    logger.info("Renderer warmed up")
+
+
+def close_renderer() -> None:
+    """Stop the renderer process pool."""
+    global executor
+    if executor:
+        executor.shutdown(wait=True, cancel_futures=True)
+        executor = None
+        logger.info("Renderer stopped")
+
+
+def _restart_renderer(pool: ProcessPoolExecutor) -> None:
+    """Replace a stuck or broken pool with a fresh one."""
+    global executor
+    if executor is not pool:
+        # Another request already restarted it
+        return
+    _kill_executor(pool)
+    executor = _create_executor()
+    logger.warning("Renderer pool restarted")
+
+
+def _release_worker(future: asyncio.Future) -> None:
+    """Free a worker once its render has ended, however it ended."""
+    if not future.cancelled():
+        # Mark the exception retrieved, the request that waited for it may be gone
+        future.exception()
+    workers.release()
+
+
+async def render_latex(latex_expr: str, fontsize: int = RENDER_FONTSIZE) -> bytes:
+    """
+    Render a LaTeX expression to PNG bytes in the worker pool.
+
+    The resolution is picked from the formula's width, so short formulas are
+    sharp and long ones still fit a Telegram photo.
+
+    Args:
+        latex_expr: LaTeX expression to render
+        fontsize: Font size of the rendered text
+
+    Returns:
+        PNG image bytes
+    """
+    if executor is None:
+        init_renderer()
+
+    if slots.locked():
+        raise RuntimeError("Renderer queue is full")
+
+    async with slots:
+        # Wait for a free worker before starting the clock, so time spent queued
+        # behind other renders doesn't count against RENDER_TIMEOUT
+        await workers.acquire()
+        pool = executor
+        try:
+            future = asyncio.get_running_loop().run_in_executor(pool, _render_png, latex_expr, fontsize)
+        except BaseException:
+            workers.release()
+            raise
+        # The worker stays busy until the render ends, even if this request is cancelled
+        future.add_done_callback(_release_worker)
+        try:
+            png, usetex = await asyncio.wait_for(asyncio.shield(future), timeout=RENDER_TIMEOUT)
+        except asyncio.TimeoutError:
+            # The render has been running in a worker for the whole timeout, it is stuck
+            logger.error(f"Rendering timed out after {RENDER_TIMEOUT}s, restarting renderer")
+            _restart_renderer(pool)
+            raise
+        except BrokenProcessPool:
+            logger.error("Renderer worker died, restarting renderer")
+            _restart_renderer(pool)
+            raise
+        stats["usetex" if usetex else "mathtext"] += 1
+        return png
+
+
+def get_render_stats() -> dict:
+    """Return how many formulas were rendered with mathtext and with LaTeX."""
+    total = stats["mathtext"] + stats["usetex"]
+    return {
+        **stats,
+        "mathtext_rate": stats["mathtext"] / total if total else 0.0,
+    }
@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from config import (
+    OPENAI_MODEL,
+    SYSTEM_PROMPT,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_MAX_ROWS,
+    RESPONSE_CACHE_MEMORY_ITEMS,
+)
+from database.db_manager import get_cached_response, save_cached_response, get_cache_opt_outs, set_cache_opt_out
+
+logger = logging.getLogger(__name__)
+
+# Hot tier: key -> (response, created_at), most recently used last
+memory_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+# Requests currently waiting on GPT: key -> future with the response
+in_flight: Dict[str, asyncio.Future] = {}
+# Users who disabled caching
+opted_out: Set[int] = set()
+
+stats = {
+    "memory_hits": 0,
+    "db_hits": 0,
+    "collapsed": 0,
+    "misses": 0,
+    "bypassed": 0,
+}
+
+# LaTeX spacing commands that don't change the meaning of a prompt
+_LATEX_SPACING = re.compile(r"\\[,;:! ]|\\q?quad\b")
+_SPACE_AROUND_SYMBOLS = re.compile(r"\s*([{}()\[\]^_=+\-*/<>,])\s*")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def init_response_cache() -> None:
+    """Load the users who opted out of response caching."""
+    opted_out.clear()
+    opted_out.update(get_cache_opt_outs())
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalize whitespace and LaTeX spacing so equivalent prompts share a cache entry."""
+    prompt = _LATEX_SPACING.sub(" ", prompt)
+    prompt = _WHITESPACE.sub(" ", prompt).strip()
+    return _SPACE_AROUND_SYMBOLS.sub(r"\1", prompt)
+
+
+def response_key(prompt: str, model: str = OPENAI_MODEL) -> str:
+    """
+    Build the cache key of a prompt.
+
+    Args:
+        prompt: The user prompt
+        model: The model answering the prompt
+
+    Returns:
+        Hex digest identifying the response
+    """
+    payload = f"{model}\0{SYSTEM_PROMPT}\0{normalize_prompt(prompt)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_cache_enabled(user_id: int) -> bool:
+    """Check whether responses for a user may be served from the cache."""
+    return user_id not in opted_out
+
+
+async def set_cache_enabled(user_id: int, enabled: bool) -> None:
+    """Opt a user in or out of response caching."""
+    if enabled:
+        opted_out.discard(user_id)
+    else:
+        opted_out.add(user_id)
+    await set_cache_opt_out(user_id, not enabled)
+
+
+def _lookup(key: str) -> Optional[str]:
+    now = time.time()
+    entry = memory_cache.get(key)
+    if entry is not None:
+        response, created_at = entry
+        if now - created_at < RESPONSE_CACHE_TTL:
+            memory_cache.move_to_end(key)
+            stats["memory_hits"] += 1
+            return response
+        del memory_cache[key]
+
+    row = get_cached_response(key, int(now - RESPONSE_CACHE_TTL))
+    if row is None:
+        return None
+    response, created_at = row
+    # Keep the row's age, so the entry expires from memory when it does in the database
+    _remember(key, response, created_at)
+    stats["db_hits"] += 1
+    return response
+
+
+def _remember(key: str, response: str, created_at: float) -> None:
+    memory_cache[key] = (response, created_at)
+    memory_cache.move_to_end(key)
+    while len(memory_cache) > RESPONSE_CACHE_MEMORY_ITEMS:
+        memory_cache.popitem(last=False)
+
+
+async def get_or_create_response(
+    prompt: str,
+    user_id: int,
+    create: Callable[[], Awaitable[str]],
+    model: str = OPENAI_MODEL,
+) -> Tuple[str, bool]:
+    """
+    Return a cached response for a prompt, or create it once.
+
+    Identical prompts that arrive while a response is being created wait for
+    that response instead of calling GPT again.
+
+    Args:
+        prompt: The user prompt
+        user_id: Telegram id of the user asking
+        create: Coroutine factory that gets the response from GPT
+        model: The model the prompt is sent to first
+
+    Returns:
+        The response and whether it was created by this call
+    """
+    if not is_cache_enabled(user_id):
+        stats["bypassed"] += 1
+        return await create(), True
+
+    key = response_key(prompt, model)
+    cached = _lookup(key)
+    if cached is not None:
+        return cached, False
+
+    waiting = in_flight.get(key)
+    while waiting is not None:
+        try:
+            response = await asyncio.shield(waiting)
+            stats["collapsed"] += 1
+            return response, False
+        except asyncio.CancelledError:
+            # The task creating the response was cancelled, not this one: try again
+            if not waiting.cancelled():
+                raise
+        waiting = in_flight.get(key)
+
+    stats["misses"] += 1
+    future = asyncio.get_running_loop().create_future()
+    in_flight[key] = future
+    try:
+        response = await create()
+        future.set_result(response)
+        _remember(key, response, time.time())
+        await save_cached_response(key, response, RESPONSE_CACHE_MAX_ROWS)
+        return response, True
+    except Exception as e:
+        if future.done():
+            raise
+        future.set_exception(e)
+        # Mark the exception as retrieved in case nobody else was waiting
+        future.exception()
+        raise
+    finally:
+        # Wake up the waiters if this task was cancelled before the response was created
+        if not future.done():
+            future.cancel()
+        del in_flight[key]
+
+
+def get_response_cache_stats() -> dict:
+    """Return hit and miss counters along with the hit rate."""
+    hits = stats["memory_hits"] + stats["db_hits"] + stats["collapsed"]
+    lookups = hits + stats["misses"]
+    return {
+        **stats,
+        "hit_rate": hits / lookups if lookups else 0.0,
+        "memory_items": len(memory_cache),
+    }
@@ -0,0 +1,288 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, SendMediaGroup, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from config import SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_MAX_RETRIES, SEND_BUCKET_SWEEP_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Send priorities, lower is served first
+INTERACTIVE = 0
+BULK = 1
+
+send_priority: contextvars.ContextVar[int] = contextvars.ContextVar("send_priority", default=INTERACTIVE)
+
+
+class TokenBucket:
+    """Token bucket allowing `rate` requests per second with bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost: float = 1) -> float:
+        """Seconds until a request of the given cost may be sent."""
+        now = time.monotonic()
+        self._refill(now)
+        needed = min(cost, self.capacity)
+        wait = max(0.0, (needed - self.tokens) / self.rate)
+        return max(wait, self.blocked_until - now)
+
+    def take(self, cost: float = 1) -> None:
+        """Spend tokens for a request, the balance may go negative for large requests."""
+        self._refill(time.monotonic())
+        self.tokens -= cost
+
+    def idle(self, now: float) -> bool:
+        """Whether the bucket is full again, so forgetting it changes nothing."""
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+    def block(self, seconds: float) -> None:
+        """Stop granting tokens for a while, e.g. after a flood-control error."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0)
+
+
+# Global scheduler state
+global_bucket: Optional[TokenBucket] = None
+# Buckets of chats sent to recently, each process has its own, see SEND_CHAT_RATE
+chat_buckets: Dict[int, TokenBucket] = {}
+last_sweep = 0.0
+# Waiting requests per chat and priority: chat id -> [interactive, bulk] queues of (future, cost)
+waiting: Dict[int, List[Deque[Tuple[asyncio.Future, int]]]] = {}
+# Round-robin order of chats with waiting requests
+chat_order: Deque[int] = deque()
+wakeup: Optional[asyncio.Event] = None
+scheduler_task: Optional[asyncio.Task] = None
+
+stats = {
+    "scheduled": 0,
+    "queue_wait": 0.0,
+    "max_queue_wait": 0.0,
+    "throttled": 0,
+    "global_throttled": 0,
+    "retry_after": 0,
+    "retries": 0,
+    "cancelled": 0,
+    "evicted_buckets": 0,
+}
+
+
+@contextmanager
+def priority(level: int) -> Iterator[None]:
+    """Send requests made inside the block with the given priority."""
+    token = send_priority.set(level)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+def init_send_scheduler(global_rate: float = SEND_GLOBAL_RATE) -> None:
+    """
+    Start the scheduler that releases queued sends.
+
+    Args:
+        global_rate: Messages per second this process may send across all chats
+    """
+    global global_bucket, wakeup, scheduler_task
+    global_bucket = TokenBucket(global_rate, global_rate)
+    wakeup = asyncio.Event()
+    scheduler_task = asyncio.create_task(_schedule_loop())
+    logger.info("Send scheduler started")
+
+
+def close_send_scheduler() -> None:
+    """Stop the scheduler."""
+    global scheduler_task
+    if scheduler_task:
+        scheduler_task.cancel()
+        scheduler_task = None
+        logger.info("Send scheduler stopped")
+
+
+def _chat_bucket(chat_id: int) -> TokenBucket:
+    bucket = chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = chat_buckets[chat_id] = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+    return bucket
+
+
+def _forget_chat_if_empty(chat_id: int) -> None:
+    queues = waiting[chat_id]
+    if not queues[INTERACTIVE] and not queues[BULK]:
+        del waiting[chat_id]
+        chat_order.remove(chat_id)
+
+
+def _pick() -> Tuple[Optional[int], int, float]:
+    """
+    Find the next chat whose request may be sent now.
+
+    Interactive requests of any chat go before bulk ones, and chats take turns
+    within a priority so one long answer can't starve the others. Requests
+    cancelled while waiting are dropped on the way, without spending tokens.
+
+    Returns:
+        The chat id and the priority of the request to send, or None with the
+        seconds until one becomes ready
+    """
+    soonest = float("inf")
+    emptied = []
+    picked = None
+    for level in (INTERACTIVE, BULK):
+        for _ in range(len(chat_order)):
+            chat_id = chat_order[0]
+            chat_order.rotate(-1)
+            queue = waiting[chat_id][level]
+            while queue and queue[0][0].done():
+                queue.popleft()
+                stats["cancelled"] += 1
+                emptied.append(chat_id)
+            if not queue:
+                continue
+            delay = _chat_bucket(chat_id).delay(queue[0][1])
+            if delay <= 0:
+                picked = chat_id, level, 0.0
+                break
+            soonest = min(soonest, delay)
+        if picked:
+            break
+    for chat_id in set(emptied):
+        _forget_chat_if_empty(chat_id)
+    return picked or (None, INTERACTIVE, soonest)
+
+
+def _evict_idle_buckets() -> None:
+    """Forget the buckets of chats without waiting requests that have refilled."""
+    global last_sweep
+    now = time.monotonic()
+    if now - last_sweep < SEND_BUCKET_SWEEP_INTERVAL:
+        return
+    last_sweep = now
+    idle = [chat_id for chat_id, bucket in chat_buckets.items()
+            if chat_id not in waiting and bucket.idle(now)]
+    for chat_id in idle:
+        del chat_buckets[chat_id]
+    stats["evicted_buckets"] += len(idle)
+
+
+async def _schedule_loop() -> None:
+    """Release waiting requests as the per-chat and global buckets allow."""
+    while True:
+        _evict_idle_buckets()
+        if not chat_order:
+            wakeup.clear()
+            await wakeup.wait()
+            continue
+
+        chat_id, level, delay = _pick()
+        if chat_id is None:
+            if not chat_order:
+                # Only cancelled requests were waiting
+                continue
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        queues = waiting[chat_id]
+        future, cost = queues[level][0]
+
+        global_delay = global_bucket.delay(cost)
+        if global_delay > 0:
+            stats["global_throttled"] += 1
+            await asyncio.sleep(global_delay)
+            continue
+
+        # _pick dropped cancelled requests, so the future is still pending
+        queues[level].popleft()
+        _forget_chat_if_empty(chat_id)
+        _chat_bucket(chat_id).take(cost)
+        global_bucket.take(cost)
+        future.set_result(None)
+
+
+async def acquire(chat_id: int, cost: int = 1) -> None:
+    """
+    Wait until a request to a chat may be sent.
+
+    Args:
+        chat_id: Chat the request goes to
+        cost: Number of messages the request sends
+    """
+    if scheduler_task is None:
+        return
+
+    start = time.perf_counter()
+    future = asyncio.get_running_loop().create_future()
+    if chat_id not in waiting:
+        waiting[chat_id] = [deque(), deque()]
+        chat_order.append(chat_id)
+    waiting[chat_id][send_priority.get()].append((future, cost))
+    wakeup.set()
+
+    await future
+    wait = time.perf_counter() - start
+    stats["scheduled"] += 1
+    stats["queue_wait"] += wait
+    stats["max_queue_wait"] = max(stats["max_queue_wait"], wait)
+    if wait > 0.05:
+        stats["throttled"] += 1
+
+
+def get_send_stats() -> dict:
+    """Return queue wait times and throttle counters."""
+    return {
+        **stats,
+        "waiting": sum(len(q) for queues in waiting.values() for q in queues),
+        "chat_buckets": len(chat_buckets),
+        "avg_queue_wait": stats["queue_wait"] / stats["scheduled"] if stats["scheduled"] else 0.0,
+    }
+
+
+class SendSchedulerMiddleware(BaseRequestMiddleware):
+    """Bot session middleware passing every chat-bound request through the scheduler."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if not isinstance(chat_id, int):
+            return await make_request(bot, method)
+
+        cost = len(method.media) if isinstance(method, SendMediaGroup) else 1
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            await acquire(chat_id, cost)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                stats["retry_after"] += 1
+                if attempt == SEND_MAX_RETRIES:
+                    raise
+                logger.warning(f"Flood control in chat {chat_id}, retrying in {e.retry_after}s")
+                _chat_bucket(chat_id).block(e.retry_after)
+                stats["retries"] += 1
@@ -0,0 +1,283 @@
+import asyncio
+import logging
+import multiprocessing
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from config import (
+    SOLVER_ENABLED,
+    SOLVER_WORKERS,
+    SOLVER_TIMEOUT,
+    SOLVER_MAX_PROMPT_LENGTH,
+    SOLVER_MEMORY_LIMIT,
+)
+from utils.metrics import observe, mean
+
+logger = logging.getLogger(__name__)
+
+# LaTeX commands, differentials such as dx, and what is left of words once they are removed
+_COMMAND = re.compile(r"\\[a-zA-Z]+")
+_DIFFERENTIAL = re.compile(r"(?<![^\W\d_])d[a-z](?![^\W\d_])")
+_WORD = re.compile(r"[^\W\d_]{2,}")
+# Math delimiters and trailing punctuation around a formula
+_DELIMITERS = re.compile(r"^(?:\$\$?|\\\[|\\\()|(?:\$\$?|\\\]|\\\))?[.,;]?$")
+
+# Global pool state
+executor: Optional[ProcessPoolExecutor] = None
+slots: Optional[asyncio.Semaphore] = None
+# Set once the workers have imported SymPy, prompts arriving before that go to GPT
+ready = False
+warmup_task: Optional[asyncio.Task] = None
+
+stats = {
+    "prompts": 0,
+    "attempts": 0,
+    "solved": 0,
+    "unsolved": 0,
+    "timeouts": 0,
+    "skipped": 0,
+    "solve_time": 0.0,
+    "fallthrough_time": 0.0,
+}
+
+
+def _init_worker() -> None:
+    """Limit the worker's memory and import SymPy's LaTeX parser, which takes about a second."""
+    import resource
+    from sympy.parsing.latex import parse_latex
+
+    limit = SOLVER_MEMORY_LIMIT * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    parse_latex("1")
+
+
+def _warm_up_worker() -> bool:
+    """No-op task whose completion means the worker has imported SymPy."""
+    return True
+
+
+def is_candidate(prompt: str) -> bool:
+    """Check whether a prompt is short and consists of math only, with no words around it."""
+    if len(prompt) > SOLVER_MAX_PROMPT_LENGTH:
+        return False
+    rest = _DIFFERENTIAL.sub(" ", _COMMAND.sub(" ", prompt))
+    return not _WORD.search(rest) and any(c.isdigit() or c in "=^\\" for c in prompt)
+
+
+def _formula_lines(prompt: str) -> List[str]:
+    """Split a prompt into formulas, one per line, without their delimiters."""
+    lines = []
+    for line in prompt.split("\n"):
+        line = _DELIMITERS.sub("", line.strip()).strip()
+        if line:
+            lines.append(line)
+    return lines
+
+
+def _format_solutions(solutions: List[dict]) -> Optional[str]:
+    """Format real solutions returned by sympy.solve(..., dict=True), None if they aren't all explicit."""
+    from sympy import RootOf, latex
+
+    # solve returns nothing for equations it can't handle as well as for ones without roots
+    if not solutions:
+        return None
+    formatted = []
+    for solution in solutions:
+        if any(value.free_symbols or value.has(RootOf) or not value.is_real for value in solution.values()):
+            return None
+        formatted.append(", ".join(f"{latex(symbol)} = {latex(value)}"
+                                   for symbol, value in sorted(solution.items(), key=lambda item: str(item[0]))))
+    return "$$" + r", \quad ".join(formatted) + "$$"
+
+
+def _solve(prompt: str) -> Optional[str]:
+    """
+    Evaluate, differentiate, integrate or solve a math prompt with SymPy.
+
+    Returns:
+        The answer as text with $$...$$ formulas, or None if the prompt is not
+        something SymPy can answer on its own
+    """
+    from sympy import Derivative, Eq, Integral, Limit, Product, Sum, Symbol, latex, nan, pi, simplify, solve, zoo
+    from sympy.parsing.latex import parse_latex
+
+    unevaluated = (Derivative, Integral, Limit, Sum, Product)
+    try:
+        # The parser reads \pi as a variable
+        exprs = [parse_latex(line).subs(Symbol("pi"), pi) for line in _formula_lines(prompt)]
+        if not exprs:
+            return None
+
+        if all(isinstance(expr, Eq) for expr in exprs):
+            symbols = sorted(set().union(*(expr.free_symbols for expr in exprs)), key=str)
+            # A single equation in several unknowns has no one answer
+            if not symbols or len(symbols) > len(exprs):
+                return None
+            answer = _format_solutions(solve(exprs, symbols, dict=True))
+            if answer is None:
+                return None
+            # The parser nests sums to the left, evaluating the sides prints them as written
+            system = "\n".join(f"$${latex(Eq(expr.lhs.doit(), expr.rhs.doit(), evaluate=False))}$$" for expr in exprs)
+            return f"{system}\n{answer}"
+
+        if len(exprs) > 1:
+            return None
+        expr = exprs[0]
+        if expr.free_symbols and not expr.has(*unevaluated):
+            # Nothing to compute in an expression with unknowns, the user wants something GPT can tell
+            return None
+        value = simplify(expr.doit())
+        if value.has(*unevaluated, nan, zoo):
+            return None
+        if latex(value) == latex(expr):
+            return None
+        result = f"{latex(expr)} = {latex(value)}"
+        if isinstance(expr, Integral) and any(len(limits) == 1 for limits in expr.limits):
+            result += " + C"
+        if value.is_number and value.is_finite and not value.is_Rational:
+            result += rf" \approx {latex(value.evalf(10))}"
+        return f"$${result}$$"
+    except Exception:
+        return None
+
+
+def _create_executor() -> ProcessPoolExecutor:
+    """Create a fresh pool of solver processes."""
+    return ProcessPoolExecutor(
+        max_workers=SOLVER_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+    )
+
+
+def _kill_executor(pool: ProcessPoolExecutor) -> None:
+    """Terminate every worker of a pool, including ones stuck in a computation."""
+    for process in list((pool._processes or {}).values()):
+        if process.is_alive():
+            process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def init_solver() -> None:
+    """Start the solver process pool."""
+    global executor, slots
+    if not SOLVER_ENABLED:
+        return
+    executor = _create_executor()
+    slots = asyncio.Semaphore(SOLVER_WORKERS)
+    logger.info(f"Solver started with {SOLVER_WORKERS} workers")
+
+
+async def warm_up_solver() -> None:
+    """Start every solver process so SymPy is imported before the first prompt arrives."""
+    global ready
+    if executor is None:
+        return
+    pool = executor
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(*(loop.run_in_executor(pool, _warm_up_worker) for _ in range(SOLVER_WORKERS)))
+    except Exception as e:
+        logger.error(f"Error warming up solver: {e}")
+        return
+    if pool is executor:
+        ready = True
+        logger.info("Solver warmed up")
+
+
+def close_solver() -> None:
+    """Stop the solver process pool."""
+    global executor, ready, warmup_task
+    ready = False
+    if warmup_task:
+        warmup_task.cancel()
+        warmup_task = None
+    if executor:
+        _kill_executor(executor)
+        executor = None
+        logger.info("Solver stopped")
+
+
+def _restart_solver(pool: ProcessPoolExecutor) -> None:
+    """Replace a stuck or broken pool with a fresh one, warmed up in the background."""
+    global executor, ready, warmup_task
+    if executor is not pool:
+        # Another request already restarted it
+        return
+    ready = False
+    _kill_executor(pool)
+    executor = _create_executor()
+    warmup_task = asyncio.create_task(warm_up_solver())
+    logger.warning("Solver pool restarted")
+
+
+async def solve(prompt: str) -> Optional[str]:
+    """
+    Answer a plain math prompt locally, without GPT.
+
+    Prompts that aren't math only, arrive while every worker is busy, or can't
+    be answered within SOLVER_TIMEOUT return None and should go to GPT, so the
+    solver never delays a prompt by more than its budget.
+
+    Args:
+        prompt: The user prompt, e.g. an equation recognized in a photo
+
+    Returns:
+        The answer as text with $$...$$ formulas, or None
+    """
+    global warmup_task
+    stats["prompts"] += 1
+    if not SOLVER_ENABLED or not is_candidate(prompt):
+        return None
+    if executor is None:
+        init_solver()
+        warmup_task = asyncio.create_task(warm_up_solver())
+    if not ready or slots.locked():
+        stats["skipped"] += 1
+        return None
+
+    stats["attempts"] += 1
+    start = time.perf_counter()
+    async with slots:
+        pool = executor
+        future = asyncio.get_running_loop().run_in_executor(pool, _solve, prompt)
+        try:
+            answer = await asyncio.wait_for(future, timeout=SOLVER_TIMEOUT)
+        except asyncio.TimeoutError:
+            stats["timeouts"] += 1
+            answer = None
+            logger.info(f"Solver gave up after {SOLVER_TIMEOUT}s, restarting it")
+            _restart_solver(pool)
+        except Exception as e:
+            answer = None
+            logger.error(f"Solver worker failed: {e}")
+            _restart_solver(pool)
+    elapsed = time.perf_counter() - start
+    observe("solve", elapsed)
+
+    if answer is None:
+        stats["unsolved"] += 1
+        stats["fallthrough_time"] += elapsed
+        return None
+    stats["solved"] += 1
+    stats["solve_time"] += elapsed
+    return answer
+
+
+def get_solver_stats() -> dict:
+    """
+    Return how many prompts the solver answered and the GPT latency it saved.
+
+    The saved latency is estimated from the average GPT response time so far,
+    minus the time spent in the solver, including on prompts it passed on to GPT.
+    """
+    gpt_time = mean("gpt")
+    return {
+        **stats,
+        "bypass_rate": stats["solved"] / stats["prompts"] if stats["prompts"] else 0.0,
+        "avg_solve_time": stats["solve_time"] / stats["solved"] if stats["solved"] else 0.0,
+        "saved_latency": (stats["solved"] * gpt_time - stats["solve_time"] - stats["fallthrough_time"]
+                          if gpt_time is not None else None),
+    }
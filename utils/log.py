@@ -0,0 +1,191 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import IO, Iterator, Optional
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_SAMPLE_RATES
+
+# Request being handled, set per message and copied into tasks and threads it starts
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+user_id: ContextVar[Optional[int]] = ContextVar("user_id", default=None)
+# Innermost stage being timed, see utils.metrics.timed
+stage: ContextVar[Optional[str]] = ContextVar("stage", default=None)
+
+# Record fields that are written as they are
+FIELDS = ("request_id", "user_id", "stage", "duration", "worker")
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+listener: Optional[QueueListener] = None
+
+stats = {
+    "queued": 0,
+    "dropped": 0,
+    "sampled_out": 0,
+}
+
+
+@contextmanager
+def request_context(chat_id: int, msg_tg_id: int, user: Optional[int]) -> Iterator[None]:
+    """
+    Tag the log records of a block with the message it handles.
+
+    The request id is the same in the bot process and in the worker that processes the job.
+
+    Args:
+        chat_id: Chat the message came from
+        msg_tg_id: Telegram id of the message
+        user: Telegram id of the sender
+    """
+    request_token = request_id.set(f"{chat_id}:{msg_tg_id}")
+    user_token = user_id.set(user)
+    try:
+        yield
+    finally:
+        request_id.reset(request_token)
+        user_id.reset(user_token)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Add the request context to records and sample high-volume info records.
+
+    Runs in the thread that logs, where the context variables are visible. Info and
+    debug records of the loggers in LOG_SAMPLE_RATES are kept for that share of
+    requests, so the records of a sampled request stay together.
+    """
+
+    def __init__(self, worker: Optional[int]) -> None:
+        super().__init__()
+        self.worker = worker
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        request = request_id.get()
+        rate = LOG_SAMPLE_RATES.get(record.name)
+        if rate is not None and record.levelno < logging.WARNING:
+            if request is None:
+                keep = random.random() < rate
+            else:
+                keep = zlib.crc32(request.encode()) / 2 ** 32 < rate
+            if not keep:
+                stats["sampled_out"] += 1
+                return False
+        if not hasattr(record, "request_id"):
+            record.request_id = request
+        if not hasattr(record, "user_id"):
+            record.user_id = user_id.get()
+        if not hasattr(record, "stage"):
+            record.stage = stage.get()
+        record.worker = self.worker
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the request context and extra duration."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler that drops records instead of blocking when the writer falls behind."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only merge the arguments here, the writer thread formats the record
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+            stats["queued"] += 1
+        except queue.Full:
+            stats["dropped"] += 1
+
+
+class DrainingQueueListener(QueueListener):
+    """Queue listener whose stop waits for room in a full queue rather than failing."""
+
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+
+def setup_logging(worker: Optional[int] = None, stream: IO[str] = sys.stdout) -> None:
+    """
+    Log through a background writer thread.
+
+    Handlers only put records on a queue; formatting and writing to the stream,
+    which may block when stdout is a slow pipe, happen in the writer thread.
+    Replaces any handlers configured before.
+
+    Args:
+        worker: Number of the worker process, added to every record
+        stream: Where the writer thread writes the records
+    """
+    global listener
+    close_logging()
+    handler = logging.StreamHandler(stream)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        prefix = f"worker {worker} - " if worker is not None else ""
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT.replace("%(name)s", prefix + "%(name)s")))
+
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(ContextFilter(worker))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    root.setLevel(getattr(logging, LOG_LEVEL))
+
+    listener = DrainingQueueListener(queue_handler.queue, handler, respect_handler_level=True)
+    listener.start()
+
+
+def close_logging() -> None:
+    """Write the records still queued and stop the writer thread."""
+    global listener
+    if listener:
+        # Anything logged from now on goes straight to stderr
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            if isinstance(handler, QueueHandler):
+                root.removeHandler(handler)
+        listener.stop()
+        listener = None
+
+
+# Also write out what was queued when the process exits without close_logging()
+atexit.register(close_logging)
+
+
+def get_log_stats() -> dict:
+    """Return queued, dropped and sampled out record counts."""
+    return dict(stats)
@@ -0,0 +1,248 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject
+
+from config import METRICS_ENABLED, METRICS_HOST
+from utils import log
+
+logger = logging.getLogger(__name__)
+# Duration of every timed stage, sampled by LOG_SAMPLE_RATES
+stage_logger = logging.getLogger("stages")
+
+# Upper bounds of the latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, safe to update from threads."""
+
+    __slots__ = ("counts", "total", "lock")
+
+    def __init__(self) -> None:
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        index = bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+
+
+# Stage name -> latency histogram
+stages: Dict[str, Histogram] = {}
+# (stage, error type) -> count
+errors: Dict[Tuple[str, str], int] = {}
+errors_lock = threading.Lock()
+# Messages being processed right now
+in_flight = 0
+# Every recorded duration per stage, only kept while a benchmark asks for them
+samples: Optional[Dict[str, List[float]]] = None
+server_runner = None
+
+
+def observe(stage: str, seconds: float) -> None:
+    """Record the duration of one run of a stage."""
+    histogram = stages.get(stage)
+    if histogram is None:
+        histogram = stages.setdefault(stage, Histogram())
+    histogram.observe(seconds)
+    if samples is not None:
+        samples.setdefault(stage, []).append(seconds)
+
+
+def mean(stage: str) -> Optional[float]:
+    """Average duration of a stage so far, or None if it never ran."""
+    histogram = stages.get(stage)
+    if histogram is None:
+        return None
+    with histogram.lock:
+        count = sum(histogram.counts)
+        return histogram.total / count if count else None
+
+
+def keep_samples() -> Dict[str, List[float]]:
+    """Keep every recorded duration from now on, for exact percentiles in benchmarks."""
+    global samples
+    samples = {}
+    return samples
+
+
+def count_error(stage: str, error: BaseException) -> None:
+    """Count an error raised in a stage by its exception type."""
+    key = (stage, type(error).__name__)
+    with errors_lock:
+        errors[key] = errors.get(key, 0) + 1
+
+
+class timed:
+    """
+    Measure the duration of a block and count the errors it raises.
+
+    Records logged inside the block are tagged with the stage, and the duration is
+    logged as a record of the "stages" logger. Works in sync and async code alike:
+
+        with timed("render"):
+            png = await render_latex(expr)
+
+    Args:
+        stage: Name of the stage in the exported metrics
+    """
+
+    __slots__ = ("stage", "start", "token")
+
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+
+    def __enter__(self) -> "timed":
+        self.token = log.stage.set(self.stage)
+        self.start = time.perf_counter()
+        return self
+
+    def _finish(self) -> None:
+        duration = time.perf_counter() - self.start
+        log.stage.reset(self.token)
+        observe(self.stage, duration)
+        if stage_logger.isEnabledFor(logging.INFO):
+            stage_logger.info("%s took %.1f ms", self.stage, duration * 1000,
+                              extra={"stage": self.stage, "duration": round(duration, 6)})
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._finish()
+        if exc is not None and isinstance(exc, Exception):
+            count_error(self.stage, exc)
+
+
+class track_message(timed):
+    """
+    Measure the processing of a message and count it in the in-flight gauge.
+
+    Errors are counted by handle_error, which sees all of them.
+    """
+
+    __slots__ = ()
+
+    def __init__(self) -> None:
+        super().__init__("message")
+
+    def __enter__(self) -> "track_message":
+        global in_flight
+        in_flight += 1
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        global in_flight
+        in_flight -= 1
+        self._finish()
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Dispatcher middleware measuring how long handlers take for each update."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        with timed("update"):
+            return await handler(event, data)
+
+
+class MetricsRequestMiddleware(BaseRequestMiddleware):
+    """Bot session middleware measuring Bot API requests, including time spent waiting for a send slot."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        with timed("send"):
+            return await make_request(bot, method)
+
+
+def _format(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render_metrics() -> str:
+    """Render all metrics in the Prometheus text exposition format."""
+    lines: List[str] = [
+        "# HELP bot_stage_duration_seconds Duration of request processing stages.",
+        "# TYPE bot_stage_duration_seconds histogram",
+    ]
+    for stage, histogram in sorted(stages.items()):
+        with histogram.lock:
+            counts = list(histogram.counts)
+            total = histogram.total
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, counts):
+            cumulative += count
+            lines.append(f'bot_stage_duration_seconds_bucket{{stage="{stage}",le="{_format(bound)}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'bot_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {cumulative}')
+        lines.append(f'bot_stage_duration_seconds_sum{{stage="{stage}"}} {total!r}')
+        lines.append(f'bot_stage_duration_seconds_count{{stage="{stage}"}} {cumulative}')
+
+    lines.append("# HELP bot_errors_total Errors raised while processing requests.")
+    lines.append("# TYPE bot_errors_total counter")
+    with errors_lock:
+        error_counts = sorted(errors.items())
+    for (stage, kind), count in error_counts:
+        lines.append(f'bot_errors_total{{stage="{stage}",type="{kind}"}} {count}')
+
+    lines.append("# HELP bot_messages_in_flight Messages being processed.")
+    lines.append("# TYPE bot_messages_in_flight gauge")
+    lines.append(f"bot_messages_in_flight {in_flight}")
+    return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(port: int, host: str = METRICS_HOST) -> None:
+    """
+    Serve the metrics of this process on http://host:port/metrics.
+
+    Args:
+        port: Port to listen on, every process needs its own
+        host: Interface to listen on
+    """
+    global server_runner
+    if not METRICS_ENABLED:
+        return
+    from aiohttp import web
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(body=render_metrics().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    server_runner = web.AppRunner(app, access_log=None)
+    await server_runner.setup()
+    try:
+        await web.TCPSite(server_runner, host, port).start()
+    except OSError as e:
+        # Metrics are not worth failing the bot for
+        logger.error(f"Error starting metrics server on {host}:{port}: {e}")
+        await server_runner.cleanup()
+        server_runner = None
+        return
+    logger.info(f"Metrics served on http://{host}:{port}/metrics")
+
+
+async def stop_metrics_server() -> None:
+    """Stop the metrics server."""
+    global server_runner
+    if server_runner:
+        await server_runner.cleanup()
+        server_runner = None
@@ -0,0 +1,31 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Recorded (phase name, seconds) pairs in the order they finished
+phases: List[Tuple[str, float]] = []
+
+
+@contextmanager
+def startup_phase(name: str) -> Iterator[None]:
+    """
+    Measure the duration of an import or initialisation phase.
+
+    Args:
+        name: Phase name shown in the startup report
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases.append((name, time.perf_counter() - start))
+
+
+def log_startup_report() -> None:
+    """Log the time spent in every recorded startup phase."""
+    total = sum(duration for _, duration in phases)
+    lines = [f"  {name:<32} {duration * 1000:8.1f} ms" for name, duration in phases]
+    logger.info("Startup report:\n" + "\n".join(lines) + f"\n  {'total':<32} {total * 1000:8.1f} ms")
@@ -1,103 +1,369 @@
-from typing import List
+import re
+from typing import Dict, List, NamedTuple, Optional
 
+# Segment kinds
+TEXT = "text"
+CODE = "code"
+INLINE_MATH = "inline_math"
+DISPLAY_MATH = "display_math"
+MATH_KINDS = (INLINE_MATH, DISPLAY_MATH)
 
-def split_response(text: str, max_length: int = 4096) -> List[str]:
+# Characters the tokenizer has to look at, everything else is copied in bulk
+_LATEX_SPECIAL = re.compile(r"[\\$]")
+_SPLIT_SPECIAL = re.compile(r"[`$]")
+
+# Lookahead needed to rewrite LaTeX delimiters ("\(" plus up to 5 characters)
+_LATEX_LOOKAHEAD = 6
+
+
+class Segment(NamedTuple):
+    """A typed piece of a response.
+
+    Segments with the same block come from one run of text between formulas.
+    """
+    kind: str
+    text: str
+    block: int = 0
+
+
+def clear_splitted_response(text: str) -> str:
     """
-    Split a response into chunks, preserving LaTeX expressions.
+    Clean up a split response by removing leading whitespace and punctuation.
 
     Args:
-        text: The text to split
-        max_length: Maximum length of each chunk
+        text: The text to clean
 
     Returns:
-        List of text chunks
+        Cleaned text
     """
-    result = []
-    buffer = ""
-    inside_latex = False
-    delimiter = None
-    in_code_block = False
-    i = 0
-
-    while i < len(text):
-        if text[i:i + 3] == "```":
-            in_code_block = not in_code_block
-            buffer += text[i:i + 3]
-            i += 3
-            continue
-
-        if not in_code_block:
-            if text[i:i + 2] == "$$":
-                if inside_latex and delimiter == "$$":
-                    result.append("$$" + buffer + "$$")
-                    buffer = ""
-                    inside_latex = False
-                    delimiter = None
-                    i += 2
+    return text.lstrip().lstrip(" !.,:-\n")
+
+
+class _DelimiterRewriter:
+    """
+    Incrementally rewrite \\( \\) \\[ \\] delimiters into dollar signs.
+
+    Short expressions like \\(abc\\) and $x$ become *italic* text, the others are
+    turned into $$ delimiters. Only backslashes, dollar signs and positions that an
+    earlier rewrite touched are inspected, so the cost is linear in the input.
+    """
+
+    def __init__(self) -> None:
+        self._pending = ""
+        self._offset = 0
+        # Absolute position -> replacement for positions ahead of the scan
+        self._overrides: Dict[int, str] = {}
+
+    def feed(self, text: str, final: bool = False) -> str:
+        buf = self._pending + text
+        offset = self._offset
+        overrides = self._overrides
+        length = len(buf)
+        # Without the end of the input, a position can only be decided with full lookahead
+        limit = length if final else length - _LATEX_LOOKAHEAD
+        out = []
+        i = 0
+
+        def at(pos: int) -> Optional[str]:
+            return overrides.get(offset + pos, buf[pos]) if pos < length else None
+
+        while i < limit:
+            match = _LATEX_SPECIAL.search(buf, i, limit)
+            nxt = match.start() if match else limit
+            if overrides:
+                nearest = min(overrides) - offset
+                if nearest < nxt:
+                    nxt = nearest
+            if nxt > i:
+                out.append(buf[i:nxt])
+                i = nxt
+                if i >= limit:
+                    break
+
+            current, following = at(i), at(i + 1)
+            if current == "\\" and following in ("(", "["):
+                if at(i + 5) == "\\" and at(i + 6) in (")", "]"):
+                    overrides[offset + i] = ""
+                    overrides[offset + i + 1] = "*"
+                    overrides[offset + i + 5] = ""
+                    overrides[offset + i + 6] = "*"
                 else:
-                    if buffer:
-                        result.extend(split_non_latex(buffer, max_length))
-                    buffer = ""
-                    inside_latex = True
-                    delimiter = "$$"
-                    i += 2
-            elif text[i] == "$":
-                if inside_latex and delimiter == "$":
-                    result.append("$" + buffer + "$")
-                    buffer = ""
-                    inside_latex = False
-                    delimiter = None
-                    i += 1
+                    overrides[offset + i] = "$"
+                    overrides[offset + i + 1] = "$"
+            elif current == "\\" and following in (")", "]"):
+                overrides[offset + i] = "$"
+                overrides[offset + i + 1] = "$"
+            elif current == "$" and i + 2 < length and at(i + 2) == "$":
+                overrides[offset + i] = "*"
+                overrides[offset + i + 2] = "*"
+
+            out.append(overrides.pop(offset + i, buf[i]))
+            i += 1
+
+        self._pending = buf[i:]
+        self._offset = offset + i
+        return "".join(out)
+
+    @property
+    def pending(self) -> str:
+        return self._pending
+
+
+class ResponseTokenizer:
+    """
+    Single-pass tokenizer splitting a GPT response into typed segments.
+
+    Text can be fed incrementally, e.g. while the response is streamed. Formulas
+    are emitted once their closing delimiter arrives, text and code blocks as
+    soon as they are received.
+    """
+
+    def __init__(self) -> None:
+        self._rewriter = _DelimiterRewriter()
+        self._tail = ""
+        self._buffer: List[str] = []
+        self._delimiter: Optional[str] = None
+        self._in_code_block = False
+        self._block = 0
+        self._segments: List[Segment] = []
+
+    def feed(self, text: str) -> List[Segment]:
+        """
+        Tokenize the next piece of a response.
+
+        Args:
+            text: Newly received text
+
+        Returns:
+            Segments completed by this piece
+        """
+        self._scan(self._rewriter.feed(text), final=False)
+        if self._delimiter is None and self._buffer:
+            self._flush(CODE if self._in_code_block else TEXT)
+        return self._take()
+
+    def close(self) -> List[Segment]:
+        """
+        Finish tokenizing once the whole response has been fed.
+
+        Returns:
+            The remaining segments
+        """
+        self._scan(self._rewriter.feed("", final=True), final=True)
+        if self._buffer:
+            self._flush(CODE if self._in_code_block and self._delimiter is None else TEXT)
+        return self._take()
+
+    @property
+    def pending(self) -> str:
+        """Text that was received but not emitted yet."""
+        return (self._delimiter or "") + "".join(self._buffer) + self._tail + self._rewriter.pending
+
+    def _take(self) -> List[Segment]:
+        segments, self._segments = self._segments, []
+        return segments
+
+    def _flush(self, kind: str) -> None:
+        if self._buffer:
+            self._segments.append(Segment(kind, "".join(self._buffer), self._block))
+            self._buffer = []
+
+    def _fence(self) -> None:
+        if self._delimiter is not None:
+            # Fences inside a formula still toggle code mode
+            self._in_code_block = not self._in_code_block
+            self._buffer.append("```")
+        elif self._in_code_block:
+            self._buffer.append("```")
+            self._flush(CODE)
+            self._in_code_block = False
+        else:
+            self._flush(TEXT)
+            self._in_code_block = True
+            self._buffer.append("```")
+
+    def _dollar(self, delimiter: str) -> None:
+        if self._delimiter == delimiter:
+            kind = DISPLAY_MATH if delimiter == "$$" else INLINE_MATH
+            self._segments.append(Segment(kind, delimiter + "".join(self._buffer) + delimiter, self._block))
+            self._buffer = []
+            self._delimiter = None
+        else:
+            # Text before a formula, or an unterminated formula, is sent as text
+            self._flush(TEXT)
+            self._delimiter = delimiter
+        self._block += 1
+
+    def _scan(self, text: str, final: bool) -> None:
+        buf = self._tail + text
+        length = len(buf)
+        i = 0
+
+        while i < length:
+            match = _SPLIT_SPECIAL.search(buf, i)
+            nxt = match.start() if match else length
+            if nxt > i:
+                self._buffer.append(buf[i:nxt])
+                i = nxt
+                if i >= length:
+                    break
+
+            if buf[i] == "`":
+                if not final and length - i < 3 and "```".startswith(buf[i:]):
+                    break
+                if buf.startswith("```", i):
+                    self._fence()
+                    i += 3
                 else:
-                    if buffer:
-                        result.extend(split_non_latex(buffer, max_length))
-                    buffer = ""
-                    inside_latex = True
-                    delimiter = "$"
+                    self._buffer.append("`")
                     i += 1
-            else:
-                buffer += text[i]
+            elif self._in_code_block:
+                self._buffer.append("$")
                 i += 1
-        else:
-            buffer += text[i]
-            i += 1
+            else:
+                if not final and i + 1 >= length:
+                    break
+                if buf.startswith("$$", i):
+                    self._dollar("$$")
+                    i += 2
+                else:
+                    self._dollar("$")
+                    i += 1
 
-    # Add remaining buffer
-    if buffer:
-        result.extend(split_non_latex(buffer, max_length))
+        self._tail = buf[i:]
 
-    return result
 
+class ResponseSplitter:
+    """
+    Turn a response into chunks that can be sent as separate messages.
 
-def split_non_latex(text: str, max_length: int) -> List[str]:
+    Text is cut into pieces of at most max_length characters and cleaned of
+    leading whitespace and punctuation, formulas are passed through whole.
     """
-    Split non-LaTeX text into chunks of a specified length.
+
+    def __init__(self, max_length: int = 4096) -> None:
+        self._tokenizer = ResponseTokenizer()
+        self._max_length = max_length
+        self._block: Optional[int] = None
+        self._parts: List[str] = []
+        self._length = 0
+        self._chunks: List[Segment] = []
+
+    def feed(self, text: str) -> List[Segment]:
+        """
+        Split the next piece of a response.
+
+        Args:
+            text: Newly received text
+
+        Returns:
+            Chunks that are complete and can be sent
+        """
+        self._pack(self._tokenizer.feed(text))
+        return self._take()
+
+    def close(self) -> List[Segment]:
+        """
+        Finish splitting once the whole response has been fed.
+
+        Returns:
+            The remaining chunks
+        """
+        self._pack(self._tokenizer.close())
+        self._end_block()
+        return self._take()
+
+    @property
+    def pending(self) -> str:
+        """Text that was received but not emitted as a chunk yet."""
+        return "".join(self._parts) + self._tokenizer.pending
+
+    def _take(self) -> List[Segment]:
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+    def _emit(self, kind: str, text: str, block: int) -> None:
+        cleared = clear_splitted_response(text)
+        if not cleared:
+            return
+        if kind == TEXT and cleared.startswith("```") and cleared.rstrip().endswith("```") \
+                and cleared.count("```") == 2:
+            kind = CODE
+        self._chunks.append(Segment(kind, cleared, block))
+
+    def _emit_full_pieces(self, final: bool) -> None:
+        if self._length < self._max_length and not final:
+            return
+        text = "".join(self._parts)
+        start = 0
+        while len(text) - start >= self._max_length or (final and start < len(text)):
+            self._emit(TEXT, text[start:start + self._max_length], self._block)
+            start += self._max_length
+        rest = text[start:]
+        self._parts = [rest] if rest else []
+        self._length = len(rest)
+
+    def _end_block(self) -> None:
+        if self._parts:
+            self._emit_full_pieces(final=True)
+        self._block = None
+
+    def _pack(self, segments: List[Segment]) -> None:
+        for segment in segments:
+            if segment.kind in MATH_KINDS:
+                self._end_block()
+                self._emit(segment.kind, segment.text, segment.block)
+                continue
+            if segment.block != self._block:
+                self._end_block()
+                self._block = segment.block
+            self._parts.append(segment.text)
+            self._length += len(segment.text)
+            self._emit_full_pieces(final=False)
+
+
+def split_response(text: str, max_length: int = 4096) -> List[Segment]:
+    """
+    Split a complete response into text chunks and formulas.
 
     Args:
         text: The text to split
-        max_length: Maximum length of each chunk
+        max_length: Maximum length of each text chunk
 
     Returns:
-        List of text chunks
+        List of non-empty chunks in reading order
     """
-    return [text[i:i + max_length] for i in range(0, len(text), max_length)]
+    splitter = ResponseSplitter(max_length)
+    return splitter.feed(text) + splitter.close()
 
 
-def clear_splitted_response(text: str) -> str:
+def compose_messages(chunks: List[Segment], max_length: int = 4096, max_group: int = 10) -> List[List[Segment]]:
     """
-    Clean up a split response by removing leading whitespace and punctuation.
+    Group response chunks into as few outbound messages as possible.
+
+    Adjacent text chunks are merged while they fit into one message, and
+    consecutive formulas are grouped so they can be sent as one media group.
+    Reading order is preserved.
 
     Args:
-        text: The text to clean
+        chunks: Chunks produced by split_response or ResponseSplitter
+        max_length: Maximum length of a text message
+        max_group: Maximum number of formulas in one media group
 
     Returns:
-        Cleaned text
+        List of messages, each either a single text chunk or up to max_group formulas
     """
-    to_remove = " !.,:-\n"
-    text = text.lstrip()
-    for ch in text:
-        if ch in to_remove:
-            text = text[1:]
+    messages: List[List[Segment]] = []
+    for chunk in chunks:
+        last = messages[-1] if messages else None
+        if chunk.kind in MATH_KINDS:
+            if last and last[0].kind in MATH_KINDS and len(last) < max_group:
+                last.append(chunk)
+            else:
+                messages.append([chunk])
+        elif last and last[0].kind not in MATH_KINDS \
+                and len(last[0].text) + 2 + len(chunk.text) <= max_length:
+            last[0] = Segment(TEXT, last[0].text + "\n\n" + chunk.text, last[0].block)
         else:
-            break
-    return text
\ No newline at end of file
+            messages.append([chunk])
+    return messages
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import logging
+import signal
+from typing import Set
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+from aiogram.types import Message
+
+from config import (
+    TOKEN, SEND_GLOBAL_RATE, METRICS_PORT, DRAIN_TIMEOUT,
+    JOB_WORKERS, JOB_CONCURRENCY, JOB_VISIBILITY_TIMEOUT, JOB_POLL_INTERVAL, JOB_MAX_ATTEMPTS,
+)
+from database.db_manager import init_db, close_connection, flush_writes
+from database.job_queue import (
+    init_job_queue, close_job_queue, claim_job, extend_job, ack_job, drop_job, release_job,
+    current_job, get_job_stats,
+)
+from database.models import Job
+from handlers.messages import process_message, handle_error
+from services.render_service import init_renderer, close_renderer, warm_up_renderer, get_render_stats
+from services.formula_cache import init_formula_cache
+from services.ocr_service import init_ocr_service, close_ocr_service, warm_up_ocr_service
+from services.response_cache import init_response_cache
+from services.ocr_cache import get_ocr_cache_stats
+from services.conversation import get_context_stats
+from services.solver_service import init_solver, close_solver, warm_up_solver, get_solver_stats
+from services.send_scheduler import init_send_scheduler, close_send_scheduler, SendSchedulerMiddleware
+from utils.metrics import start_metrics_server, stop_metrics_server, MetricsRequestMiddleware
+from utils.log import setup_logging, close_logging, request_context, get_log_stats
+
+logger = logging.getLogger(__name__)
+
+
+async def _heartbeat(job_id: int) -> None:
+    """Extend a job's visibility timeout for as long as it is being processed."""
+    while True:
+        await asyncio.sleep(JOB_VISIBILITY_TIMEOUT / 3)
+        try:
+            await extend_job(job_id)
+        except Exception as e:
+            logger.error(f"Error extending job {job_id}: {e}")
+
+
+async def process_job(bot: Bot, job: Job) -> None:
+    """
+    Process a claimed job and acknowledge it.
+
+    Stages the job completed in an earlier attempt are skipped. If the worker is
+    stopped midway, the job is released and resumed by another worker.
+
+    Args:
+        bot: Bot used for downloads and replies
+        job: The claimed job
+    """
+    message = Message.model_validate_json(job.payload).as_(bot)
+    if job.attempts > JOB_MAX_ATTEMPTS:
+        logger.error(f"Dropping job {job.id} after {job.attempts - 1} attempts")
+        await drop_job(job.id)
+        await handle_error(message, RuntimeError(f"Job dropped after {job.attempts - 1} attempts, "
+                                                 f"last stage: {job.stage}"))
+        return
+
+    if job.stage is not None:
+        logger.info(f"Resuming job {job.id} after stage {job.stage}")
+    # Opt-outs may have been changed by the bot process
+    init_response_cache()
+
+    token = current_job.set(job)
+    heartbeat = asyncio.create_task(_heartbeat(job.id))
+    try:
+        with request_context(message.chat.id, message.message_id, message.from_user.id):
+            await process_message(message)
+    except asyncio.CancelledError:
+        await release_job(job.id)
+        raise
+    finally:
+        heartbeat.cancel()
+        current_job.reset(token)
+    # The response must be stored before the job that would redo it is gone
+    await flush_writes()
+    await ack_job(job.id)
+
+
+async def run_worker(worker_id: int) -> None:
+    """
+    Consume the job queue until SIGTERM or SIGINT.
+
+    Args:
+        worker_id: Number of the worker, used in log messages
+    """
+    # Formatting and writing log records happens in a background thread
+    setup_logging(worker_id)
+
+    init_db()
+    init_job_queue()
+    init_response_cache()
+    init_renderer()
+    init_formula_cache()
+    init_ocr_service()
+    init_solver()
+
+    bot = Bot(
+        token=TOKEN,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+    )
+    bot.session.middleware(MetricsRequestMiddleware())
+    bot.session.middleware(SendSchedulerMiddleware())
+    # The bot process and each worker send at an equal share of the global flood limit
+    init_send_scheduler(SEND_GLOBAL_RATE / (JOB_WORKERS + 1))
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    warmup = asyncio.gather(warm_up_renderer(), warm_up_ocr_service(), warm_up_solver())
+    slots = asyncio.Semaphore(JOB_CONCURRENCY)
+    tasks: Set[asyncio.Task] = set()
+
+    async def run(job: Job) -> None:
+        try:
+            await process_job(bot, job)
+        except Exception as e:
+            # Left unacknowledged, the job is retried after its visibility timeout
+            logger.error(f"Error processing job {job.id}: {e}")
+        finally:
+            slots.release()
+
+    await start_metrics_server(METRICS_PORT + worker_id + 1)
+
+    logger.info(f"Worker {worker_id} started")
+    try:
+        while not stopping.is_set():
+            await slots.acquire()
+            try:
+                job = await claim_job()
+            except Exception as e:
+                logger.error(f"Error claiming job: {e}")
+                job = None
+            if job is None:
+                slots.release()
+                try:
+                    await asyncio.wait_for(stopping.wait(), timeout=JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(run(job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        # Let running jobs finish, then hand the rest back to the queue
+        if tasks:
+            logger.info(f"Draining {len(tasks)} jobs in progress")
+            await asyncio.wait(list(tasks), timeout=DRAIN_TIMEOUT)
+        for task in list(tasks):
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        warmup.cancel()
+        await stop_metrics_server()
+        close_send_scheduler()
+        close_renderer()
+        close_ocr_service()
+        close_solver()
+        await bot.session.close()
+        logger.info(f"Job queue stats: {get_job_stats()}")
+        logger.info(f"Conversation context stats: {get_context_stats()}")
+        logger.info(f"OCR cache stats: {get_ocr_cache_stats()}")
+        logger.info(f"Renderer stats: {get_render_stats()}")
+        logger.info(f"Solver stats: {get_solver_stats()}")
+        close_job_queue()
+        close_connection()
+        logger.info(f"Logging stats: {get_log_stats()}")
+        logger.info(f"Worker {worker_id} stopped")
+        close_logging()
+
+
+def worker_main(worker_id: int) -> None:
+    """Process entry point of a worker."""
+    asyncio.run(run_worker(worker_id))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Job queue worker")
+    parser.add_argument("--id", type=int, default=0, help="worker number shown in the logs")
+    worker_main(parser.parse_args().id)